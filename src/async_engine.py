@@ -0,0 +1,450 @@
+##
+# @file async_engine.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-10
+# @brief An asyncio alternative to the rx/tx thread pair that runs receive,
+# transmit and rendering as coroutines on a single event loop (posix only)
+
+import asyncio
+import os
+import sys
+import time
+import serial
+import utils
+
+from com_tx import convert_to_bytes, EscapeError
+from keyboard_hit import KBHit
+from merged_output import MergedOutput, FramePacer
+from capture import TX
+from bulk_send import BulkSender
+from metrics import Metrics
+
+
+class AsyncEngine:
+    """
+    Runs one or more serial ports and the keyboard on one event loop. Each
+    port gets a receive coroutine that waits on the port fd, all received
+    chunks are rendered by a single coroutine (written to the terminal in
+    frames by the same pacer as the receive thread) and keyboard input is
+    sent to the first port. When monitoring several ports losing one of them does
+    not stop the others, it is reopened by its own receive coroutine. Ports
+    that were not present at the start are opened the same way.
+    """
+    def __init__(self, ports: list, pipelines: list, mode: str = "local",
+        chunk_size: int = 4096, queue_size: int = 256,
+        output: MergedOutput = None, sender: BulkSender = None,
+        metrics: Metrics = None, supervisors: list = None,
+        on_first_port=None, frame_interval: float = 0.016,
+        frame_size: int = 65536, skip_over: int = 0):
+        """
+        Initialise the engine
+
+        ### Params:
+        ports : list
+            The serial ports to monitor, opened with a timeout of 0. None
+            for a port that is not present yet, it is opened through its 
+            supervisor
+        pipelines : list
+            The RxPipeline for each port
+        mode : str = "local"
+            The mode to use for the terminal (dumb or local)
+        chunk_size : int = 4096
+            The largest number of bytes to take from a port in one read
+        queue_size : int = 256
+            The number of chunks that can wait to be rendered before the
+            receive coroutines stop reading
+        output : MergedOutput = None
+            The output to write to, by default the terminal tagged with the
+            port names
+        sender : BulkSender = None
+            Runs file sends and in session commands (::send, ::script) on the
+            first port
+        metrics : Metrics = None
+            The metrics to count reads, writes, queue depth and render times
+            in
+        supervisors : list = None
+            The PortSupervisor for each port, used to reopen a lost port 
+            when monitoring several. None leaves lost ports closed
+        on_first_port = None
+            Callable passed the first port each time it is reopened
+        frame_interval : float = 0.016
+            The shortest time between writes to the terminal while data is 
+            streaming
+        frame_size : int = 65536
+            The amount of text that is written without waiting for the frame
+            interval
+        skip_over : int = 0
+            When more than this many bytes are queued all but the newest 
+            frame_size are skipped (but still captured), 0 never skips
+        """
+        self.ports = ports
+        self.pipelines = pipelines
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+
+        self.output = output
+        if (output == None):
+            self.output = MergedOutput([os.path.basename(port.name)
+                for port in ports])
+
+        self.pacer = FramePacer(self.output, frame_interval, frame_size,
+            skip_over)
+
+        self.sender = sender
+        self._closing = False
+        if (sender != None):
+            sender.stopped = lambda: self._closing
+
+        self.metrics = metrics
+        self.supervisors = supervisors
+        self.on_first_port = on_first_port
+        self.queued_bytes = 0
+        self.queue_high_water = 0
+
+        self.kb = None
+
+    async def wait_readable(self, fd: int):
+        """
+        Wait until a file descriptor has data to read
+
+        ### Params:
+        fd : int
+            The file descriptor to wait on
+        """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(fd, ready.set_result, None)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+
+    async def receive(self, index: int, queue: asyncio.Queue):
+        """
+        Receive coroutine for a single port. Reads everything waiting each
+        time the port becomes readable and queues it for rendering. When one
+        of several ports is lost it is reopened through its supervisor.
+
+        ### Params:
+        index : int
+            The index of the port to read
+        queue : asyncio.Queue
+            The queue of (index, chunk) pairs to render
+        """
+        while (True):
+            port = self.ports[index]
+            if (port != None):
+                try:
+                    await self.read_port(index, port, queue)
+                except (serial.SerialException, OSError):
+                    if (len(self.ports) == 1):
+                        raise
+
+                    # Leave the other ports running while this one is reopened
+                    self.output.write(index, 
+                        f"{utils.get_time_str()} Lost connection\n")
+                    self.output.flush()
+
+                self.ports[index] = None
+                try:
+                    port.close()
+                except (serial.SerialException, OSError):
+                    pass
+
+            if (self.supervisors == None):
+                return
+
+            port = await self.supervisors[index].open_async()
+            self.ports[index] = port
+
+            if (index == 0):
+                if (self.sender != None):
+                    self.sender.serial_port = port
+                if (self.metrics != None):
+                    self.metrics.serial_port = port
+                if (self.on_first_port != None):
+                    self.on_first_port(port)
+
+    async def read_port(self, index: int, port: serial.Serial,
+        queue: asyncio.Queue):
+        """
+        Read a port until it is lost
+
+        ### Params:
+        index : int
+            The index of the port
+        port : serial.Serial
+            The port to read
+        queue : asyncio.Queue
+            The queue of (index, chunk) pairs to render
+
+        ### Raises:
+        serial.SerialException or OSError
+            When the port is lost
+        """
+        fd = port.fileno()
+
+        while (True):
+            await self.wait_readable(fd)
+            chunk = self.read_chunk(port)
+
+            if (self.metrics != None):
+                self.metrics.count_rx(len(chunk))
+
+            self.queued_bytes += len(chunk)
+            if (self.queued_bytes > self.queue_high_water):
+                self.queue_high_water = self.queued_bytes
+
+            await queue.put((index, chunk))
+
+    def read_chunk(self, port: serial.Serial) -> bytes:
+        """
+        Read what is waiting on a readable port (up to the chunk size)
+
+        ### Params:
+        port : serial.Serial
+            The port to read
+
+        ### Returns:
+        out : bytes
+            The bytes read
+
+        ### Raises:
+        serial.SerialException
+            When the port is readable with no data, it has been disconnected
+        """
+        chunk = port.read(max(1, min(port.in_waiting, self.chunk_size)))
+        if (chunk == b''):
+            raise serial.SerialException("device disconnected")
+
+        return chunk
+
+    async def render(self, queue: asyncio.Queue):
+        """
+        Render coroutine, passes received chunks through their pipeline and
+        writes the result to the terminal in frames
+
+        ### Params:
+        queue : asyncio.Queue
+            The queue of (index, chunk) pairs to render
+        """
+        pacer = self.pacer
+
+        while (True):
+            wait = pacer.wait_time()
+            if (not queue.empty() or wait == None):
+                index, chunk = await queue.get()
+            else:
+                try:
+                    index, chunk = await asyncio.wait_for(queue.get(), wait)
+                except asyncio.TimeoutError:
+                    pacer.frame()
+                    continue
+            self.queued_bytes -= len(chunk)
+
+            if (self.metrics != None):
+                start = time.perf_counter()
+                self.output.write(index, self.pipelines[index].process(chunk))
+                self.metrics.render_seconds.observe(time.perf_counter() - start)
+            else:
+                self.output.write(index, self.pipelines[index].process(chunk))
+
+            # Summarise rather than fall further behind, the skipped chunks
+            # are still recorded
+            if (pacer.behind(self.queued_bytes)):
+                skipped = {}
+                while (self.queued_bytes > pacer.frame_size):
+                    index, chunk = queue.get_nowait()
+                    self.queued_bytes -= len(chunk)
+                    self.pipelines[index].record(chunk)
+                    skipped[index] = skipped.get(index, 0) + len(chunk)
+
+                for index, count in skipped.items():
+                    pacer.report_skip(index, count)
+
+            pacer.frame()
+
+    def send(self, data: bytes):
+        """
+        Send data to the first port and record it in its capture, data is
+        dropped while the port is not connected
+
+        ### Params:
+        data : bytes
+            The data to send
+        """
+        if (self.ports[0] == None):
+            self.output.write(0, f"{utils.get_time_str()} Not connected, " \
+                f"{len(data)} bytes not sent\n")
+            self.output.flush()
+            return
+
+        self.ports[0].write(data)
+
+        capture = self.pipelines[0].capture
+        if (capture != None):
+            capture.write(data, TX)
+
+        if (self.metrics != None):
+            self.metrics.count_tx(len(data))
+
+    async def transmit(self):
+        """
+        Transmit coroutine, reads the keyboard and sends to the first port.
+        Returns when <esc> is pressed. Once stdin is closed local mode exits
+        as it does with the threads, dumb mode keeps receiving.
+        """
+        line = ""
+        loop = asyncio.get_running_loop()
+
+        # Sends block so run them off the event loop
+        if (self.sender != None):
+            await loop.run_in_executor(None, self.sender.run_pending)
+
+        while (True):
+            await self.wait_readable(self.kb.fd)
+
+            data = os.read(self.kb.fd, 1024)
+            if (data == b''): # stdin closed, its reader has been removed
+                if (self.mode == "local"):
+                    return
+                await loop.create_future() # Wait to be cancelled
+
+            text = self.kb.decoder.decode(data)
+            to_send = ""
+
+            for char in text:
+                if (char == '\x1B'):
+                    if (to_send):
+                        self.send(to_send.encode())
+                    return
+
+                if (char == '\b'): # Backspace handling
+                    print('\b\x20\b', end="")
+
+                if (self.mode == "dumb"):
+                    to_send += char
+                    continue
+
+                print(char, end="")
+                line += char
+
+                if (char == "\r"):
+                    print()
+                    if (self.sender != None and await loop.run_in_executor(
+                        None, self.sender.run_command, line.strip())):
+                        line = ""
+                        continue
+
+                    try:
+                        output_bytes = convert_to_bytes(line)
+                        output_bytes.append(13) # \n
+                        self.send(output_bytes)
+                    except EscapeError as e:
+                        print(f"error: {e}, line not sent")
+                    line = ""
+
+            sys.stdout.flush()
+
+            if (to_send):
+                self.send(to_send.encode())
+
+    async def run(self) -> bool:
+        """
+        Run the engine until <esc> is pressed or all the ports are lost. All
+        other coroutines are then cancelled and awaited before returning.
+
+        ### Returns:
+        out : bool
+            True if the user exited, False if a port was lost
+        """
+        self.kb = KBHit()
+        queue = asyncio.Queue(self.queue_size)
+
+        tx_task = asyncio.ensure_future(self.transmit())
+        render_task = asyncio.ensure_future(self.render(queue))
+        rx_tasks = [asyncio.ensure_future(self.receive(index, queue))
+            for index in range(len(self.ports))]
+        tasks = [tx_task, render_task] + rx_tasks
+
+        try:
+            pending = tasks
+            while (True):
+                done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                if (tx_task.done() or render_task.done()
+                    or all(task.done() for task in rx_tasks)):
+                    break
+        finally:
+            self._closing = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.kb.set_normal_term()
+
+        # Render anything received before the shutdown
+        while (not queue.empty()):
+            index, chunk = queue.get_nowait()
+            self.output.write(index, self.pipelines[index].process(chunk))
+        self.output.flush()
+
+        return tx_task.done() and not tx_task.cancelled() \
+            and tx_task.exception() == None
+
+
+def run_async_engine(ports: list, pipelines: list, mode: str = "local",
+    chunk_size: int = 4096, output: MergedOutput = None,
+    sender: BulkSender = None, metrics: Metrics = None,
+    supervisors: list = None, on_first_port=None,
+    frame_interval: float = 0.016, frame_size: int = 65536,
+    skip_over: int = 0) -> bool:
+    """
+    Run the asyncio engine on a new event loop
+
+    ### Params:
+    ports : list
+        The serial ports to monitor, opened with a timeout of 0, None for
+        ports that are not present yet
+    pipelines : list
+        The RxPipeline for each port
+    mode : str = "local"
+        The mode to use for the terminal (dumb or local)
+    chunk_size : int = 4096
+        The largest number of bytes to take from a port in one read
+    output : MergedOutput = None
+        The output to write to, by default the terminal
+    sender : BulkSender = None
+        Runs file sends and in session commands on the first port
+    metrics : Metrics = None
+        The metrics to count in, the engine is set as the metrics' 
+        async_engine while it runs
+    supervisors : list = None
+        The PortSupervisor for each port, used to reopen lost ports when
+        monitoring several
+    on_first_port = None
+        Callable passed the first port each time it is reopened
+    frame_interval : float = 0.016
+        The shortest time between writes to the terminal while streaming
+    frame_size : int = 65536
+        The amount of text written without waiting for the frame interval
+    skip_over : int = 0
+        The queued bytes over which the backlog is skipped, 0 never skips
+
+    ### Returns:
+    out : bool
+        True if the user exited, False if a port was lost
+    """
+    engine = AsyncEngine(ports, pipelines, mode, chunk_size, output=output,
+        sender=sender, metrics=metrics, supervisors=supervisors,
+        on_first_port=on_first_port, frame_interval=frame_interval,
+        frame_size=frame_size, skip_over=skip_over)
+
+    if (metrics != None):
+        metrics.async_engine = engine
+    try:
+        return asyncio.run(engine.run())
+    finally:
+        if (metrics != None):
+            metrics.async_engine = None
@@ -0,0 +1,556 @@
+##
+# @file benchmark.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-28
+# @brief Benchmarks for the receive and transmit threads run against pty
+# pairs and pyserial loop:// and socket:// stand ins. Results are printed as JSON lines.
+#
+# Usage: python3 ./src/benchmark.py [-o results.jsonl]
+
+import argparse
+import atexit
+import ctypes
+import ctypes.util
+import json
+import os
+import pty
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+import socket
+import serial
+
+from com_rx import ComRxThread, RxPipeline
+from com_tx import ComTxThread
+from merged_output import MergedOutput
+
+# The display modes benchmarked as (format, display non printable chars)
+DISPLAY_MODES = [("ascii", False), ("ascii", True), ("hex", False),
+    ("ascii+hex", False)]
+
+# The first glibc symbol version of each architecture (e.g. 2.2.5 on x86_64
+# and 2.17 on aarch64), which the malloc tracer is exported under
+GLIBC_BASE_VERSIONS = [b"GLIBC_2.2.5", b"GLIBC_2.17", b"GLIBC_2.0",
+    b"GLIBC_2.2", b"GLIBC_2.3", b"GLIBC_2.4", b"GLIBC_2.16", b"GLIBC_2.27",
+    b"GLIBC_2.29", b"GLIBC_2.32", b"GLIBC_2.35", b"GLIBC_2.36"]
+
+
+class CountingStream:
+    """
+    A stand in for stdout that throws the text away and counts it. When
+    record_times is set the time each char is flushed is recorded, so latency
+    is measured once the text has actually been written out.
+    """
+    def __init__(self, record_times: bool = False):
+        self.chars = 0
+        self.writes = 0
+        self.record_times = record_times
+        self.times = []
+        self._unflushed = 0
+
+    def write(self, text: str):
+        self.chars += len(text)
+        self.writes += 1
+        self._unflushed += len(text)
+
+    def flush(self):
+        if (self.record_times and self._unflushed):
+            self.times.extend([time.perf_counter()] * self._unflushed)
+        self._unflushed = 0
+
+
+class CountingPipeline(RxPipeline):
+    """
+    A receive pipeline that records how many bytes have been rendered, so
+    throughput can be measured at the output
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_rendered = 0
+        self.expected = None
+        self.finished = threading.Event()
+
+    def present(self, chunk: bytes) -> str:
+        text = super().present(chunk)
+
+        self.bytes_rendered += len(chunk)
+        if (self.expected != None and self.bytes_rendered >= self.expected):
+            self.finished.set()
+
+        return text
+
+
+def open_transport(transport: str) -> tuple:
+    """
+    Open a serial port stand in
+
+    ### Params:
+    transport : str
+        "pty" for an os.openpty() pair, "loop" for pyserial's loop:// or
+        "socket" for pyserial's socket:// connected to a local TCP server
+
+    ### Returns:
+    out : tuple
+        The serial port and a function that writes to the other end of it
+    """
+    if (transport == "loop"):
+        port = serial.serial_for_url("loop://", timeout=0.5)
+        return port, port.write
+
+    if (transport == "socket"):
+        server = socket.create_server(("127.0.0.1", 0))
+        port = serial.serial_for_url(
+            f"socket://127.0.0.1:{server.getsockname()[1]}", timeout=0.5)
+        peer, _ = server.accept()
+        server.close()
+
+        port.bench_peer = peer
+        return port, peer.sendall
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    port = serial.Serial(os.ttyname(slave), timeout=0.5)
+    os.close(slave)
+
+    def write(data: bytes):
+        view = memoryview(data)
+        while (len(view)):
+            view = view[os.write(master, view):]
+
+    port.bench_master = master
+    return port, write
+
+
+def close_transport(port):
+    """
+    Close a serial port stand in
+    """
+    port.close()
+    if (hasattr(port, "bench_master")):
+        os.close(port.bench_master)
+    if (hasattr(port, "bench_peer")):
+        port.bench_peer.close()
+
+
+def make_payload(size: int) -> bytes:
+    """
+    Make the data sent for the throughput tests. Mostly printable text with
+    some control chars, all valid utf-8.
+    """
+    line = b"[00123.456] sensor=0x1f value=-12.75 status=OK\x01\x02\r\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def bench_rx_throughput(transport: str, format: str, display: bool,
+    size: int, baud: int) -> dict:
+    """
+    Measure the sustained receive throughput of ComRxThread
+
+    ### Params:
+    transport : str
+        "pty", "loop" or "socket"
+    format : str
+        The output format
+    display : bool
+        Weather non printable chars are displayed
+    size : int
+        The number of bytes to send
+    baud : int
+        The baud rate to pace the sender at (10 bits a byte), 0 is unpaced
+
+    ### Returns:
+    out : dict
+        The results
+    """
+    port, write = open_transport(transport)
+    pipeline = CountingPipeline(display, format)
+    stream = CountingStream()
+    rx = ComRxThread(port, pipeline, output=MergedOutput(["rx"],
+        stream=stream))
+
+    payload = make_payload(size)
+    block = 4096 if baud == 0 else max(1, baud // 10 // 100)
+
+    def sender():
+        start = time.perf_counter()
+        for offset in range(0, size, block):
+            write(payload[offset:offset + block])
+            if (baud):
+                due = start + (offset + block) * 10 / baud
+                delay = due - time.perf_counter()
+                if (delay > 0):
+                    time.sleep(delay)
+
+    rx.start()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+
+    sender_thread = threading.Thread(target=sender, daemon=True)
+    sender_thread.start()
+
+    # Wait until everything is rendered or nothing happens for a while
+    last_count = -1
+    last_change = time.perf_counter()
+    while (pipeline.bytes_rendered < size):
+        time.sleep(0.01)
+        if (pipeline.bytes_rendered != last_count):
+            last_count = pipeline.bytes_rendered
+            last_change = time.perf_counter()
+        elif (time.perf_counter() - last_change > 2):
+            break
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    rx.stop()
+    rx.join()
+    sender_thread.join(1)
+    close_transport(port)
+
+    received = pipeline.bytes_rendered
+    return {
+        "bench": "rx_throughput",
+        "transport": transport,
+        "format": format,
+        "display": display,
+        "baud": baud,
+        "bytes_sent": size,
+        "bytes_rendered": received,
+        "dropped": size - received,
+        "seconds": round(elapsed, 6),
+        "bytes_per_s": round(received / elapsed),
+        "cpu_s_per_mb": round(cpu / (received / 1e6), 6) if received else None,
+        "writes": stream.writes,
+        "ring_high_water": rx.ring.high_water,
+        "ring_blocked": rx.ring.blocked,
+    }
+
+
+def percentiles(samples: list) -> dict:
+    """
+    Summarise latency samples in microseconds
+
+    ### Params:
+    samples : list
+        The latencies in seconds
+
+    ### Returns:
+    out : dict
+        The p50, p90, p99 and max latencies
+    """
+    if (not samples):
+        return {}
+
+    ordered = sorted(samples)
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1,
+            int(fraction * len(ordered)))] * 1e6, 1)
+
+    return {"p50_us": pick(0.5), "p90_us": pick(0.9), "p99_us": pick(0.99),
+        "max_us": round(ordered[-1] * 1e6, 1)}
+
+
+def bench_rx_latency(transport: str, count: int, interval: float) -> dict:
+    """
+    Measure the time from a byte being written to the port to the terminal
+    output it was rendered into being written and flushed, sending single
+    bytes with a gap between them
+
+    ### Params:
+    transport : str
+        "pty", "loop" or "socket"
+    count : int
+        The number of bytes to send
+    interval : float
+        The seconds between bytes
+
+    ### Returns:
+    out : dict
+        The results
+    """
+    port, write = open_transport(transport)
+    pipeline = CountingPipeline()
+    stream = CountingStream(record_times=True)
+    rx = ComRxThread(port, pipeline, output=MergedOutput(["rx"],
+        stream=stream))
+    rx.start()
+
+    sent_times = []
+    for i in range(count):
+        sent_times.append(time.perf_counter())
+        write(b"x")
+        time.sleep(interval)
+
+    time.sleep(0.1)
+    rx.stop()
+    rx.join()
+    close_transport(port)
+
+    latencies = [flushed - sent for sent, flushed
+        in zip(sent_times, stream.times)]
+
+    result = {"bench": "rx_latency", "transport": transport, "count": count,
+        "dropped": count - pipeline.bytes_rendered}
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_tx_latency(count: int, interval: float) -> dict:
+    """
+    Measure the time from a key press reaching stdin to it being written to
+    the serial port by ComTxThread in dumb mode. stdin is replaced by a pty
+    for the duration of the test.
+
+    ### Params:
+    count : int
+        The number of key presses
+    interval : float
+        The seconds between key presses
+
+    ### Returns:
+    out : dict
+        The results
+    """
+    key_master, key_slave = pty.openpty()
+    port, write = open_transport("pty")
+    device = port.bench_master
+
+    old_stdin = sys.stdin
+    sys.stdin = open(key_slave, "r", closefd=False)
+    try:
+        tx = ComTxThread(port, "dumb")
+    finally:
+        sys.stdin = old_stdin
+
+    tx.start()
+
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        os.write(key_master, b"k")
+        ready, _, _ = select.select([device], [], [], 1)
+        if (ready):
+            os.read(device, 64)
+            latencies.append(time.perf_counter() - start)
+        time.sleep(interval)
+
+    tx.stop()
+    tx.join()
+    tx.kb.set_normal_term()
+    atexit.unregister(tx.kb.set_normal_term)
+    close_transport(port)
+    os.close(key_master)
+
+    result = {"bench": "tx_latency", "transport": "pty", "count": count,
+        "dropped": count - len(latencies)}
+    result.update(percentiles(latencies))
+    return result
+
+
+def find_mtrace() -> tuple:
+    """
+    Find glibc's malloc tracer. Since glibc 2.34 libc only has a no op mtrace
+    and the real one is in libc_malloc_debug under the first symbol version
+    of the architecture, which dlsym does not return. Older versions have it
+    in libc.
+
+    ### Returns:
+    out : tuple
+        The mtrace and muntrace functions or None if they are not available
+    """
+    libc = ctypes.CDLL(None)
+    try:
+        dlvsym = libc.dlvsym
+    except AttributeError:
+        dlvsym = None
+
+    if (dlvsym != None):
+        dlvsym.restype = ctypes.c_void_p
+        dlvsym.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        for version in GLIBC_BASE_VERSIONS:
+            addresses = [dlvsym(None, name, version)
+                for name in (b"mtrace", b"muntrace")]
+            if (None not in addresses):
+                return tuple(ctypes.CFUNCTYPE(None)(address)
+                    for address in addresses)
+
+    try:
+        return libc.mtrace, libc.muntrace
+    except AttributeError:
+        return None
+
+
+def trace_rx_allocations(format: str, display: bool, size: int) -> dict:
+    """
+    Receive over a pty with glibc's malloc tracer on, run in the child 
+    process started by bench_rx_allocations. The data is written by a forked
+    process so only the receive side is traced.
+
+    ### Params:
+    format : str
+        The output format
+    display : bool
+        Weather non printable chars are displayed
+    size : int
+        The number of bytes to send
+
+    ### Returns:
+    out : dict
+        The number of bytes received, None if the tracer is not available
+    """
+    tracer = find_mtrace()
+    if (tracer == None):
+        return {"bytes_rendered": None}
+    mtrace, muntrace = tracer
+
+    port, _ = open_transport("pty")
+    payload = make_payload(size)
+    start_read, start_write = os.pipe()
+
+    # Fork before any threads are started
+    pid = os.fork()
+    if (pid == 0):
+        os.read(start_read, 1)
+        view = memoryview(payload)
+        while (len(view)):
+            view = view[os.write(port.bench_master, view[:4096]):]
+        os._exit(0)
+
+    pipeline = CountingPipeline(display, format)
+    pipeline.expected = size
+    rx = ComRxThread(port, pipeline, output=MergedOutput(["rx"],
+        stream=CountingStream()))
+    rx.start()
+    time.sleep(0.2)
+
+    mtrace()
+    os.write(start_write, b"g")
+    pipeline.finished.wait(30)
+    muntrace()
+
+    rx.stop()
+    rx.join()
+    os.waitpid(pid, 0)
+    close_transport(port)
+
+    return {"bytes_rendered": pipeline.bytes_rendered}
+
+
+def bench_rx_allocations(format: str, display: bool, size: int) -> dict:
+    """
+    Count the heap allocations made by the receive and render threads per MB
+    received over a pty. The test is run in a child process with python's
+    allocator switched to malloc and glibc's malloc tracer preloaded, each 
+    allocation in the trace is counted. Only available on Linux with glibc.
+
+    ### Params:
+    format : str
+        The output format
+    display : bool
+        Weather non printable chars are displayed
+    size : int
+        The number of bytes to send
+
+    ### Returns:
+    out : dict
+        The results, allocs_per_mb is None where it cannot be measured
+    """
+    result = {"bench": "rx_allocations", "transport": "pty", "format": format,
+        "display": display, "bytes_sent": size, "allocs_per_mb": None}
+
+    tracer = ctypes.util.find_library("c_malloc_debug")
+    if (tracer == None):
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        trace_path = os.path.join(directory, "malloc.trace")
+        env = dict(os.environ, PYTHONMALLOC="malloc", LD_PRELOAD=tracer,
+            MALLOC_TRACE=trace_path)
+        child = subprocess.run([sys.executable, os.path.abspath(__file__),
+            "--allocations-child", format, str(int(display)), str(size)],
+            env=env, stdout=subprocess.PIPE)
+        if (child.returncode != 0 or not os.path.exists(trace_path)):
+            return result
+
+        received = json.loads(child.stdout)["bytes_rendered"]
+        if (received == None):
+            return result
+
+        # malloc and calloc are logged as "+", the new block of a realloc ">"
+        allocations = 0
+        with open(trace_path, "r") as file:
+            for line in file:
+                if (" + " in line or " > " in line):
+                    allocations += 1
+
+    result["bytes_rendered"] = received
+    result["allocations"] = allocations
+    if (received):
+        result["allocs_per_mb"] = round(allocations / (received / 1e6), 1)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the receive and transmit threads.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+        help="file to append the JSON lines results to (D: stdout)")
+    parser.add_argument("-s", "--size", type=float, default=8,
+        help="megabytes sent in each throughput test (D: 8)")
+    parser.add_argument("-b", "--bauds", type=int, nargs="+",
+        default=[115200, 921600, 0],
+        help="baud rates to pace the throughput tests at, 0 is unpaced")
+    parser.add_argument("-t", "--transports", type=str, nargs="+",
+        default=["pty", "loop", "socket"], choices=["pty", "loop", "socket"])
+    parser.add_argument("-n", "--count", type=int, default=500,
+        help="samples in each latency test (D: 500)")
+    parser.add_argument("--allocations-child", nargs=3, default=None,
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if (args.allocations_child != None):
+        format, display, size = args.allocations_child
+        print(json.dumps(trace_rx_allocations(format, display == "1",
+            int(size))))
+        return
+
+    output = sys.stdout
+    if (args.output != None):
+        output = open(args.output, "a")
+
+    def report(result: dict):
+        result["time"] = time.time()
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    for transport in args.transports:
+        for baud in args.bauds:
+            # Keep the paced tests to a few seconds
+            size = int(args.size * 1e6)
+            if (baud):
+                size = min(size, baud // 10 * 3)
+
+            for format, display in DISPLAY_MODES:
+                report(bench_rx_throughput(transport, format, display, size,
+                    baud))
+
+        report(bench_rx_latency(transport, args.count, 0.002))
+
+    if ("pty" in args.transports):
+        for format, display in DISPLAY_MODES:
+            report(bench_rx_allocations(format, display, 
+                min(int(args.size * 1e6), 2000000)))
+
+    report(bench_tx_latency(args.count, 0.002))
+
+    if (output != sys.stdout):
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+##
+# @file bulk_send.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-03
+# @brief Streams files and command scripts to the serial port in large
+# chunks with optional pacing and a live throughput report
+
+import sys
+import time
+import serial
+
+from capture import CaptureWriter, TX
+from com_tx import convert_lines
+from metrics import Metrics
+import utils
+
+# In session commands typed in local mode, e.g. "::send image.bin"
+COMMAND_PREFIX = "::"
+
+
+class BulkSender:
+    """
+    Sends whole files (as is) or line based scripts (through the escape
+    encoder) to a serial port. Writes are made in large chunks and block while
+    the port's flow control (RTS/CTS or XON/XOFF set when it was opened) holds
+    them back. Throughput is printed as the send progresses.
+    """
+    def __init__(self, serial_port: serial.Serial, chunk_size: int = 4096,
+        chunk_delay: float = 0, line_delay: float = 0,
+        capture: CaptureWriter = None, stopped=None, pending: list = None,
+        metrics: Metrics = None):
+        """
+        Initialise the sender
+
+        ### Params:
+        serial_port : serial.Serial
+            The port to send to
+        chunk_size : int = 4096
+            The number of bytes written at once when sending a file
+        chunk_delay : float = 0
+            The seconds to wait between file chunks
+        line_delay : float = 0
+            The seconds to wait between script lines
+        capture : CaptureWriter = None
+            The capture to record sent data in
+        stopped = None
+            Callable returning True when the send should be abandoned
+        pending : list = None
+            Commands (e.g. "::send image.bin") to run once the transmit side 
+            starts
+        metrics : Metrics = None
+            The metrics to count sent data in
+        """
+        self.serial_port = serial_port
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.line_delay = line_delay
+        self.capture = capture
+        self.stopped = stopped if stopped != None else lambda: False
+        self.pending = pending if pending != None else []
+        self.metrics = metrics
+
+        # Other in session commands, name -> callable taking the argument
+        self.commands = {}
+
+        self._sent = 0
+        self._total = 0
+        self._started = 0.0
+        self._last_report = 0.0
+
+    def _write(self, data: bytes):
+        """
+        Write to the port, record in the capture and update the progress
+        """
+        if (self.serial_port == None): # Not present yet (several ports)
+            raise serial.SerialException("port not connected")
+
+        self.serial_port.write(data)
+
+        if (self.capture != None):
+            self.capture.write(data, TX)
+
+        if (self.metrics != None):
+            self.metrics.count_tx(len(data))
+
+        self._sent += len(data)
+        now = time.monotonic()
+        if (now - self._last_report >= 0.5):
+            self._last_report = now
+            self.report()
+
+    def report(self, end: str = ""):
+        """
+        Print the progress and achieved throughput of the current send
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        print(f"\r{utils.get_time_str()} Sent {self._sent}/{self._total} " \
+            f"bytes ({self._sent / elapsed / 1000:.1f} kB/s)", end=end)
+        sys.stdout.flush()
+
+    def _start(self, total: int):
+        self._sent = 0
+        self._total = total
+        self._started = time.monotonic()
+        self._last_report = self._started
+
+    def send_file(self, path: str) -> int:
+        """
+        Send a file as is
+
+        ### Params:
+        path : str
+            The file to send
+
+        ### Returns:
+        out : int
+            The number of bytes sent
+        """
+        with open(path, "rb") as file:
+            file.seek(0, 2)
+            self._start(file.tell())
+            file.seek(0)
+
+            while (not self.stopped()):
+                chunk = file.read(self.chunk_size)
+                if (chunk == b""):
+                    break
+
+                self._write(chunk)
+
+                if (self.chunk_delay):
+                    time.sleep(self.chunk_delay)
+
+        self.report("\r\n")
+        return self._sent
+
+    def send_script(self, path: str) -> int:
+        """
+        Send a line based script. Every line is converted with the escape
+        encoder before anything is sent so a bad line stops the whole script.
+        Without a line delay the converted lines are sent in large chunks.
+
+        ### Params:
+        path : str
+            The script to send
+
+        ### Returns:
+        out : int
+            The number of bytes sent
+
+        ### Raises:
+        EscapeError
+            If a line has a bad escape sequence
+        """
+        with open(path, "r") as file:
+            lines = convert_lines(file)
+
+        self._start(sum(len(line) for line in lines))
+
+        if (self.line_delay):
+            for line in lines:
+                if (self.stopped()):
+                    break
+                self._write(line)
+                time.sleep(self.line_delay)
+        else:
+            data = b"".join(lines)
+            for offset in range(0, len(data), self.chunk_size):
+                if (self.stopped()):
+                    break
+                self._write(data[offset:offset + self.chunk_size])
+
+        self.report("\r\n")
+        return self._sent
+
+    def run_pending(self):
+        """
+        Run the commands queued for the start of the session
+        """
+        while (self.pending and not self.stopped()):
+            self.run_command(self.pending.pop(0))
+
+    def run_command(self, command: str) -> bool:
+        """
+        Run an in session command if the line is one
+
+        ### Params:
+        command : str
+            The line typed by the user
+
+        ### Returns:
+        out : bool
+            True if the line was a command (and should not be sent)
+        """
+        if (not command.startswith(COMMAND_PREFIX)):
+            return False
+
+        name, _, argument = command[len(COMMAND_PREFIX):].strip().partition(" ")
+        argument = argument.strip()
+
+        try:
+            if (name == "send"):
+                self.send_file(argument)
+            elif (name == "script"):
+                self.send_script(argument)
+            elif (name in self.commands):
+                self.commands[name](argument)
+            else:
+                print(f"error: unknown command {name}, use " \
+                    f"{COMMAND_PREFIX}send FILE or {COMMAND_PREFIX}script FILE")
+        except (OSError, ValueError) as e: # Includes EscapeError
+            print(f"\r\nerror: {e}")
+
+        return True
@@ -0,0 +1,411 @@
+##
+# @file capture.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-18
+# @brief Writes the raw received data to disk with optional rotation by size
+# or time and background compression of finished files. Also provides the
+# time stamped record format and a reader for it.
+
+import bisect
+import collections
+import gzip
+import mmap
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+import weakref
+
+import utils
+
+# Record direction flags
+RX = 0
+TX = 1
+
+# Record capture layout. The file starts with a magic and the wall clock time
+# of time stamp 0, followed by records made of a fixed size header (time
+# stamp in ns, direction, payload length) and the payload. The sidecar index
+# (.idx) holds (time stamp, file offset) pairs at a fixed time interval.
+CAPTURE_MAGIC = b"BSCAP001"
+FILE_HEADER = struct.Struct("<8sd")
+RECORD_HEADER = struct.Struct("<QBxxxI")
+INDEX_ENTRY = struct.Struct("<QQ")
+
+CaptureRecord = collections.namedtuple("CaptureRecord",
+    ["timestamp", "direction", "data"])
+
+
+class CaptureWriter:
+    """
+    Writes received chunks straight to disk through a large buffer. When a
+    size or time limit is given the capture is split over numbered files
+    (capture.0000.bin, capture.0001.bin, ...) and finished files can be
+    gzipped by a background thread so compression never blocks receiving.
+
+    In record mode each chunk is stored with a time stamp and direction and
+    a sidecar index is written next to each file for seeking by time.
+    """
+    def __init__(self, path: str, rotate_size: int = None,
+        rotate_time: float = None, compress: bool = False,
+        buffer_size: int = 1024 * 1024, records: bool = False,
+        index_interval: float = 1.0):
+        """
+        Open the capture
+
+        ### Params:
+        path : str
+            The capture file, numbered when rotating
+        rotate_size : int = None
+            The number of bytes to write to a file before starting the next
+        rotate_time : float = None
+            The number of seconds to write to a file before starting the next
+        compress : bool = False
+            Gzip each file once it has been rotated out
+        buffer_size : int = 1024 * 1024
+            The size of the write buffer
+        records : bool = False
+            Write time stamped records rather than the raw data
+        index_interval : float = 1.0
+            The seconds between entries in the record index
+        """
+        self.path = path
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.buffer_size = buffer_size
+        self.rotating = rotate_size != None or rotate_time != None
+
+        self.records = records
+        self.index_interval = int(index_interval * 1e9)
+
+        self.bytes_written = 0
+        self.file_number = 0
+        self.file = None
+        self.index_file = None
+
+        self._header_size = FILE_HEADER.size if records else 0
+        self._start_ns = time.monotonic_ns()
+        self._start_wall = time.time()
+
+        self._lock = threading.Lock()
+
+        self._compress_queue = None
+        if (compress):
+            self._compress_queue = queue.Queue()
+            threading.Thread(target=self._compress_worker,
+                name="capture_compress_thread", daemon=True).start()
+
+        # Carry on after the files from an earlier capture
+        while (self.rotating 
+            and (os.path.exists(self.file_path(self.file_number))
+            or os.path.exists(self.file_path(self.file_number) + ".gz"))):
+            self.file_number += 1
+
+        self._open_next()
+
+    def file_path(self, number: int) -> str:
+        """
+        Get the path of a capture file
+
+        ### Params:
+        number : int
+            The file number
+
+        ### Returns:
+        out : str
+            The path of the file
+        """
+        if (not self.rotating):
+            return self.path
+
+        root, ext = os.path.splitext(self.path)
+        return f"{root}.{number:04d}{ext}"
+
+    def _open_next(self):
+        """
+        Close the current file and open the next one
+        """
+        if (self.file != None):
+            self._close_files()
+            if (self._compress_queue != None):
+                self._compress_queue.put(self.file.name)
+            self.file_number += 1
+
+        path = self.file_path(self.file_number)
+        self._file_bytes = 0
+        self._file_opened = time.monotonic()
+
+        if (not self.records):
+            self.file = open(path, "ab", buffering=self.buffer_size)
+            return
+
+        # Records can not be appended to an old capture as the time stamps
+        # would not line up
+        self.file = open(path, "xb", buffering=self.buffer_size)
+        self.index_file = open(path + ".idx", "xb")
+        self._next_index = 0
+
+        self.file.write(FILE_HEADER.pack(CAPTURE_MAGIC, self._start_wall))
+        self._file_bytes = FILE_HEADER.size
+
+    def _close_files(self):
+        """
+        Close the current capture file and its index
+        """
+        self.file.close()
+        if (self.index_file != None):
+            self.index_file.close()
+
+    def write(self, chunk: bytes, direction: int = RX):
+        """
+        Write a chunk to the capture
+
+        ### Params:
+        chunk : bytes
+            The received or sent bytes
+        direction : int = RX
+            RX or TX, raw captures only hold received data so sent data is
+            ignored unless in record mode
+        """
+        if (direction == TX and not self.records):
+            return
+
+        with self._lock:
+            if (self.rotating and self._file_bytes > self._header_size
+                and self._needs_rotate(len(chunk))):
+                self._open_next()
+
+            if (self.records):
+                self._write_record_header(len(chunk), direction)
+
+            self.file.write(chunk)
+            self._file_bytes += len(chunk)
+            self.bytes_written += len(chunk)
+
+    def _write_record_header(self, length: int, direction: int):
+        """
+        Write the header for the next record and add an index entry if the
+        index interval has passed
+
+        ### Params:
+        length : int
+            The payload length
+        direction : int
+            RX or TX
+        """
+        timestamp = time.monotonic_ns() - self._start_ns
+
+        if (timestamp >= self._next_index):
+            self.index_file.write(INDEX_ENTRY.pack(timestamp, 
+                self._file_bytes))
+            self._next_index = timestamp - timestamp % self.index_interval \
+                + self.index_interval
+
+        self.file.write(RECORD_HEADER.pack(timestamp, direction, length))
+        self._file_bytes += RECORD_HEADER.size
+
+    def _needs_rotate(self, length: int) -> bool:
+        """
+        Check if the next write should go to a new file
+
+        ### Params:
+        length : int
+            The length of the next write
+
+        ### Returns:
+        out : bool
+            True if the current file is full or too old
+        """
+        if (self.rotate_size != None
+            and self._file_bytes + length > self.rotate_size):
+            return True
+
+        return self.rotate_time != None \
+            and time.monotonic() - self._file_opened >= self.rotate_time
+
+    def _compress_worker(self):
+        """
+        Background thread that gzips finished capture files. A file that
+        fails to compress is left as it is (along with any partial .gz) and
+        the worker carries on with the next.
+        """
+        while (True):
+            path = self._compress_queue.get()
+
+            try:
+                with open(path, "rb") as src, \
+                    gzip.open(path + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.remove(path)
+            except OSError as e: # Includes a missing file and a full disk
+                print(f"\r\n{utils.get_time_str()} Could not compress " \
+                    f"{path}: {e}\r")
+            finally:
+                self._compress_queue.task_done()
+
+    def flush(self):
+        """
+        Flush the buffered data to disk
+        """
+        with self._lock:
+            self.file.flush()
+            if (self.index_file != None):
+                self.index_file.flush()
+
+    def close(self):
+        """
+        Close the capture and wait for any compression to finish
+        """
+        with self._lock:
+            self._close_files()
+
+        if (self._compress_queue != None):
+            self._compress_queue.join()
+
+
+class _IndexTimes:
+    """
+    A sequence view of the time stamps in a mapped index so it can be
+    searched with bisect without loading it
+    """
+    def __init__(self, entries: memoryview):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries) // 2
+
+    def __getitem__(self, i: int) -> int:
+        return self.entries[i * 2]
+
+
+class CaptureReader:
+    """
+    Reads a record capture file. The file is memory mapped and records are
+    produced lazily with the payload as a memoryview into the map, so even
+    very large captures are not loaded into memory. A payload view is only
+    valid until the next record is read, copy it with bytes() to keep it.
+    """
+    def __init__(self, path: str):
+        """
+        Open a record capture
+
+        ### Params:
+        path : str
+            The capture file, the index is loaded from path + ".idx" if it
+            exists
+
+        ### Raises:
+        ValueError
+            If the file is not a record capture (including an empty file)
+        """
+        self.path = path
+        self._generators = weakref.WeakSet()
+
+        with open(path, "rb") as file:
+            # An empty file cannot be mapped
+            if (os.fstat(file.fileno()).st_size < FILE_HEADER.size):
+                raise ValueError(f"{path} is not a record capture")
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.start_time = FILE_HEADER.unpack_from(self.map, 0)
+        if (magic != CAPTURE_MAGIC):
+            raise ValueError(f"{path} is not a record capture")
+
+        self.index = None
+        if (os.path.exists(path + ".idx") 
+            and os.path.getsize(path + ".idx") >= INDEX_ENTRY.size):
+            with open(path + ".idx", "rb") as file:
+                self._index_map = mmap.mmap(file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+            length = len(self._index_map) // INDEX_ENTRY.size * INDEX_ENTRY.size
+            self.index = memoryview(self._index_map)[:length].cast("Q")
+
+    def offset_for_time(self, seconds: float) -> int:
+        """
+        Find the file offset of the first record at or before a time using
+        the index
+
+        ### Params:
+        seconds : float
+            The time since the start of the capture
+
+        ### Returns:
+        out : int
+            The offset to start reading records from
+        """
+        if (self.index == None):
+            return FILE_HEADER.size
+
+        i = bisect.bisect_right(_IndexTimes(self.index), int(seconds * 1e9))
+        if (i == 0):
+            return FILE_HEADER.size
+
+        return self.index[(i - 1) * 2 + 1]
+
+    def records(self, start: float = None, end: float = None):
+        """
+        Iterate over the records in the capture. The payload of each record
+        is released when the next one is read.
+
+        ### Params:
+        start : float = None
+            Only yield records from this many seconds into the capture
+        end : float = None
+            Stop at the first record after this many seconds
+
+        ### Returns:
+        out : generator
+            CaptureRecord tuples with the time stamp in seconds
+        """
+        generator = self._records(start, end)
+        self._generators.add(generator)
+        return generator
+
+    def _records(self, start: float, end: float):
+        """
+        The generator behind records, its views of the map are released as
+        it goes so the map can be closed
+        """
+        offset = FILE_HEADER.size
+        start_ns = 0
+        if (start != None):
+            offset = self.offset_for_time(start)
+            start_ns = int(start * 1e9)
+        end_ns = None if end == None else int(end * 1e9)
+
+        length = len(self.map)
+
+        with memoryview(self.map) as view:
+            while (offset + RECORD_HEADER.size <= length):
+                timestamp, direction, size = RECORD_HEADER.unpack_from(
+                    self.map, offset)
+                offset += RECORD_HEADER.size
+
+                if (offset + size > length): # Truncated final record
+                    break
+
+                if (end_ns != None and timestamp > end_ns):
+                    break
+
+                if (timestamp >= start_ns):
+                    with view[offset:offset + size] as data:
+                        yield CaptureRecord(timestamp / 1e9, direction, data)
+
+                offset += size
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        """
+        Unmap the capture, any unfinished records generators are closed
+        first
+        """
+        for generator in list(self._generators):
+            generator.close()
+
+        if (self.index != None):
+            self.index.release()
+            self._index_map.close()
+        self.map.close()
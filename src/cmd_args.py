@@ -7,6 +7,12 @@
 import argparse
 
 from configuration import ConfigDict
+from framing import FRAMING_TYPES
+from port_index import parse_vid_pid
+from ring_buffer import RING_POLICIES
+from render import ENCODINGS, DECODE_ERRORS
+from line_filter import COLOURS
+from decoders import DECODERS
 
 def setup_cmd_args(default_cfg: ConfigDict) -> argparse.ArgumentParser:
     """
@@ -47,6 +53,51 @@ def setup_cmd_args(default_cfg: ConfigDict) -> argparse.ArgumentParser:
         choices=["Y", "N"], default=default_cfg.serial.parity,
         help=f"whether parity is enabled (D: \"{default_cfg.serial.parity}\")")
     
+    serial_settings.add_argument("-P", "--add-port", type=str, 
+        action="append", default=[], metavar="PORT",
+        help="""another port to monitor with the same settings, may be given 
+        more than once. Received lines are tagged with the port name""")
+
+    serial_settings.add_argument("--port-logs", type=str, action="store",
+        default=None, metavar="DIR",
+        help="directory to also write a log file for each port to")
+
+    serial_settings.add_argument("-l", "--list", action="store_true",
+        help="list the available serial ports and exit")
+
+    serial_settings.add_argument("--vid-pid", type=parse_vid_pid, 
+        action="store", default=None, metavar="VID:PID",
+        help="""open the first USB port with this vendor and product id (hex, 
+        either may be left out) instead of port, found again if it is 
+        replugged under another name""")
+
+    serial_settings.add_argument("--serial-number", type=str, action="store",
+        default=None, help="open the USB port with this serial number")
+
+    serial_settings.add_argument("--description", type=str, action="store",
+        default=None, help="open the first port whose description contains this")
+
+    serial_settings.add_argument("--flow", type=str, action="store",
+        default=default_cfg.serial.flow, choices=["none", "rtscts", "xonxoff"],
+        help=f"""flow control for the port 
+        (D: \"{default_cfg.serial.flow}\")""")
+
+    serial_settings.add_argument("-c", "--chunk-size", type=int, 
+        action="store", default=default_cfg.serial.chunk_size,
+        help=f"""largest number of bytes to read from the port at once 
+        (D: {default_cfg.serial.chunk_size})""")
+    
+    serial_settings.add_argument("--ring-size", type=int, action="store",
+        default=default_cfg.serial.ring_size, metavar="KB",
+        help=f"""size of the buffer between reading the port and displaying 
+        the data (D: {default_cfg.serial.ring_size})""")
+
+    serial_settings.add_argument("--overflow", type=str, action="store",
+        default=default_cfg.serial.overflow, choices=RING_POLICIES,
+        help=f"""what to do when the display falls a whole buffer behind: wait,
+        drop the oldest data or drop new data and report each gap once 
+        (D: \"{default_cfg.serial.overflow}\")""")
+    
     # Mode select
     parser.add_argument("-m", "--mode", nargs="?", action="store", 
         default=default_cfg.mode,
@@ -54,13 +105,224 @@ def setup_cmd_args(default_cfg: ConfigDict) -> argparse.ArgumentParser:
         help=f"""mode to start the monitor in dumb or local(-line) 
         (D: \"{default_cfg.mode}\")""")
     
+    # Engine select
+    parser.add_argument("--engine", action="store", default=default_cfg.engine,
+        type=str, choices=["thread", "asyncio"],
+        help=f"""run the receive and transmit sides as a thread pair or as 
+        coroutines on one asyncio event loop (posix only) 
+        (D: \"{default_cfg.engine}\")""")
+    
     # Non printable char display toggle
     parser.add_argument("-d", "--display", action="store_true", 
         default=default_cfg.terminal.display_npc, help="""enable the printing
         of non-printable chars""")
     
-    # # Print in byte formula
-    # parser.add_argument("-a", "--all", action="store_true", default=False,
-    #     help="enable printing of all chars as bytes")
+    # Numerical output format
+    parser.add_argument("-f", "--format", action="store",
+        default=default_cfg.terminal.format, type=str,
+        choices=["ascii", "hex", "dec", "bin", "ascii+hex"],
+        help=f"""format to print received data in, ascii or a numerical dump
+        (D: \"{default_cfg.terminal.format}\")""")
+
+    # Text decoding
+    parser.add_argument("--encoding", action="store", type=str,
+        default=default_cfg.terminal.encoding, choices=ENCODINGS,
+        help=f"""encoding received text is decoded as, characters split 
+        across reads are joined (D: \"{default_cfg.terminal.encoding}\")""")
+
+    parser.add_argument("--decode-errors", action="store", type=str,
+        default=default_cfg.terminal.decode_errors, choices=DECODE_ERRORS,
+        help=f"""how bytes that are not valid in the encoding are shown, as 
+        \ufffd, as \\xNN escapes or as <NN> 
+        (D: \"{default_cfg.terminal.decode_errors}\")""")
+
+    # Terminal update rate
+    parser.add_argument("--frame-ms", type=float, action="store",
+        default=default_cfg.terminal.frame_ms, metavar="MS",
+        help=f"""shortest time between terminal updates while data is 
+        streaming (D: {default_cfg.terminal.frame_ms})""")
+
+    parser.add_argument("--frame-kb", type=int, action="store",
+        default=default_cfg.terminal.frame_kb, metavar="KB",
+        help=f"""output that is written without waiting for the next update
+        (D: {default_cfg.terminal.frame_kb})""")
+
+    parser.add_argument("--skip-over", type=int, action="store",
+        default=default_cfg.terminal.skip_over, metavar="KB",
+        help=f"""when more than this is waiting to be displayed skip to the 
+        newest data and show how much was skipped, captures still get 
+        everything. 0 never skips (D: {default_cfg.terminal.skip_over})""")
+
+    # Scrollback
+    parser.add_argument("--scrollback", type=float, action="store",
+        default=default_cfg.terminal.scrollback, metavar="MB",
+        help=f"""memory to keep received data in for the ::find, ::findhex, 
+        ::jump and ::next commands, only kept in local mode. 0 disables 
+        (D: {default_cfg.terminal.scrollback})""")
+
+    # Metrics
+    metrics_settings = parser.add_argument_group("Metrics",
+        """Throughput, queue, error and reconnect counters. In local mode 
+        ::status shows or hides the status line""")
+
+    metrics_settings.add_argument("--status", action="store_true",
+        default=default_cfg.terminal.status,
+        help="show a status line at the bottom of the terminal")
+
+    metrics_settings.add_argument("--metrics-file", type=str, action="store",
+        default=None, metavar="FILE", 
+        help="file to append the metrics to as JSON lines")
+
+    metrics_settings.add_argument("--metrics-port", type=int, action="store",
+        default=None, metavar="PORT", help="""serve the metrics as Prometheus
+        text on http://127.0.0.1:PORT/metrics""")
+
+    metrics_settings.add_argument("--metrics-interval", type=float, 
+        action="store", default=1.0, metavar="SECONDS",
+        help="time between metrics file lines (D: 1)")
+
+    # Profiling
+    profile_settings = parser.add_argument_group("Profiling",
+        "Time the receive and transmit stages, written to a file at exit")
+
+    profile_settings.add_argument("--profile", type=str, action="store",
+        default=None, metavar="FILE", help="""file to write the time spent in
+        each stage (read, record, render, decode, flush, encode, write) to""")
+
+    profile_settings.add_argument("--profile-python", action="store_true",
+        help="also run cProfile on each thread (saved to FILE.pstats)")
+
+    profile_settings.add_argument("--profile-memory", action="store_true",
+        help="also report the top allocations with tracemalloc")
+
+    # Line filtering
+    filter_settings = parser.add_argument_group("Filter",
+        """Filter and highlight received lines, data is split into lines 
+        if no framing is given. Captures still get everything""")
+
+    filter_settings.add_argument("--include", type=str, action="append",
+        default=default_cfg.terminal.include, metavar="REGEX",
+        help="""only show lines matching this, may be given more than once""")
+
+    filter_settings.add_argument("--exclude", type=str, action="append",
+        default=default_cfg.terminal.exclude, metavar="REGEX",
+        help="""hide lines matching this (even if they are included), may be 
+        given more than once""")
+
+    filter_settings.add_argument("--highlight", type=str, action="append",
+        default=default_cfg.terminal.highlight, metavar="COLOUR:REGEX",
+        help=f"""colour text matching REGEX, the colour is one of 
+        {", ".join(COLOURS)} and may be prefixed with bold- (e.g. 
+        bold-red:ERROR), may be given more than once""")
+
+    # Packet framing
+    framing_settings = parser.add_argument_group("Framing",
+        "Split received data into packets printed one per line")
+
+    framing_settings.add_argument("-e", "--eop", type=str, action="store",
+        default=default_cfg.terminal.new_line_char,
+        help=f"""end of packet identifier, may use the escape sequences 
+        accepted in local mode (D: \"{default_cfg.terminal.new_line_char}\")""")
+
+    framing_settings.add_argument("--framing", type=str, action="store",
+        default=default_cfg.terminal.framing, choices=FRAMING_TYPES,
+        help=f"""method used to split packets, delim is selected when an end 
+        of packet identifier is given (D: \"{default_cfg.terminal.framing}\")""")
+
+    framing_settings.add_argument("--length-size", type=int, action="store",
+        default=default_cfg.terminal.length_size, choices=[1, 2, 4],
+        help=f"""number of bytes in the header for length framing
+        (D: {default_cfg.terminal.length_size})""")
+
+    framing_settings.add_argument("--packet-log", type=str, action="store",
+        default=None, help="file to append received packets to as hex")
+
+    # Protocol decoding
+    decoder_settings = parser.add_argument_group("Decoder",
+        """Decode each packet into fields, Modbus RTU picks its own framing 
+        and struct layouts need a framing method""")
+
+    decoder_settings.add_argument("--decoder", type=str, action="store",
+        default=default_cfg.decoder.type, metavar="DECODER",
+        help=f"""decoder to use, one of none, {", ".join(DECODERS)} or 
+        module:Class to load a plugin (D: "{default_cfg.decoder.type}")""")
+
+    decoder_settings.add_argument("--layout", type=str, action="store",
+        default=default_cfg.decoder.layout, metavar="NAME",
+        help=f"""struct layout to decode packets with, from the decoder 
+        layouts in the settings or --layouts 
+        (D: "{default_cfg.decoder.layout}")""")
+
+    decoder_settings.add_argument("--layouts", type=str, action="store",
+        default=None, metavar="FILE", help="""JSON file of more struct 
+        layouts, each {"format": "<BhH", "fields": ["id", "x", "y"]}""")
+
+    # Raw capture to disk
+    capture_settings = parser.add_argument_group("Capture",
+        "Write all received data to disk as it arrives")
+
+    capture_settings.add_argument("--capture", type=str, action="store",
+        default=None, metavar="FILE", help="""file to capture received data 
+        to, the port name is added when monitoring more than one port""")
+
+    capture_settings.add_argument("--capture-format", type=str, 
+        action="store", default="raw", choices=["raw", "records"],
+        help="""write the raw received bytes or time stamped records of sent
+        and received data with an index for seeking (D: "raw")""")
+
+    capture_settings.add_argument("--capture-size", type=float, 
+        action="store", default=None, metavar="MB",
+        help="start a new capture file after this many megabytes")
+
+    capture_settings.add_argument("--capture-time", type=float,
+        action="store", default=None, metavar="SECONDS",
+        help="start a new capture file after this many seconds")
+
+    capture_settings.add_argument("--capture-compress", action="store_true",
+        default=False, help="gzip capture files once they are rotated out")
+
+    # Bulk send
+    send_settings = parser.add_argument_group("Send",
+        """Send files and scripts once the port opens. In local mode 
+        ::send FILE and ::script FILE do the same during a session""")
+
+    send_settings.add_argument("--send-file", type=str, action="append",
+        default=[], metavar="FILE", help="file to send as is")
+
+    send_settings.add_argument("--send-script", type=str, action="append",
+        default=[], metavar="FILE", help="""file of lines to send, escape
+        sequences are converted as in local mode""")
+
+    send_settings.add_argument("--chunk-delay", type=float, action="store",
+        default=0, metavar="SECONDS", 
+        help="time to wait between each chunk of a file (D: 0)")
+
+    send_settings.add_argument("--line-delay", type=float, action="store",
+        default=0, metavar="SECONDS", 
+        help="time to wait between each line of a script (D: 0)")
+
+    # Expect
+    expect_settings = parser.add_argument_group("Expect",
+        """Run a script of send and expect commands against the device""")
+
+    expect_settings.add_argument("--expect-script", type=str, action="store",
+        default=None, metavar="FILE", help="""script to run once the port 
+        opens, see expect.py for the commands""")
+
+    expect_settings.add_argument("--expect-timeout", type=float, 
+        action="store", default=10, metavar="SECONDS",
+        help="time to wait for each expect (D: 10)")
+
+    # Replay
+    replay_settings = parser.add_argument_group("Replay",
+        "Play a capture back through the display instead of opening a port")
+
+    replay_settings.add_argument("--replay", type=str, action="store",
+        default=None, metavar="FILE", help="capture file to replay")
+
+    replay_settings.add_argument("--replay-speed", type=float, 
+        action="store", default=0, metavar="SPEED",
+        help="""playback speed relative to the recorded timing of a record 
+        capture, 0 replays as fast as possible (D: 0)""")
 
     return parser
\ No newline at end of file
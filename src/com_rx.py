@@ -1,23 +1,201 @@
-## 
+##
 # @file com_rx.py
 # @author Jack Duignan (JackpDuignan@gmail.com)
 # @date 2024-06-30
 # @brief This file contains the functionality to receive communications from
 # the serial port and print them to the terminal
 
-import string
-import sys
+import io
+import os
+import select
 import serial
 import threading
+import time
 import utils
 
+from render import render_npc, DumpFormatter, StreamDecoder
+from framing import Framer
+from capture import CaptureWriter
+from merged_output import MergedOutput, FramePacer
+from ring_buffer import RingBuffer
+from metrics import Metrics
+from line_filter import LineFilter
+from decoders import Decoder
+
+
+class RxPipeline:
+    """
+    The processing applied to received data between the serial read and the
+    terminal. Shared by the receive thread and the asyncio engine and kept
+    across reconnects so framing state is not lost.
+    """
+    def __init__(self, display: bool = False, format: str = "ascii",
+        framer: Framer = None, packet_sinks: list = None,
+        capture: CaptureWriter = None, chunk_sinks: list = None,
+        encoding: str = "utf-8", errors: str = "replace",
+        line_filter: LineFilter = None,
+        packet_decoder: Decoder = None):
+        """
+        Initialise the receive pipeline
+
+        ### Params:
+        display : bool = False
+            Weather to display non printable characters
+        format : str = "ascii"
+            The output format, ascii or one of the numerical dump formats
+            (hex, dec, bin or ascii+hex)
+        framer : Framer = None
+            The framer used to split the received data into packets, each
+            packet is printed on its own line. None prints the data as is
+        packet_sinks : list = None
+            Callables that are passed each packet found by the framer
+        capture : CaptureWriter = None
+            The capture to write all received data to before it is rendered
+        chunk_sinks : list = None
+            Callables that are passed each received chunk before framing
+            (e.g. an Expecter)
+        encoding : str = "utf-8"
+            The encoding received text is decoded as
+        errors : str = "replace"
+            How invalid bytes are shown (replace, escape or hex)
+        line_filter : LineFilter = None
+            The filter and highlighting applied to the rendered packets, the
+            capture and sinks still get everything
+        packet_decoder : Decoder = None
+            The decoder that turns each packet into the records printed in
+            place of the packet
+        """
+        self.display = display
+        self.capture = capture
+
+        self.dump_formatter = None
+        if (format != "ascii"):
+            self.dump_formatter = DumpFormatter(format)
+
+        self.decoder = StreamDecoder(encoding, errors)
+
+        self.framer = framer
+        self.packet_sinks = packet_sinks if packet_sinks != None else []
+        self.chunk_sinks = chunk_sinks if chunk_sinks != None else []
+        self.line_filter = line_filter
+        self.packet_decoder = packet_decoder
+
+    def render(self, chunk: bytes, final: bool = False) -> str:
+        """
+        Convert a chunk of received bytes into the text to print
+
+        ### Params:
+        chunk : bytes
+            The received bytes
+        final : bool = False
+            The chunk is a whole packet so no character continues after it
+
+        ### Returns:
+        out : str
+            The text to write to the terminal
+        """
+        if (self.dump_formatter != None):
+            return self.dump_formatter.render(chunk)
+
+        if (not self.display):
+            return self.decoder.decode(chunk, final)
+
+        return render_npc(chunk)
+
+    def render_packets(self, chunk: bytes) -> str:
+        """
+        Pass a chunk through the framer and render each complete packet on its
+        own line. The packets are also handed to each of the packet sinks.
+
+        ### Params:
+        chunk : bytes
+            The received bytes
+
+        ### Returns:
+        out : str
+            The text to write to the terminal
+        """
+        output = []
+        for packet in self.framer.feed(chunk):
+            for sink in self.packet_sinks:
+                sink(packet)
+
+            if (self.packet_decoder != None):
+                output.append(self.packet_decoder.render(packet))
+            elif (self.dump_formatter != None): # Dump each packet from 0
+                self.dump_formatter.offset = 0
+                output.append(self.dump_formatter.render(packet))
+            else:
+                output.append(self.render(packet, True) + "\n")
+
+        if (self.line_filter != None):
+            return self.line_filter.apply("".join(output))
+
+        return "".join(output)
+
+    def record(self, chunk: bytes):
+        """
+        Pass a received chunk to the capture and chunk sinks. Done as soon as
+        the chunk is read so nothing is missed if the display falls behind.
+
+        ### Params:
+        chunk : bytes
+            The received bytes, may be a memoryview of a buffer that is 
+            reused once this returns so sinks must copy what they keep
+        """
+        if (self.capture != None):
+            self.capture.write(chunk)
+
+        for sink in self.chunk_sinks:
+            sink(chunk)
+
+    def present(self, chunk: bytes) -> str:
+        """
+        Frame and render a received chunk
+
+        ### Params:
+        chunk : bytes
+            The received bytes, may be a memoryview of a reused buffer
+
+        ### Returns:
+        out : str
+            The text to write to the terminal
+        """
+        if (self.framer == None):
+            return self.render(chunk)
+
+        return self.render_packets(chunk)
+
+    def process(self, chunk: bytes) -> str:
+        """
+        Run a received chunk through the pipeline
+
+        ### Params:
+        chunk : bytes
+            The received bytes
+
+        ### Returns:
+        out : str
+            The text to write to the terminal
+        """
+        self.record(chunk)
+        return self.present(chunk)
+
 
 class ComRxThread(threading.Thread):
     """
     A thread to receive values from the serial port and print them to the
-    terminal.
+    terminal. The thread only drains the port into a ring buffer (recording
+    each chunk on the way), a second thread renders from the ring so a slow
+    terminal does not stop the port being read. Both sides work in buffers
+    allocated once, where the port has a file descriptor it is read straight
+    into the read buffer and views of it are passed on rather than copies.
     """
-    def __init__(self, serial_port: serial.Serial, display: bool = False):
+    def __init__(self, serial_port: serial.Serial,
+        pipeline: RxPipeline = None, chunk_size: int = 4096,
+        output: MergedOutput = None, ring_size: int = 1024 * 1024,
+        overflow: str = "block", frame_interval: float = 0.016,
+        frame_size: int = 65536, skip_over: int = 0, metrics: Metrics = None):
         """
         Initialise the thread to receive value from the serial port and print
         it to the terminal
@@ -25,20 +203,49 @@ class ComRxThread(threading.Thread):
         ### Params:
         serial_port : serial.Serial
             The serial port to read from
-        display : bool = False
-            Weather to display non printable characters
+        pipeline : RxPipeline = None
+            The processing to apply to received data, None prints it as is
+        chunk_size : int = 4096
+            The largest number of bytes to take from the port in one read
+        output : MergedOutput = None
+            The output to write to, by default the terminal
+        ring_size : int = 1024 * 1024
+            The size of the ring buffer between reading and rendering
+        overflow : str = "block"
+            What to do when the ring is full (block, drop-oldest or coalesce)
+        frame_interval : float = 0.016
+            The shortest time between writes to the terminal while data is 
+            streaming, data after a quiet spell is written straight away
+        frame_size : int = 65536
+            The amount of text that is written without waiting for the frame
+            interval
+        skip_over : int = 0
+            When more than this many bytes are waiting to be displayed all 
+            but the newest frame_size are skipped and summarised, 0 never 
+            skips
+        metrics : Metrics = None
+            The metrics to count reads and render times in
         """
         super().__init__(group=None, name="com_rx_thread")
-        
-        printable_chars = string.printable
-        self.printable_char_bytes = bytes(printable_chars, 'ascii')
 
         self.serial_port = serial_port
-        self.display = display
+        self.pipeline = pipeline if pipeline != None else RxPipeline()
+        self.chunk_size = chunk_size
+        self.output = output if output != None else MergedOutput(["rx"])
+        self.ring = RingBuffer(ring_size, overflow)
+        self.frame_size = frame_size
+        self.pacer = FramePacer(self.output, frame_interval, frame_size,
+            skip_over)
+        self.metrics = metrics
+
+        self.read_buffer = memoryview(bytearray(chunk_size))
+        self.render_buffer = memoryview(bytearray(frame_size))
+        self._poller = None
+        self._fd = None
 
         self._stopper = threading.Event()
         self._stopper.clear()
-    
+
     def stop(self):
         """
         Stop the thread
@@ -51,27 +258,144 @@ class ComRxThread(threading.Thread):
         """
         return self._stopper.is_set()
 
+    def open_fd(self) -> int:
+        """
+        Get the file descriptor to read the port through, once per connection
+
+        ### Returns:
+        out : int
+            The descriptor or None if the port does not have one (e.g. 
+            loop://, replays or Windows) and has to be read through pyserial
+        """
+        self._poller = None
+        try:
+            fd = self.serial_port.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation,
+            serial.SerialException):
+            return None
+
+        self._poller = select.poll()
+        self._poller.register(fd, select.POLLIN)
+        self._fd = fd
+
+        return fd
+
+    def read_chunk(self) -> memoryview:
+        """
+        Read everything currently waiting on the serial port (up to the chunk
+        size), waiting up to the port timeout if nothing is. Ports with a file
+        descriptor are read directly into the read buffer.
+
+        ### Returns:
+        out : memoryview
+            The bytes read, only valid until the next read. Empty if the read
+            timed out
+        """
+        if (self._poller == None):
+            return memoryview(self.read_port())
+
+        timeout = self.serial_port.timeout
+        if (not self._poller.poll(None if timeout == None else timeout * 1000)):
+            return self.read_buffer[:0]
+
+        try:
+            length = os.readv(self._fd, [self.read_buffer])
+        except BlockingIOError:
+            return self.read_buffer[:0]
+
+        if (length == 0): # Readable with no data means disconnected
+            raise serial.SerialException("device disconnected")
+
+        return self.read_buffer[:length]
+
+    def read_port(self) -> bytes:
+        """
+        Read through pyserial. If nothing is waiting block for a single byte
+        (up to the port timeout) and then collect anything that arrived with
+        it.
+
+        ### Returns:
+        out : bytes
+            The bytes read, empty if the read timed out
+        """
+        waiting = self.serial_port.in_waiting
+        if (waiting == 0):
+            first = self.serial_port.read(1)
+            if (first == b''):
+                return first
+
+            waiting = self.serial_port.in_waiting
+            if (waiting == 0):
+                return first
+
+            return first + self.serial_port.read(min(waiting,
+                self.chunk_size - 1))
+
+        return self.serial_port.read(min(waiting, self.chunk_size))
+
     def run(self):
         """
         Run the com receive thread
         """
+        renderer = threading.Thread(target=self.render_loop,
+            name="com_render_thread")
+        renderer.start()
+
+        self.open_fd()
         while (not self.stopped()):
             try:
-                com_rx = self.serial_port.read(1)
-            except serial.SerialException:
+                com_rx = self.read_chunk()
+            except (serial.SerialException, OSError): # in_waiting raises OSError
                 utils.close_com_threads()
                 continue
 
-            if (com_rx == b''): # if empty don't print
+            if (not com_rx): # if empty don't print
                 continue
 
-            if (self.display):
-                if (com_rx in self.printable_char_bytes):
-                    print(com_rx.decode(), end="")
-                else:
-                    print(com_rx, end="")
-            else:
-                print(com_rx.decode(), end="")
+            if (self.metrics != None):
+                self.metrics.count_rx(len(com_rx))
+
+            self.pipeline.record(com_rx)
+            self.ring.put(com_rx)
+
+        self.ring.close()
+        renderer.join()
+
+        if (self.ring.dropped or self.pacer.skipped):
+            self.output.write(0, f"\r\n{utils.get_time_str()} Dropped " \
+                f"{self.ring.dropped} bytes in {self.ring.overruns} " \
+                f"overruns, skipped {self.pacer.skipped} bytes\r\n")
+            self.output.flush()
+
+    def render_loop(self):
+        """
+        Render received data from the ring until it is closed. Output is 
+        written in frames by the pacer, at most one per frame interval while
+        data is streaming.
+        """
+        pacer = self.pacer
+
+        while (True):
+            item = self.ring.get_into(self.render_buffer, pacer.wait_time(0.5))
+            if (item == None):
+                break
+
+            length, dropped = item
+            data = self.render_buffer[:length]
+            if (dropped):
+                self.output.write(0, f"\r\n... {dropped} bytes dropped ...\r\n")
+
+            if (data and self.metrics != None):
+                start = time.perf_counter()
+                self.output.write(0, self.pipeline.present(data))
+                self.metrics.render_seconds.observe(time.perf_counter() - start)
+            elif (data):
+                self.output.write(0, self.pipeline.present(data))
+
+            # Summarise rather than fall further behind
+            if (pacer.behind(self.ring.waiting())):
+                pacer.report_skip(0, self.ring.skip(self.frame_size))
+
+            pacer.frame()
 
-            sys.stdout.flush()
-        
+        self.output.flush()
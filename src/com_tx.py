@@ -4,89 +4,162 @@
 # @date 2024-06-30
 # @brief The file contains the functionality to send over the serial port.
 
-import string
+import re
 import serial
 import os
 import sys
 import threading
 import utils
-import time
 
 from keyboard_hit import KBHit
+from capture import CaptureWriter, TX
+from metrics import Metrics
 
-# Possible escape characters
-escape_chars = ['n', 'r', 't', 'b', 'f', 'o', 'x', '\\']
+# Simple single char escape sequences
+SIMPLE_ESCAPES = {'n': b"\n", 'r': b"\r", 't': b"\t", 'b': b"\b", 'f': b"\f",
+    '0': b"\x00", '\\': b"\\"}
 
-def convert_to_bytes(input_str: string) -> bytearray:
+# An escape sequence optionally followed by a repeat count e.g. \x00{16}. The
+# last group catches anything that is not a valid escape.
+ESCAPE_RE = re.compile(r"\\(?:([nrtbf0\\])|x([0-9a-fA-F]{2})|o([0-7]{3})"
+    r"|u([0-9a-fA-F]{4})|(.?))(?:\{(\d+)\})?", re.DOTALL)
+
+# The largest repeat count accepted
+MAX_REPEAT = 65536
+
+# The bytes for each escape sequence already seen, without any repeat count
+# so the cached values stay a few bytes long
+_escape_cache = {}
+
+
+class EscapeError(ValueError):
+    """
+    Raised when a string contains a bad escape sequence
+    """
+    def __init__(self, input_str: str, column: int, line: int = None):
+        """
+        ### Params:
+        input_str : str
+            The string being converted
+        column : int
+            The index of the bad escape sequence in the string
+        line : int = None
+            The line number when converting several lines
+        """
+        self.input_str = input_str
+        self.column = column
+        self.line = line
+
+        location = f"column {column + 1}"
+        if (line != None):
+            location = f"line {line}, " + location
+
+        super().__init__(f"bad escape sequence at {location}: " \
+            f"{input_str[column:column + 8]!r}")
+
+
+def convert_to_bytes(input_str: str) -> bytearray:
     """
     convert the provided string into a byte array without escaping \\. This
-    allows the sending of non printable chars to the device. 
+    allows the sending of non printable chars to the device. Supported 
+    escapes are \\n, \\r, \\t, \\b, \\f, \\0, \\\\, \\xHH, \\oOOO and \\uHHHH
+    (sent as utf-8), any of which can be followed by {N} to repeat it N times.
+    Text between escapes is encoded as utf-8 in one go.
 
     ### Params:
-    input_str : string
+    input_str : str
         the input string to convert
 
     ### Return:
      : bytearray
         The converted string
+
+    ### Raises:
+    EscapeError
+        If the string contains a bad escape sequence
     """
-    def print_error():
-        print("error: bad escape sequence line not sent")
-        return bytearray(b'')
+    if ('\\' not in input_str):
+        return bytearray(input_str.encode())
+
+    output_bytes = bytearray()
+    last = 0
+
+    for match in ESCAPE_RE.finditer(input_str):
+        output_bytes += input_str[last:match.start()].encode()
+        last = match.end()
+
+        simple, hex_value, octal, unicode, bad, repeat = match.groups()
+
+        escape = match.group(0)
+        if (repeat != None):
+            escape = input_str[match.start():match.start(6) - 1]
+
+        value = _escape_cache.get(escape)
+        if (value == None):
+            if (simple != None):
+                value = SIMPLE_ESCAPES[simple]
+            elif (hex_value != None):
+                value = bytes((int(hex_value, 16),))
+            elif (octal != None and int(octal, 8) < 256):
+                value = bytes((int(octal, 8),))
+            elif (unicode != None):
+                value = chr(int(unicode, 16)).encode('utf-8', 'surrogatepass')
+            else:
+                raise EscapeError(input_str, match.start())
 
-    output_bytes = bytearray(b'')
+            if (len(_escape_cache) < 4096):
+                _escape_cache[escape] = value
 
-    char_num = 0
+        if (repeat != None):
+            if (int(repeat) > MAX_REPEAT):
+                raise EscapeError(input_str, match.start())
+            value *= int(repeat)
 
-    while (char_num < len(input_str)):
-        # escape sequences
-        if (input_str[char_num] == '\\' 
-            and char_num < (len(input_str) - 1)): 
-            
-            if (input_str[char_num+1] == 'n'):
-                    output_bytes.append(10)
-            elif (input_str[char_num+1] == 'r'):
-                    output_bytes.append(13)
-            elif (input_str[char_num+1] == 't'):
-                    output_bytes.append(9)
-            elif (input_str[char_num+1] == 'b'):
-                    output_bytes.append(8)
-            elif (input_str[char_num+1] == 'f'):
-                    output_bytes.append(12)
-            elif (input_str[char_num+1] == '\\'):
-                    output_bytes.append(92)
-            elif (input_str[char_num+1] =='x'
-                  and char_num < len(input_str) - 3):
-                    output_bytes.append(int(input_str[char_num+2:char_num+4], 
-                        16))
-                    char_num += 2
-            elif (input_str[char_num+1] == 'o' 
-                and char_num < len(input_str) - 4):
-                    output_bytes.append(int(input_str[char_num+2:char_num+5], 
-                        8))
-                    char_num += 3
-            else:
-                    print_error()
-                
-            char_num += 1
-
-        elif (input_str[char_num] == '\\'
-            and not char_num < (len(input_str) - 1)):
-            print_error()
-        else:
-            output_bytes.append(int.from_bytes(
-                input_str[char_num].encode(), "big"))
-        
-        char_num += 1
+        output_bytes += value
+
+    output_bytes += input_str[last:].encode()
 
     return output_bytes
 
 
+def convert_lines(lines, line_end: bytes = b"\r") -> list:
+    """
+    Convert several lines (e.g. a command file) into the bytes to send for
+    each line
+
+    ### Params:
+    lines : iterable
+        The lines to convert, any trailing new line is removed
+    line_end : bytes = b"\\r"
+        The bytes added to the end of each converted line
+
+    ### Return:
+    out : list
+        The bytearray for each line
+
+    ### Raises:
+    EscapeError
+        If a line contains a bad escape sequence, line is set to its number
+    """
+    output = []
+    for number, line in enumerate(lines, 1):
+        try:
+            converted = convert_to_bytes(line.rstrip("\r\n"))
+        except EscapeError as e:
+            raise EscapeError(e.input_str, e.column, number) from None
+
+        converted += line_end
+        output.append(converted)
+
+    return output
+
+
 class ComTxThread(threading.Thread):
     """
     A thread to send values to the serial port from the terminal.
     """
-    def __init__(self, serial_port: serial.Serial, mode: str = "local"):
+    def __init__(self, serial_port: serial.Serial, mode: str = "local",
+        capture: CaptureWriter = None, sender=None, metrics: Metrics = None):
         """
         Initialise the thread to send values to the terminal from the 
         terminal.
@@ -96,15 +169,34 @@ class ComTxThread(threading.Thread):
             The serial port to send to
         mode : str = "local"
             The mode to use for the terminal (dumb or local)
+        capture : CaptureWriter = None
+            The capture to record sent data in
+        sender : BulkSender = None
+            Runs file sends and in session commands (::send, ::script)
+        metrics : Metrics = None
+            The metrics to count sent data in
         """
         super().__init__(group=None, name="com_tx_thread")
 
         self.serial_port = serial_port
         self.mode = mode
+        self.capture = capture
+        self.metrics = metrics
+
+        self.sender = sender
+        if (sender != None):
+            sender.stopped = self.stopped
 
         self._stopper = threading.Event()
         self._stopper.clear()
 
+        # Pipe written to on stop to wake the thread from waiting on stdin
+        self._wake_lock = threading.Lock()
+        self._wake_r = None
+        self._wake_w = None
+        if (os.name != 'nt'):
+            self._wake_r, self._wake_w = os.pipe()
+
         self.kb = KBHit()
     
     def stop(self):
@@ -113,12 +205,58 @@ class ComTxThread(threading.Thread):
         """
         self._stopper.set()
 
+        with self._wake_lock:
+            if (self._wake_w != None):
+                os.write(self._wake_w, b"\x00")
+
+    def close_wake_pipe(self):
+        """
+        Close the stop wake up pipe once the thread has finished
+        """
+        with self._wake_lock:
+            if (self._wake_w != None):
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+                self._wake_r = None
+                self._wake_w = None
+
     def stopped(self):
         """
         Check if the thread has been stopped
         """
         return self._stopper.is_set()
     
+    def send(self, data: bytes):
+        """
+        Send data to the serial port and record it in the capture
+
+        ### Params:
+        data : bytes
+            The data to send
+        """
+        self.serial_port.write(data)
+
+        if (self.capture != None):
+            self.capture.write(data, TX)
+
+        if (self.metrics != None):
+            self.metrics.count_tx(len(data))
+
+    def wait_for_key(self) -> bool:
+        """
+        Block until a key is pressed or the thread is stopped. Without a wake
+        up pipe (Windows) this returns periodically so the stop flag is still
+        checked.
+
+        ### Return:
+        out : bool
+            True if a key is waiting to be read
+        """
+        if (self._wake_r == None):
+            return self.kb.wait(0.1)
+
+        return self.kb.wait(None, self._wake_r)
+
     def get_char_if_available(self) -> str:
         """
         Get a char from stdin using the non blocking KBhit
@@ -141,7 +279,7 @@ class ComTxThread(threading.Thread):
             print()
             self.kb.set_normal_term()
             utils.close_com_threads()
-            os._exit(0)
+            utils.exit_app(0)
         
         return char
     
@@ -155,7 +293,8 @@ class ComTxThread(threading.Thread):
         """
         read_string = ""
         while (not self.stopped()):
-            time.sleep(0.01)
+            if (not self.wait_for_key()):
+                continue
 
             char = self.get_char_if_available()
 
@@ -177,27 +316,38 @@ class ComTxThread(threading.Thread):
         """
         Run the sending thread
         """
-        if (self.mode == "dumb"):
-            self.run_dumb()
-        elif (self.mode == "local"):
-            self.run_local()
+        try:
+            if (self.sender != None):
+                self.sender.run_pending()
+
+            if (self.mode == "dumb"):
+                self.run_dumb()
+            elif (self.mode == "local"):
+                self.run_local()
+        finally:
+            self.close_wake_pipe()
 
     def run_dumb(self):
         """
         Dumb terminal serial transmit thread entry. This thread takes user input
-        and then sends it to the device one char at a time.
+        and then sends it to the device one char at a time. Sending stops if
+        stdin is closed and receiving carries on.
         """
         while (not self.stopped()):
-            time.sleep(0.01)
+            if (not self.wait_for_key()):
+                continue
 
-            char = self.get_char_if_available()
+            try:
+                char = self.get_char_if_available()
+            except EOFError:
+                return
             
             if (char == None):
                  continue
             
             # Send
             try: # Cannot use .is_open() as it is to slow
-                self.serial_port.write(char.encode())
+                self.send(char.encode())
             except serial.SerialException:
                 self.kb.set_normal_term()
                 utils.close_com_threads()
@@ -212,22 +362,28 @@ class ComTxThread(threading.Thread):
         """
         try:
             while (not self.stopped()):
-                time.sleep(0.01)
-
                 str_to_send = self.input_non_blocking()
 
                 if (str_to_send == None):
                     continue
 
-                output_bytes = convert_to_bytes(str_to_send)
+                if (self.sender != None 
+                    and self.sender.run_command(str_to_send.strip())):
+                    continue
+
+                try:
+                    output_bytes = convert_to_bytes(str_to_send)
+                except EscapeError as e:
+                    print(f"error: {e}, line not sent")
+                    continue
                 output_bytes.append(13) # \n
 
                 try: # Cannot use .is_open() as it is to slow
-                    self.serial_port.write(output_bytes)
+                    self.send(output_bytes)
                 except serial.SerialException:
                     self.kb.set_normal_term()
                     utils.close_com_threads()
 
         except EOFError:
-            os._exit(0)
+            utils.exit_app(0)
 
@@ -43,6 +43,30 @@ class Config(object):
         result = [Config.__load__(item) for item in data]
         return result
 
+    @staticmethod
+    def merge(base: dict, overrides: dict) -> ConfigDict:
+        """
+        Merge settings over a base, nested sections are merged key by key so
+        anything missing from overrides keeps its base value
+
+        ### Params:
+        base : dict
+            The base settings
+        overrides : dict
+            The settings that take precedence
+
+        ### Returns:
+        out : ConfigDict
+            The merged settings
+        """
+        result = Config.load_dict(base)
+        for key, value in overrides.items():
+            if (isinstance(value, dict) and isinstance(result.get(key), dict)):
+                result[key] = Config.merge(result[key], value)
+            else:
+                result[key] = Config.__load__(value)
+        return result
+
     @staticmethod
     def load_json(path: str) -> Union[ConfigDict, list]:
         with open(path, "r") as f:
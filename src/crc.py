@@ -0,0 +1,87 @@
+##
+# @file crc.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-24
+# @brief Table driven CRC16 as used by Modbus RTU (reflected polynomial 0xA001,
+# initial value 0xFFFF)
+
+import struct
+
+MODBUS_POLY = 0xA001
+
+def _build_crc16_table(poly: int) -> list:
+    """
+    Build the table giving the CRC of each byte value for a reflected CRC16
+
+    ### Params:
+    poly : int
+        The reflected polynomial
+
+    ### Returns:
+    out : list
+        The table indexed by byte value
+    """
+    table = []
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            crc = (crc >> 1) ^ poly if (crc & 1) else crc >> 1
+        table.append(crc)
+
+    return table
+
+CRC16_TABLE = _build_crc16_table(MODBUS_POLY)
+
+# Two bytes at a time. Once a little endian word is xored into a reflected
+# CRC16 the next two steps only depend on the result, so the whole CRC can
+# be looked up in one go halving the work done per byte. The table is a few
+# MB so it is only built the first time a CRC is calculated.
+_word_table = None
+
+
+def _build_word_table() -> list:
+    """
+    Build the table giving the CRC16 step for each little endian word
+
+    ### Returns:
+    out : list
+        The table indexed by the CRC xored with the word
+    """
+    global _word_table
+    _word_table = [CRC16_TABLE[CRC16_TABLE[value & 0xFF] & 0xFF ^ value >> 8]
+        ^ CRC16_TABLE[value & 0xFF] >> 8 for value in range(65536)]
+
+    return _word_table
+
+# The unpackers for each length of a Modbus frame (up to 256 bytes)
+_word_structs = [struct.Struct(f"<{words}H").unpack_from 
+    for words in range(129)]
+
+
+def crc16_modbus(data: bytes) -> int:
+    """
+    Calculate the Modbus CRC16 of some bytes
+
+    ### Params:
+    data : bytes
+        The bytes to check
+
+    ### Returns:
+    out : int
+        The CRC, sent low byte first at the end of a Modbus RTU frame
+    """
+    words = len(data) // 2
+    if (words < len(_word_structs)):
+        unpack = _word_structs[words]
+    else:
+        unpack = struct.Struct(f"<{words}H").unpack_from
+
+    crc = 0xFFFF
+    table = _word_table if _word_table != None else _build_word_table()
+    for word in unpack(data):
+        crc = table[crc ^ word]
+
+    if (len(data) & 1):
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ data[-1]) & 0xFF]
+
+    return crc
@@ -0,0 +1,330 @@
+##
+# @file decoders.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-24
+# @brief Decoder plugins that turn framed packets into structured records,
+# Modbus RTU and struct layouts from the settings are built in and others can
+# be loaded from a module
+
+import importlib
+import struct
+
+from configuration import ConfigDict
+from crc import crc16_modbus
+from framing import MODBUS_FUNCTIONS
+
+# The Modbus exception codes mapped to their names
+MODBUS_EXCEPTIONS = {1: "illegal_function", 2: "illegal_data_address",
+    3: "illegal_data_value", 4: "server_device_failure", 5: "acknowledge",
+    6: "server_device_busy", 8: "memory_parity_error",
+    10: "gateway_path_unavailable", 11: "gateway_target_failed"}
+
+# Register unpackers for each count up to the 125 a frame can hold
+_register_structs = [struct.Struct(f">{count}H").unpack_from
+    for count in range(126)]
+
+
+class Decoder:
+    """
+    The base decoder plugin. A decoder turns each framed packet into records
+    (dictionaries of field name -> value) which are printed one per line.
+    Plugins subclass this, implement decode and are selected with
+    --decoder module:Class.
+    """
+    # The name printed with errors
+    name = "decoder"
+
+    # The framing used when none is selected, None if one must be given
+    framing = None
+
+    def __init__(self, config: ConfigDict = None):
+        """
+        Initialise the decoder
+
+        ### Params:
+        config : ConfigDict = None
+            The decoder section of the configuration
+        """
+        self.config = config if config != None else ConfigDict()
+        self.records = 0
+        self.errors = 0
+
+    def decode(self, packet: bytes) -> list:
+        """
+        Decode a packet
+
+        ### Params:
+        packet : bytes
+            The framed packet
+
+        ### Returns:
+        out : list
+            The records found in the packet
+
+        ### Raises:
+        ValueError
+            If the packet cannot be decoded
+        """
+        raise NotImplementedError
+
+    def format(self, record: dict) -> str:
+        """
+        Format a record as a line of text
+
+        ### Params:
+        record : dict
+            The record
+
+        ### Returns:
+        out : str
+            The line, without a new line
+        """
+        return " ".join(f"{key}={value}" for key, value in record.items())
+
+    def render(self, packet: bytes) -> str:
+        """
+        Decode a packet into the lines to print, packets that fail to decode
+        are shown as hex with the reason
+
+        ### Params:
+        packet : bytes
+            The framed packet
+
+        ### Returns:
+        out : str
+            The lines to print, each ending in a new line
+        """
+        try:
+            records = self.decode(packet)
+        except ValueError as e:
+            self.errors += 1
+            return f"{self.name} error: {e}: {bytes(packet).hex(' ')}\n"
+
+        self.records += len(records)
+        return "".join([self.format(record) + "\n" for record in records])
+
+
+class ModbusRtuDecoder(Decoder):
+    """
+    Decodes Modbus RTU frames, requests and responses. Read and write
+    multiple requests and their responses are told apart by their length.
+    """
+    name = "modbus"
+    framing = "modbus"
+
+    def decode(self, packet: bytes) -> list:
+        if (len(packet) < 4):
+            raise ValueError("frame too short")
+        if (crc16_modbus(packet) != 0):
+            raise ValueError("bad CRC")
+
+        function = packet[1]
+        data = packet[2:-2]
+        record = {"address": packet[0],
+            "function": MODBUS_FUNCTIONS.get(function & 0x7F, function)}
+
+        if (function & 0x80):
+            if (not data):
+                raise ValueError("missing exception code")
+            record["exception"] = MODBUS_EXCEPTIONS.get(data[0], data[0])
+        elif (function in (1, 2, 3, 4)):
+            # Register responses have an odd length so a request starting at
+            # 0x03XX is not mistaken for one by its byte count
+            response = len(data) > 0 and data[0] == len(data) - 1
+            if (function in (3, 4)):
+                response = response and len(data) & 1 == 1
+
+            if (response):
+                if (function in (1, 2)):
+                    record["bits"] = unpack_bits(data[1:], len(data[1:]) * 8)
+                else:
+                    record["registers"] = list(unpack_registers(data[1:]))
+            elif (len(data) == 4):
+                record["start"], record["count"] = struct.unpack(">HH", data)
+            else:
+                raise ValueError("bad read length")
+        elif (function in (5, 6) and len(data) == 4):
+            record["start"], record["value"] = struct.unpack(">HH", data)
+        elif (function in (15, 16) and len(data) >= 4):
+            record["start"], record["count"] = struct.unpack_from(">HH", data)
+            if (len(data) > 4): # Request
+                if (data[4] != len(data) - 5):
+                    raise ValueError("bad byte count")
+                if (function == 15):
+                    record["bits"] = unpack_bits(data[5:], record["count"])
+                else:
+                    record["registers"] = list(unpack_registers(data[5:]))
+        else:
+            record["data"] = bytes(data).hex(" ")
+
+        return [record]
+
+
+def unpack_registers(data: bytes) -> tuple:
+    """
+    Unpack big endian 16 bit registers all at once
+
+    ### Params:
+    data : bytes
+        The register bytes
+
+    ### Returns:
+    out : tuple
+        The register values
+    """
+    if (len(data) & 1):
+        raise ValueError("odd register byte count")
+
+    count = len(data) // 2
+    if (count < len(_register_structs)):
+        return _register_structs[count](data)
+
+    return struct.unpack(f">{count}H", data)
+
+
+def unpack_bits(data: bytes, count: int) -> str:
+    """
+    Unpack coils or inputs packed least significant bit first
+
+    ### Params:
+    data : bytes
+        The packed bits
+    count : int
+        The number of bits to unpack
+
+    ### Returns:
+    out : str
+        The bits as 0s and 1s, the first coil first
+    """
+    # Reversing the bit string of the whole field puts the first bit first
+    value = int.from_bytes(data, "little")
+    return f"{value:0{len(data) * 8}b}"[::-1][:count]
+
+
+class StructDecoder(Decoder):
+    """
+    Decodes packets made of one or more fixed size records described by a
+    struct layout in the settings, e.g.
+    {"format": "<BhhH", "fields": ["id", "x", "y", "status"]}.
+    All the records in a packet are unpacked together with iter_unpack.
+    """
+    name = "struct"
+
+    def __init__(self, config: ConfigDict = None):
+        """
+        Initialise the decoder from the selected layout
+
+        ### Params:
+        config : ConfigDict = None
+            The decoder section of the configuration, layout names one of
+            the layouts
+
+        ### Raises:
+        ValueError
+            If the layout is missing or not valid
+        """
+        super().__init__(config)
+
+        layouts = self.config.get("layouts") or {}
+        layout = layouts.get(self.config.get("layout"))
+        if (layout == None):
+            raise ValueError(f"no layout {self.config.get('layout')}, the " \
+                f"layouts are {', '.join(layouts) or 'not set'}")
+
+        try:
+            self.struct = struct.Struct(layout["format"])
+        except (KeyError, struct.error) as e:
+            raise ValueError(f"bad layout format: {e}")
+
+        self.fields = list(layout.get("fields") or [])
+        width = len(self.struct.unpack(bytes(self.struct.size)))
+        if (len(self.fields) != width):
+            raise ValueError(f"the layout has {len(self.fields)} fields for " \
+                f"{width} values")
+
+        self.name = self.config.get("layout")
+        self._line = " ".join([self.name] + [f"{field}={{}}"
+            for field in self.fields]) + "\n"
+
+    def decode(self, packet: bytes) -> list:
+        return [dict(zip(self.fields, values))
+            for values in self._unpack(packet)]
+
+    def _unpack(self, packet: bytes):
+        """
+        Unpack the records in a packet
+
+        ### Params:
+        packet : bytes
+            The framed packet
+
+        ### Returns:
+        out : iterator
+            The values of each record
+        """
+        if (not packet or len(packet) % self.struct.size):
+            raise ValueError(f"{len(packet)} bytes is not a whole number " \
+                f"of {self.struct.size} byte records")
+
+        return self.struct.iter_unpack(packet)
+
+    def format(self, record: dict) -> str:
+        return self._line[:-1].format(*record.values())
+
+    def render(self, packet: bytes) -> str:
+        # Formatted straight from the unpacked values, skipping the records
+        try:
+            rows = self._unpack(packet)
+        except ValueError as e:
+            self.errors += 1
+            return f"{self.name} error: {e}: {bytes(packet).hex(' ')}\n"
+
+        line = self._line.format
+        lines = [line(*values) for values in rows]
+        self.records += len(lines)
+
+        return "".join(lines)
+
+
+# The built in decoders
+DECODERS = {"modbus": ModbusRtuDecoder, "struct": StructDecoder}
+
+
+def make_decoder(config: ConfigDict) -> Decoder:
+    """
+    Create the decoder selected in the configuration
+
+    ### Params:
+    config : ConfigDict
+        The decoder section of the configuration, type is "none", one of
+        DECODERS or module:Class for a plugin
+
+    ### Returns:
+    out : Decoder
+        The decoder or None if the type is "none"
+
+    ### Raises:
+    ValueError
+        If the decoder cannot be created
+    """
+    if (config.type == "none"):
+        return None
+
+    decoder_class = DECODERS.get(config.type)
+    if (decoder_class == None):
+        module_name, _, class_name = config.type.partition(":")
+        if (not class_name):
+            raise ValueError(f"unknown decoder {config.type}, use one of " \
+                f"{', '.join(DECODERS)} or module:Class")
+
+        try:
+            decoder_class = getattr(importlib.import_module(module_name),
+                class_name)
+        except (ImportError, AttributeError) as e:
+            raise ValueError(f"cannot load {config.type}: {e}")
+
+        if (not isinstance(decoder_class, type) 
+            or not issubclass(decoder_class, Decoder)):
+            raise ValueError(f"{config.type} is not a Decoder")
+
+    return decoder_class(config)
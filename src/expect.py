@@ -0,0 +1,383 @@
+##
+# @file expect.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-06
+# @brief Expect style automation on top of the receive pipeline. Commands are
+# sent and the received data is matched against regular expressions, either
+# from a script file given on the command line or from Python.
+#
+# Library use:
+#   device = open_expecter("/dev/ttyUSB0", 115200)
+#   device.send("version\r")
+#   match = device.expect(rb"v(\d+)\.(\d+)", timeout=2)
+#   device.close()
+
+import os
+import re
+import sys
+import threading
+import time
+import serial
+
+from com_rx import ComRxThread, RxPipeline
+from com_tx import convert_to_bytes, EscapeError
+from capture import CaptureWriter, TX
+from merged_output import MergedOutput
+from metrics import Metrics
+import utils
+
+
+class ExpectTimeout(TimeoutError):
+    """
+    Raised when none of the expected patterns are received in time
+    """
+    def __init__(self, patterns: list, timeout: float, tail: bytes):
+        """
+        ### Params:
+        patterns : list
+            The patterns that were expected
+        timeout : float
+            The seconds waited
+        tail : bytes
+            The end of the unmatched data
+        """
+        self.patterns = patterns
+        self.timeout = timeout
+        self.tail = tail
+
+        super().__init__(f"timed out after {timeout} s waiting for " \
+            f"{' or '.join(repr(p.pattern) for p in patterns)}, " \
+            f"last received {tail!r}")
+
+
+class Expecter:
+    """
+    Matches received data against regular expressions. Data is fed in from
+    the receive pipeline into a bounded rolling buffer. Each wait only scans
+    the newly received bytes (plus max_match bytes of overlap for matches
+    that span chunks) so matching keeps up on chatty devices however long
+    the wait. A match consumes the buffer up to its end, anything before it
+    is kept in before.
+    """
+    def __init__(self, serial_port: serial.Serial = None,
+        capture: CaptureWriter = None, timeout: float = 10,
+        buffer_size: int = 65536, max_match: int = 4096,
+        metrics: Metrics = None):
+        """
+        Initialise the expecter
+
+        ### Params:
+        serial_port : serial.Serial = None
+            The port to send to, can be changed on a reconnect
+        capture : CaptureWriter = None
+            The capture to record sent data in
+        timeout : float = 10
+            The default seconds to wait for a pattern
+        buffer_size : int = 65536
+            The number of unmatched bytes kept, older data is dropped
+        max_match : int = 4096
+            The longest match guaranteed to be found across chunk boundaries
+        metrics : Metrics = None
+            The metrics to count sent data in
+        """
+        self.serial_port = serial_port
+        self.capture = capture
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.max_match = max_match
+        self.metrics = metrics
+
+        self.before = b""
+        self.match = None
+
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._received = threading.Condition()
+        self._rx_thread = None
+        self._null_stream = None
+
+    def feed(self, chunk: bytes):
+        """
+        Add received data to the buffer, called by the receive pipeline
+
+        ### Params:
+        chunk : bytes
+            The received bytes
+        """
+        with self._received:
+            self._buffer += chunk
+
+            # Trim in large steps so the cost is spread over many chunks
+            if (len(self._buffer) > 2 * self.buffer_size):
+                drop = len(self._buffer) - self.buffer_size
+                del self._buffer[:drop]
+                self._scanned = max(self._scanned - drop, 0)
+
+            self._received.notify()
+
+    def send(self, data):
+        """
+        Send to the port. Strings are converted with the escape encoder used
+        in local mode, e.g. "reset\\r".
+
+        ### Params:
+        data : str | bytes
+            The data to send
+
+        ### Raises:
+        EscapeError
+            If a string has a bad escape sequence
+        """
+        if (isinstance(data, str)):
+            data = convert_to_bytes(data)
+
+        self.serial_port.write(data)
+
+        if (self.capture != None):
+            self.capture.write(data, TX)
+
+        if (self.metrics != None):
+            self.metrics.count_tx(len(data))
+
+    def _search(self, patterns: list) -> tuple:
+        """
+        Search the unscanned end of the buffer for the earliest match of any
+        of the patterns. Must be called with the buffer locked.
+
+        ### Returns:
+        out : tuple
+            The pattern index and match or None
+        """
+        start = max(self._scanned - self.max_match, 0)
+        window = bytes(self._buffer[start:])
+        self._scanned = len(self._buffer)
+
+        best = None
+        for index, pattern in enumerate(patterns):
+            match = pattern.search(window)
+            if (match != None and (best == None
+                or match.start() < best[1].start())):
+                best = (index, match)
+
+        if (best != None):
+            end = start + best[1].end()
+            self.before = bytes(self._buffer[:start + best[1].start()])
+            del self._buffer[:end]
+            self._scanned = 0
+
+        return best
+
+    def expect_any(self, patterns: list, timeout: float = None) -> tuple:
+        """
+        Wait for any of the patterns to be received. Data already in the
+        buffer is matched first.
+
+        ### Params:
+        patterns : list
+            Regular expressions as bytes, str (encoded as utf-8) or compiled
+        timeout : float = None
+            The seconds to wait, None uses the default timeout
+
+        ### Returns:
+        out : tuple
+            The index of the pattern that matched first and its match
+
+        ### Raises:
+        ExpectTimeout
+            If nothing matched in time
+        """
+        timeout = self.timeout if timeout == None else timeout
+        patterns = [compile_pattern(pattern) for pattern in patterns]
+        deadline = time.monotonic() + timeout
+
+        with self._received:
+            self._scanned = 0 # New patterns so check everything held
+            while (True):
+                if (self._scanned < len(self._buffer)):
+                    found = self._search(patterns)
+                    if (found != None):
+                        self.match = found[1]
+                        return found
+
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    raise ExpectTimeout(patterns, timeout,
+                        bytes(self._buffer[-64:]))
+
+                self._received.wait(remaining)
+
+    def expect(self, pattern, timeout: float = None) -> re.Match:
+        """
+        Wait for a pattern to be received
+
+        ### Params:
+        pattern : bytes | str | re.Pattern
+            The regular expression to wait for
+        timeout : float = None
+            The seconds to wait, None uses the default timeout
+
+        ### Returns:
+        out : re.Match
+            The match, against bytes
+
+        ### Raises:
+        ExpectTimeout
+            If the pattern is not received in time
+        """
+        return self.expect_any([pattern], timeout)[1]
+
+    def close(self):
+        """
+        Stop receiving and close the port when opened with open_expecter
+        """
+        if (self._rx_thread != None):
+            self._rx_thread.stop()
+            self._rx_thread.join()
+            self._rx_thread = None
+            self.serial_port.close()
+
+        if (self._null_stream != None):
+            self._null_stream.close()
+            self._null_stream = None
+
+
+def compile_pattern(pattern) -> re.Pattern:
+    """
+    Compile a pattern to match against received bytes
+
+    ### Params:
+    pattern : bytes | str | re.Pattern
+        The regular expression, a str is encoded as utf-8
+
+    ### Returns:
+    out : re.Pattern
+        The compiled bytes pattern
+    """
+    if (isinstance(pattern, re.Pattern)):
+        return pattern
+
+    if (isinstance(pattern, str)):
+        pattern = pattern.encode()
+
+    return re.compile(pattern)
+
+
+def open_expecter(port: str, baud: int = 115200, echo: bool = False,
+    timeout: float = 10, **serial_args) -> Expecter:
+    """
+    Open a serial port with a receive thread feeding an expecter, for use
+    from Python scripts
+
+    ### Params:
+    port : str
+        The serial port to open
+    baud : int = 115200
+        The baud rate
+    echo : bool = False
+        Weather to print the received data to the terminal
+    timeout : float = 10
+        The default seconds to wait for a pattern
+    **serial_args
+        Passed on to serial.Serial
+
+    ### Returns:
+    out : Expecter
+        The expecter, close it when finished
+    """
+    serial_port = serial.Serial(port, baud, timeout=0.5, **serial_args)
+    expecter = Expecter(serial_port, timeout=timeout)
+
+    stream = sys.stdout
+    if (not echo): # Closed with the expecter
+        expecter._null_stream = stream = open(os.devnull, "w")
+    pipeline = RxPipeline(display=True, chunk_sinks=[expecter.feed])
+    expecter._rx_thread = ComRxThread(serial_port, pipeline,
+        output=MergedOutput([os.path.basename(port)], stream=stream))
+    expecter._rx_thread.daemon = True
+    expecter._rx_thread.start()
+
+    return expecter
+
+
+def load_script(path: str) -> list:
+    """
+    Load an expect script. Each line is a command:
+        send TEXT       send TEXT with escapes converted (add \\r yourself)
+        expect REGEX    wait for REGEX, use | to accept several replies
+        timeout SECONDS set the wait for the following expects
+        sleep SECONDS   pause
+        exit [CODE]     exit the application
+    Blank lines and lines starting with # are ignored.
+
+    ### Params:
+    path : str
+        The script file
+
+    ### Returns:
+    out : list
+        (line number, command, argument) for each command
+
+    ### Raises:
+    ValueError
+        If a line is not a valid command, EscapeError for a bad escape
+    """
+    commands = []
+    with open(path, "r") as file:
+        for number, line in enumerate(file, 1):
+            line = line.rstrip("\r\n")
+            if (line.strip() == "" or line.lstrip().startswith("#")):
+                continue
+
+            command, _, argument = line.lstrip().partition(" ")
+
+            try:
+                if (command == "send"):
+                    argument = bytes(convert_to_bytes(argument))
+                elif (command == "expect"):
+                    argument = compile_pattern(argument)
+                elif (command in ("timeout", "sleep")):
+                    argument = float(argument)
+                elif (command == "exit"):
+                    argument = int(argument) if argument.strip() else 0
+                else:
+                    raise ValueError(f"unknown command {command!r}")
+            except EscapeError as e:
+                raise EscapeError(e.input_str, e.column, number) from None
+            except (ValueError, re.error) as e:
+                raise ValueError(f"{path} line {number}: {e}") from None
+
+            commands.append((number, command, argument))
+
+    return commands
+
+
+def run_script(expecter: Expecter, commands: list):
+    """
+    Run a loaded expect script. A timed out expect or a failed send stops the
+    script and exits the application with code 1.
+
+    ### Params:
+    expecter : Expecter
+        The expecter to run the script with
+    commands : list
+        The commands from load_script
+    """
+    for number, command, argument in commands:
+        try:
+            if (command == "send"):
+                expecter.send(argument)
+            elif (command == "expect"):
+                expecter.expect(argument)
+        except (ExpectTimeout, serial.SerialException, OSError) as e:
+            print(f"\r\n{utils.get_time_str()} Script line {number} " \
+                f"failed: {e}\r")
+            utils.exit_app(1)
+
+        if (command == "timeout"):
+            expecter.timeout = argument
+        elif (command == "sleep"):
+            time.sleep(argument)
+        elif (command == "exit"):
+            utils.exit_app(argument)
+
+    print(f"\r\n{utils.get_time_str()} Script finished\r")
@@ -0,0 +1,450 @@
+##
+# @file framing.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-04
+# @brief Splits the received byte stream into packets using an end of packet
+# identifier, length prefix headers, COBS, SLIP or Modbus RTU frame checks
+
+import re
+
+from utils import get_time_str
+from crc import crc16_modbus
+
+# The framing methods that can be selected
+FRAMING_TYPES = ["none", "delim", "length", "cobs", "slip", "modbus"]
+
+MODBUS_MAX_FRAME = 256
+MODBUS_MAX_ADDRESS = 247
+MODBUS_ANY_LENGTH = list(range(4, MODBUS_MAX_FRAME + 1))
+
+# The public Modbus function codes mapped to their names
+MODBUS_FUNCTIONS = {1: "read_coils", 2: "read_discrete_inputs",
+    3: "read_holding_registers", 4: "read_input_registers", 
+    5: "write_single_coil", 6: "write_single_register",
+    7: "read_exception_status", 8: "diagnostics", 
+    11: "get_comm_event_counter", 12: "get_comm_event_log", 
+    15: "write_multiple_coils", 16: "write_multiple_registers", 
+    17: "report_server_id", 20: "read_file_record", 21: "write_file_record",
+    22: "mask_write_register", 23: "read_write_multiple_registers",
+    24: "read_fifo_queue", 43: "encapsulated_interface"}
+
+# The request and response lengths of each function with a known frame 
+# format. Either a length or (offset, base, width) for a base length plus
+# the byte count found at offset
+MODBUS_FRAME_LENGTHS = {1: [8, (2, 5, 1)], 2: [8, (2, 5, 1)], 
+    3: [8, (2, 5, 1)], 4: [8, (2, 5, 1)], 5: [8], 6: [8], 7: [4, 5], 8: [8],
+    11: [4, 8], 12: [4, (2, 5, 1)], 15: [8, (6, 9, 1)], 16: [8, (6, 9, 1)],
+    17: [4, (2, 5, 1)], 20: [(2, 5, 1)], 21: [(2, 5, 1)], 22: [10],
+    23: [(2, 5, 1), (10, 13, 1)], 24: [6, (2, 6, 2)]}
+
+SLIP_END = 0xC0
+SLIP_ESC = 0xDB
+SLIP_ESC_END = 0xDC
+SLIP_ESC_ESC = 0xDD
+
+_slip_escape_re = re.compile(b"\xdb(.)", re.DOTALL)
+
+
+class Framer:
+    """
+    The base framer. Bytes are added to an internal buffer and complete
+    packets are returned as they are found. Everything before the search
+    position has already been looked at and is never scanned again.
+    """
+    def __init__(self, max_length: int = 65536):
+        """
+        Initialise the framer
+
+        ### Params:
+        max_length : int = 65536
+            The largest packet to buffer before it is forced out
+        """
+        self.max_length = max_length
+        self.buffer = bytearray()
+        self.errors = 0
+        self.overflows = 0
+
+        self._search = 0
+
+    def reset(self):
+        """
+        Discard any partially received packet
+        """
+        self.buffer.clear()
+        self._search = 0
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Add received bytes to the framer
+
+        ### Params:
+        chunk : bytes
+            The bytes received
+
+        ### Returns:
+        out : list
+            The complete packets found, may be empty
+        """
+        self.buffer += chunk
+        packets = []
+        start = self._extract(packets)
+
+        # Remove all the consumed bytes at once rather than per packet
+        if (start):
+            del self.buffer[:start]
+            self._search -= start
+
+        if (len(self.buffer) > self.max_length):
+            self.overflows += 1
+            packets.append(bytes(self.buffer))
+            self.reset()
+
+        return packets
+
+    def _extract(self, packets: list) -> int:
+        """
+        Find the complete packets in the buffer and add them to packets.
+        Implemented by each framing method.
+
+        ### Params:
+        packets : list
+            The list to add found packets to
+
+        ### Returns:
+        out : int
+            The number of bytes consumed from the start of the buffer
+        """
+        raise NotImplementedError
+
+
+class DelimiterFramer(Framer):
+    """
+    Splits packets on a delimiter byte or sequence of bytes. The delimiter is
+    not included in the packets.
+    """
+    def __init__(self, delimiter: bytes, max_length: int = 65536):
+        """
+        Initialise the framer
+
+        ### Params:
+        delimiter : bytes
+            The end of packet identifier
+        max_length : int = 65536
+            The largest packet to buffer before it is forced out
+        """
+        super().__init__(max_length)
+
+        if (len(delimiter) == 0):
+            raise ValueError("the end of packet identifier cannot be empty")
+
+        self.delimiter = bytes(delimiter)
+
+    def _extract(self, packets: list) -> int:
+        buffer = self.buffer
+        delimiter = self.delimiter
+        start = 0
+
+        while (True):
+            end = buffer.find(delimiter, self._search)
+            if (end == -1):
+                # A delimiter could be split across the end of the buffer
+                self._search = max(start,
+                    len(buffer) - len(delimiter) + 1)
+                return start
+
+            packets.append(bytes(buffer[start:end]))
+            start = end + len(delimiter)
+            self._search = start
+
+
+class LengthPrefixFramer(Framer):
+    """
+    Splits packets that start with an unsigned length header. The header is
+    not included in the packets.
+    """
+    def __init__(self, header_size: int = 1, byteorder: str = "big",
+        max_length: int = 65536):
+        """
+        Initialise the framer
+
+        ### Params:
+        header_size : int = 1
+            The number of bytes in the length header
+        byteorder : str = "big"
+            The byte order of the length header
+        max_length : int = 65536
+            The largest packet to buffer before it is forced out
+        """
+        super().__init__(max_length)
+
+        self.header_size = header_size
+        self.byteorder = byteorder
+
+    def _extract(self, packets: list) -> int:
+        buffer = self.buffer
+        start = 0
+
+        while (len(buffer) - start >= self.header_size):
+            length = int.from_bytes(
+                buffer[start:start + self.header_size], self.byteorder)
+            end = start + self.header_size + length
+
+            if (end > len(buffer)):
+                break
+
+            packets.append(bytes(buffer[start + self.header_size:end]))
+            start = end
+
+        self._search = len(buffer)
+        return start
+
+
+class SlipFramer(DelimiterFramer):
+    """
+    Splits and decodes SLIP (RFC 1055) encoded packets. Empty packets and
+    packets with bad escape sequences are dropped.
+    """
+    def __init__(self, max_length: int = 65536):
+        super().__init__(bytes((SLIP_END,)), max_length)
+
+    def _extract(self, packets: list) -> int:
+        raw_packets = []
+        start = super()._extract(raw_packets)
+
+        for raw in raw_packets:
+            if (len(raw) == 0):
+                continue
+
+            try:
+                packets.append(_slip_escape_re.sub(_slip_unescape, raw))
+            except ValueError:
+                self.errors += 1
+
+        return start
+
+
+def _slip_unescape(match: re.Match) -> bytes:
+    """
+    Convert a SLIP escape sequence back into the byte it represents
+    """
+    code = match.group(1)[0]
+    if (code == SLIP_ESC_END):
+        return b"\xc0"
+    elif (code == SLIP_ESC_ESC):
+        return b"\xdb"
+
+    raise ValueError("bad SLIP escape sequence")
+
+
+class CobsFramer(DelimiterFramer):
+    """
+    Splits and decodes COBS encoded packets delimited by zero bytes. Packets
+    that fail to decode are dropped.
+    """
+    def __init__(self, max_length: int = 65536):
+        super().__init__(b"\x00", max_length)
+
+    def _extract(self, packets: list) -> int:
+        raw_packets = []
+        start = super()._extract(raw_packets)
+
+        for raw in raw_packets:
+            if (len(raw) == 0):
+                continue
+
+            try:
+                packets.append(cobs_decode(raw))
+            except ValueError:
+                self.errors += 1
+
+        return start
+
+
+def cobs_decode(encoded: bytes) -> bytes:
+    """
+    Decode a single COBS encoded packet (without the zero delimiter). Each
+    block is copied as a slice rather than byte by byte.
+
+    ### Params:
+    encoded : bytes
+        The encoded packet
+
+    ### Returns:
+    out : bytes
+        The decoded packet
+    """
+    output = bytearray()
+    i = 0
+    length = len(encoded)
+
+    while (i < length):
+        code = encoded[i]
+        if (code == 0 or i + code > length):
+            raise ValueError("bad COBS block")
+
+        output += encoded[i + 1:i + code]
+        i += code
+
+        if (code != 0xFF and i < length):
+            output.append(0)
+
+    return bytes(output)
+
+
+class ModbusRtuFramer(Framer):
+    """
+    Splits a Modbus RTU byte stream into frames. RTU frames are separated by
+    silence rather than a delimiter, so instead the lengths a frame could
+    have are worked out from its function code (a request or a response) and
+    the first one whose CRC checks is taken. Bytes that do not start a valid
+    frame are dropped one at a time until the stream is back in step.
+    """
+    def __init__(self, max_length: int = 65536):
+        super().__init__(max_length)
+
+        # The lengths up to this have failed the CRC for the frame waiting at
+        # the start of the buffer, so they are not checked again as the rest
+        # of it arrives
+        self._checked = 0
+
+    def reset(self):
+        super().reset()
+        self._checked = 0
+
+    def _frame_lengths(self, start: int) -> list:
+        """
+        Find the lengths the frame starting at start could have
+
+        ### Params:
+        start : int
+            The position of the frame in the buffer
+
+        ### Returns:
+        out : list
+            The possible lengths, shortest first. Empty if more bytes are
+            needed to tell and None if a frame cannot start here
+        """
+        buffer = self.buffer
+        function = buffer[start + 1]
+
+        if (buffer[start] > MODBUS_MAX_ADDRESS):
+            return None
+        elif (function & 0x80): # Exception response
+            return [5] if (function & 0x7F) in MODBUS_FUNCTIONS else None
+        elif (function not in MODBUS_FRAME_LENGTHS):
+            return MODBUS_ANY_LENGTH if function in MODBUS_FUNCTIONS else None
+
+        lengths = set()
+        for length in MODBUS_FRAME_LENGTHS[function]:
+            if (isinstance(length, tuple)): # Depends on a byte count
+                offset, base, width = length
+                if (len(buffer) - start < offset + width):
+                    return []
+                length = base + int.from_bytes(
+                    buffer[start + offset:start + offset + width], "big")
+
+            if (length <= MODBUS_MAX_FRAME):
+                lengths.add(length)
+
+        return sorted(lengths) if lengths else None
+
+    def _extract(self, packets: list) -> int:
+        buffer = self.buffer
+        start = 0
+        checked = self._checked
+        self._checked = 0
+
+        # The CRCs are checked on views rather than copies, the view is 
+        # released before feed removes the consumed bytes
+        with memoryview(buffer) as view:
+            while (len(buffer) - start >= 4):
+                lengths = self._frame_lengths(start)
+                if (lengths == []):
+                    break
+
+                found = None
+                for length in lengths or []:
+                    if (length <= checked):
+                        continue
+                    elif (start + length > len(buffer)):
+                        found = 0
+                        break
+
+                    if (crc16_modbus(view[start:start + length]) == 0):
+                        found = length
+                        break
+                    checked = length
+
+                if (found == 0): # Wait for the rest of the frame
+                    self._checked = checked
+                    break
+                elif (found == None): # Not a frame, try the next byte
+                    self.errors += 1
+                    start += 1
+                    checked = 0
+                    continue
+
+                packets.append(bytes(view[start:start + found]))
+                start += found
+                checked = 0
+
+        self._search = len(buffer)
+        return start
+
+
+def make_framer(framing: str, delimiter: bytes = b"\n",
+    header_size: int = 1) -> Framer:
+    """
+    Create the framer for a framing method
+
+    ### Params:
+    framing : str
+        The framing method, one of FRAMING_TYPES
+    delimiter : bytes = b"\\n"
+        The end of packet identifier used by delim framing
+    header_size : int = 1
+        The length header size used by length framing
+
+    ### Returns:
+    out : Framer
+        The framer or None if framing is "none"
+    """
+    if (framing == "none"):
+        return None
+    elif (framing == "delim"):
+        return DelimiterFramer(delimiter)
+    elif (framing == "length"):
+        return LengthPrefixFramer(header_size)
+    elif (framing == "cobs"):
+        return CobsFramer()
+    elif (framing == "slip"):
+        return SlipFramer()
+    elif (framing == "modbus"):
+        return ModbusRtuFramer()
+
+    raise ValueError(f"unknown framing {framing}")
+
+
+class PacketLogSink:
+    """
+    Writes each received packet to a file as a time stamped line of hex.
+    """
+    def __init__(self, path: str):
+        """
+        Open the packet log
+
+        ### Params:
+        path : str
+            The file to append packets to
+        """
+        # Line buffered as the application exits without closing files
+        self.file = open(path, "a", buffering=1)
+
+    def __call__(self, packet: bytes):
+        self.file.write(f"{get_time_str()} {packet.hex(' ')}\n")
+
+    def close(self):
+        """
+        Flush and close the log file
+        """
+        self.file.close()
@@ -23,6 +23,7 @@ GNU General Public License for more details.
 '''
 
 import os
+import time
 
 # Windows
 if os.name == 'nt':
@@ -33,6 +34,7 @@ else:
     import sys
     import termios
     import atexit
+    import codecs
     from select import select
 
 
@@ -56,6 +58,10 @@ class KBHit:
             self.new_term[3] = (self.new_term[3] & ~termios.ICANON & ~termios.ECHO)
             termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.new_term)
 
+            # Read the fd directly so no chars are hidden in the sys.stdin
+            # buffer where select cannot see them
+            self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
             # Support normal-terminal reset at exit
             atexit.register(self.set_normal_term)
 
@@ -68,12 +74,16 @@ class KBHit:
             pass
 
         else:
-            termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.old_term)
+            try:
+                termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.old_term)
+            except termios.error: # The terminal has hung up
+                pass
 
 
     def getch(self):
         ''' Returns a keyboard character after kbhit() has been called.
             Should not be called in the same program as getarrow().
+            Raises EOFError once stdin is closed (e.g. a hangup).
         '''
 
         s = ''
@@ -82,7 +92,14 @@ class KBHit:
             return msvcrt.getch().decode('utf-8')
 
         else:
-            return sys.stdin.read(1)
+            # Only keep reading while the decoder holds part of a character
+            c = ''
+            while (c == ''):
+                byte = os.read(self.fd, 1)
+                if (byte == b''):
+                    raise EOFError("stdin closed")
+                c = self.decoder.decode(byte)
+            return c
 
 
     def getarrow(self):
@@ -117,6 +134,26 @@ class KBHit:
             return dr != []
 
 
+    def wait(self, timeout=None, wake_fd=None):
+        ''' Blocks until a keyboard character is hit, wake_fd becomes readable
+        or the timeout (in seconds, None for ever) expires. Returns True if a
+        keyboard character was hit, False otherwise. On Windows this polls.
+        '''
+
+        if os.name == 'nt':
+            end = None if timeout is None else time.monotonic() + timeout
+            while not msvcrt.kbhit():
+                if end is not None and time.monotonic() >= end:
+                    return False
+                time.sleep(0.01)
+            return True
+
+        else:
+            fds = [self.fd] if wake_fd is None else [self.fd, wake_fd]
+            dr,dw,de = select(fds, [], [], timeout)
+            return self.fd in dr
+
+
 # Test    
 if __name__ == "__main__":
 
@@ -0,0 +1,182 @@
+##
+# @file line_filter.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-23
+# @brief Filters and highlights received lines after framing. The include,
+# exclude and highlight rules are each compiled into one regex so the cost 
+# does not grow with the number of rules.
+
+import re
+
+# The colours highlight rules can use mapped to their ANSI SGR codes
+COLOURS = {"black": "30", "red": "31", "green": "32", "yellow": "33",
+    "blue": "34", "magenta": "35", "cyan": "36", "white": "37"}
+
+RESET = "\x1b[0m"
+
+
+def parse_highlight(rule: str) -> tuple:
+    """
+    Parse a highlight rule given as COLOUR:REGEX, the colour may be prefixed
+    with "bold-" (e.g. "bold-red:ERROR")
+
+    ### Params:
+    rule : str
+        The rule
+
+    ### Returns:
+    out : tuple
+        The ANSI escape that starts the colour and the regex
+
+    ### Raises:
+    ValueError
+        If the colour is not known
+    """
+    colour, _, pattern = rule.partition(":")
+    bold = colour.startswith("bold-")
+    if (bold):
+        colour = colour[len("bold-"):]
+
+    if (colour not in COLOURS or not pattern):
+        raise ValueError(f"highlight rule {rule} is not COLOUR:REGEX with a " \
+            f"colour of {', '.join(COLOURS)}")
+
+    return f"\x1b[{'1;' if bold else ''}{COLOURS[colour]}m", pattern
+
+
+def combine_rules(rules: list) -> tuple:
+    """
+    Compile rules into one alternation. Rules with the same value share a
+    named group, a group for every rule stops the regex engine using its
+    fast search for the literal start of a match and is several times slower.
+    The pattern is multiline so ^ and $ anchor to each line.
+
+    ### Params:
+    rules : list
+        The rules as (value, regex)
+
+    ### Returns:
+    out : tuple
+        The combined pattern (None if there are no rules) and a dictionary 
+        of group name -> value for finding the value of a match from its
+        lastgroup
+
+    ### Raises:
+    ValueError
+        If a regex is not valid
+    """
+    groups = {}
+    for value, pattern in rules:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"bad pattern {pattern}: {e}")
+
+        groups.setdefault(value, []).append(f"(?:{pattern})")
+
+    if (not groups):
+        return None, {}
+
+    values = {}
+    alternatives = []
+    for value, patterns in groups.items():
+        name = f"_rule{len(values)}"
+        values[name] = value
+        alternatives.append(f"(?P<{name}>{'|'.join(patterns)})")
+
+    return re.compile("|".join(alternatives), re.MULTILINE), values
+
+
+class LineFilter:
+    """
+    Drops lines matching an exclude rule, keeps only lines matching an
+    include rule (if there are any) and colours the text matching highlight
+    rules. The include rules, the exclude rules and the highlight rules are
+    each joined into one regex, so however many rules there are each line 
+    is searched at most once per kind. Every search is limited to a single
+    line (without its line ending) so a pattern cannot match across lines
+    and ^ and $ anchor to the line.
+    """
+    def __init__(self, include: list = None, exclude: list = None,
+        highlight: list = None):
+        """
+        Compile the rules
+
+        ### Params:
+        include : list = None
+            Regexes of the lines to show, all lines are shown if empty
+        exclude : list = None
+            Regexes of the lines to hide
+        highlight : list = None
+            Highlight rules given as COLOUR:REGEX
+
+        ### Raises:
+        ValueError
+            If a rule is not valid
+        """
+        self.include = include if include != None else []
+        self.exclude = exclude if exclude != None else []
+        self.highlight = [parse_highlight(rule) for rule in highlight or []]
+
+        self.lines_dropped = 0
+
+        self._include, _ = combine_rules([(None, pattern) 
+            for pattern in self.include])
+        self._exclude, _ = combine_rules([(None, pattern) 
+            for pattern in self.exclude])
+        self._highlight, self._colours = combine_rules(self.highlight)
+
+    def _colour_match(self, match: re.Match) -> str:
+        """
+        Wrap a highlight match in its colour
+        """
+        return f"{self._colours[match.lastgroup]}{match.group()}{RESET}"
+
+    def apply(self, text: str) -> str:
+        """
+        Filter and highlight a batch of lines
+
+        ### Params:
+        text : str
+            The lines, each ending in a new line
+
+        ### Returns:
+        out : str
+            The lines that are kept with highlighting added
+        """
+        include = self._include.search if self._include != None else None
+        exclude = self._exclude.search if self._exclude != None else None
+        highlight = self._highlight.sub if self._highlight != None else None
+        colour = self._colour_match
+
+        output = []
+        kept = 0 # The start of the run of kept lines not yet output
+        start = 0
+        length = len(text)
+        while (start < length):
+            end = text.find("\n", start)
+            if (end == -1):
+                end = length
+            following = end + 1
+
+            # Searches stop before the line ending, including a \r
+            if (end > start and text[end - 1] == "\r"):
+                end -= 1
+
+            if ((include != None and include(text, start, end) == None)
+                or (exclude != None and exclude(text, start, end) != None)):
+                output.append(text[kept:start])
+                kept = following
+                self.lines_dropped += 1
+            elif (highlight != None):
+                output.append(text[kept:start])
+                output.append(highlight(colour, text[start:end]))
+                kept = end
+
+            start = following
+
+        if (kept == 0):
+            return text
+
+        output.append(text[kept:])
+        return "".join(output)
@@ -8,13 +8,29 @@
 import serial
 import datetime
 import os
+import time
 
 import sys
+import threading
 
 
 from cmd_args import setup_cmd_args
-from com_rx import ComRxThread
-from com_tx import ComTxThread
+from com_rx import ComRxThread, RxPipeline
+from com_tx import ComTxThread, convert_to_bytes, EscapeError
+from framing import make_framer, PacketLogSink
+from async_engine import run_async_engine
+from merged_output import MergedOutput
+from capture import CaptureWriter
+from replay import ReplaySerial
+from reconnect import PortSupervisor
+from port_index import PortIndex, format_ports
+from metrics import Metrics, MetricsReporter
+from bulk_send import BulkSender, COMMAND_PREFIX
+from expect import Expecter, load_script, run_script
+from scrollback import Scrollback
+from line_filter import LineFilter
+from decoders import make_decoder
+from keyboard_hit import KBHit
 import utils
 
 
@@ -46,10 +62,27 @@ def get_cwd() -> str:
     else:
         return os.getcwd()
 
+# The settings used for anything missing from default-settings.json, so a
+# settings file written before a setting was added still loads
+DEFAULT_SETTINGS = {
+    "version": 1,
+    "engine": "thread",
+    "mode": "dumb",
+    "serial": {"port": "/dev/ttyUSB0", "baud": 115200, "data": 8, "stop": 1,
+        "parity": "N", "chunk_size": 4096, "flow": "none", "ring_size": 1024,
+        "overflow": "block"},
+    "terminal": {"display_npc": False, "new_line_char": "NaN",
+        "format": "ascii", "encoding": "utf-8", "decode_errors": "replace",
+        "framing": "none", "length_size": 1, "frame_ms": 16, "frame_kb": 64,
+        "skip_over": 0, "scrollback": 0, "include": [], "exclude": [],
+        "highlight": [], "status": False},
+    "decoder": {"type": "none", "layout": None, "layouts": {}},
+}
+
 def load_settings() -> tuple[ConfigDict, ConfigDict]:
     """
     Load settings from a file if it exists otherwise create it from the default
-    configuration.
+    configuration. The file is merged over DEFAULT_SETTINGS.
 
     ### Returns:
     out : ConfigDict
@@ -69,6 +102,8 @@ def load_settings() -> tuple[ConfigDict, ConfigDict]:
     else:
         default_cfg = Config.load_json(current_cfg.cwd_full + "/default-settings.json")
 
+    default_cfg = Config.merge(DEFAULT_SETTINGS, default_cfg)
+
     return default_cfg, current_cfg
 
 def transpose_args(args, current_cfg: ConfigDict) -> None:
@@ -82,61 +117,184 @@ def transpose_args(args, current_cfg: ConfigDict) -> None:
         The current configurations
     """
     current_cfg.mode = args.mode
+    current_cfg.engine = args.engine
     current_cfg.serial = ConfigDict()
     current_cfg.serial.port = args.port
+    current_cfg.serial.ports = [args.port] + args.add_port
     current_cfg.serial.baud = args.baud
     current_cfg.serial.data = args.data
     current_cfg.serial.parity = args.parity
     current_cfg.serial.stop = args.stop
+    current_cfg.serial.chunk_size = args.chunk_size
+    current_cfg.serial.flow = args.flow
+    current_cfg.serial.ring_size = args.ring_size
+    current_cfg.serial.overflow = args.overflow
+
+    current_cfg.serial.select = ConfigDict()
+    current_cfg.serial.select.vid, current_cfg.serial.select.pid = \
+        args.vid_pid if args.vid_pid != None else (None, None)
+    current_cfg.serial.select.serial_number = args.serial_number
+    current_cfg.serial.select.description = args.description
     
     current_cfg.terminal = ConfigDict()
     current_cfg.terminal.display_npc = args.display
-    current_cfg.terminal.new_line_char = "NaN"
-
-def open_serial_port(port: str, baud: int, data: int, parity: str,
-    stop: int, timeout: float) -> serial.Serial:
+    current_cfg.terminal.new_line_char = args.eop
+    current_cfg.terminal.format = args.format
+    current_cfg.terminal.encoding = args.encoding
+    current_cfg.terminal.decode_errors = args.decode_errors
+    current_cfg.terminal.framing = args.framing
+    current_cfg.terminal.length_size = args.length_size
+    current_cfg.terminal.frame_ms = args.frame_ms
+    current_cfg.terminal.frame_kb = args.frame_kb
+    current_cfg.terminal.skip_over = args.skip_over
+    current_cfg.terminal.scrollback = args.scrollback
+    current_cfg.terminal.include = args.include
+    current_cfg.terminal.exclude = args.exclude
+    current_cfg.terminal.highlight = args.highlight
+    current_cfg.terminal.status = args.status
+
+    current_cfg.decoder = ConfigDict()
+    current_cfg.decoder.type = args.decoder
+    current_cfg.decoder.layout = args.layout
+
+    current_cfg.profile = ConfigDict()
+    current_cfg.profile.path = args.profile
+    current_cfg.profile.python = args.profile_python
+    current_cfg.profile.memory = args.profile_memory
+
+    current_cfg.metrics = ConfigDict()
+    current_cfg.metrics.path = args.metrics_file
+    current_cfg.metrics.port = args.metrics_port
+    current_cfg.metrics.interval = args.metrics_interval
+    current_cfg.terminal.packet_log = args.packet_log
+    current_cfg.terminal.port_logs = args.port_logs
+
+    current_cfg.capture = ConfigDict()
+    current_cfg.capture.path = args.capture
+    current_cfg.capture.rotate_size = None
+    if (args.capture_size != None):
+        current_cfg.capture.rotate_size = int(args.capture_size * 1024 * 1024)
+    current_cfg.capture.rotate_time = args.capture_time
+    current_cfg.capture.compress = args.capture_compress
+    current_cfg.capture.records = args.capture_format == "records"
+
+    current_cfg.send = ConfigDict()
+    current_cfg.send.commands = \
+        [f"{COMMAND_PREFIX}send {path}" for path in args.send_file] + \
+        [f"{COMMAND_PREFIX}script {path}" for path in args.send_script]
+    current_cfg.send.chunk_delay = args.chunk_delay
+    current_cfg.send.line_delay = args.line_delay
+
+    current_cfg.expect = ConfigDict()
+    current_cfg.expect.script = args.expect_script
+    current_cfg.expect.timeout = args.expect_timeout
+
+    current_cfg.replay = ConfigDict()
+    current_cfg.replay.path = args.replay
+    current_cfg.replay.speed = args.replay_speed
+
+    # An end of packet identifier implies delimiter framing
+    if (args.framing == "none" and args.eop != "NaN"):
+        current_cfg.terminal.framing = "delim"
+
+def create_capture(current_cfg: ConfigDict, port: str) -> CaptureWriter:
     """
-    Continuously attempt to open a serial port.
-
-    ### Param:
-    port: string
-        The serial port to open
-    baud: int
-        The baud rate to open the serial port
-    data: int
-        The number of data bits
-    parity: str 
-        The whether parity is enabled
-    stop: int
-        The number of stop bits
-    timeout: float
-        The time to wait before timing out on a serial read
+    Create the raw capture for a port if capturing is enabled. When more than
+    one port is monitored the port name is added to the capture file name.
+
+    ### Params:
+    current_cfg : ConfigDict
+        The current configuration
+    port : str
+        The port being captured
 
     ### Returns:
-     : serial.Serial
-        The opened serial port
+    out : CaptureWriter
+        The capture or None if capturing is disabled
     """
-    serial_started = False
-    first_print = True
-    while (not serial_started):
-        try:
-            port = serial.Serial(port=port, baudrate=baud, 
-                bytesize=data, parity=parity, stopbits=stop,
-                timeout=timeout)
-            serial_started = True
-            
-        except serial.serialutil.SerialException:
-            if (first_print):
-                print(f"{utils.get_time_str()} Serial port waiting to open" \
-                      "(Check settings if connected) \r")
+    if (current_cfg.capture.path == None):
+        return None
+
+    path = current_cfg.capture.path
+    if (len(current_cfg.serial.ports) > 1):
+        root, ext = os.path.splitext(path)
+        path = f"{root}-{os.path.basename(port)}{ext}"
 
-            first_print = False
-        except:
-            os._exit(0)
+    try:
+        capture = CaptureWriter(path, current_cfg.capture.rotate_size,
+            current_cfg.capture.rotate_time, current_cfg.capture.compress,
+            records=current_cfg.capture.records)
+    except FileExistsError:
+        print(f"{utils.get_time_str()} Record capture {path} already exists")
+        sys.exit(1)
 
-    print(f"{utils.get_time_str()} Serial monitor started: {data}, {stop}, {baud}, {parity}")
+    utils.exit_handlers.append(capture.close)
 
-    return port
+    return capture
+
+def create_pipeline(current_cfg: ConfigDict, packet_sinks: list,
+    port: str) -> RxPipeline:
+    """
+    Create the receive pipeline for a port from the current configuration
+
+    ### Params:
+    current_cfg : ConfigDict
+        The current configuration
+    packet_sinks : list
+        The callables to pass each received packet to
+    port : str
+        The port the pipeline is for
+
+    ### Returns:
+    out : RxPipeline
+        The receive pipeline
+    """
+    delimiter = b"\n"
+    if (current_cfg.terminal.new_line_char != "NaN"):
+        try:
+            delimiter = bytes(convert_to_bytes(
+                current_cfg.terminal.new_line_char))
+        except EscapeError as e:
+            print(f"{utils.get_time_str()} End of packet identifier has a {e}")
+            sys.exit(1)
+
+    framer = make_framer(current_cfg.terminal.framing, delimiter,
+        current_cfg.terminal.length_size)
+
+    try:
+        packet_decoder = make_decoder(current_cfg.decoder)
+    except ValueError as e:
+        print(f"{utils.get_time_str()} Decoder {e}")
+        sys.exit(1)
+
+    # A decoder picks its own framing if one is not selected
+    if (packet_decoder != None and framer == None):
+        if (packet_decoder.framing == None):
+            print(f"{utils.get_time_str()} The {current_cfg.decoder.type} " \
+                "decoder needs a framing method (--framing)")
+            sys.exit(1)
+
+        framer = make_framer(packet_decoder.framing)
+
+    line_filter = None
+    if (current_cfg.terminal.include or current_cfg.terminal.exclude
+        or current_cfg.terminal.highlight):
+        try:
+            line_filter = LineFilter(current_cfg.terminal.include,
+                current_cfg.terminal.exclude, current_cfg.terminal.highlight)
+        except ValueError as e:
+            print(f"{utils.get_time_str()} Filter {e}")
+            sys.exit(1)
+
+        if (framer == None): # Filters work on whole lines
+            framer = make_framer("delim", delimiter)
+
+    return RxPipeline(current_cfg.terminal.display_npc, 
+        current_cfg.terminal.format, framer, packet_sinks,
+        create_capture(current_cfg, port), 
+        encoding=current_cfg.terminal.encoding,
+        errors=current_cfg.terminal.decode_errors, line_filter=line_filter,
+        packet_decoder=packet_decoder)
 
 def main() -> None:
     """
@@ -152,28 +310,225 @@ def main() -> None:
 
     transpose_args(args, current_cfg)
 
+    if (args.list):
+        print(format_ports(PortIndex().refresh()))
+        return
+
+    # Struct layouts come from the settings with any from a layouts file
+    current_cfg.decoder.layouts = ConfigDict(default_cfg.decoder.layouts)
+    if (args.layouts != None):
+        try:
+            current_cfg.decoder.layouts.update(Config.load_json(args.layouts))
+        except (OSError, ValueError, TypeError) as e:
+            print(f"{utils.get_time_str()} Could not load layouts: {e}")
+            sys.exit(1)
+
+    # Only imported when used so the hot paths are untouched otherwise
+    if (current_cfg.profile.path != None):
+        from profiling import Profiler
+
+        profiler = Profiler(current_cfg.profile.path, 
+            current_cfg.profile.python, current_cfg.profile.memory)
+        profiler.install()
+        utils.exit_handlers.append(profiler.write)
+
+    # The first port can be picked by its details, it is looked up again on 
+    # each reconnect as it may come back under another name
+    resolve = None
+    select = current_cfg.serial.select
+    if (select.vid != None or select.pid != None 
+        or select.serial_number != None or select.description != None):
+        index = PortIndex()
+
+        def resolve():
+            matches = index.find(select.vid, select.pid, select.serial_number,
+                select.description)
+            return matches[0].device if matches else None
+
+        device = resolve()
+        if (device != None):
+            current_cfg.serial.ports[0] = device
+        else:
+            print(f"{utils.get_time_str()} No port matches the selection")
+
+    # A replay stands in for the serial port and has no fd to wait on
+    if (current_cfg.replay.path != None):
+        current_cfg.serial.ports = [current_cfg.replay.path]
+        current_cfg.engine = "thread"
+
+    packet_sinks = []
+    if (current_cfg.terminal.packet_log != None):
+        packet_sinks.append(PacketLogSink(current_cfg.terminal.packet_log))
+
+    # The pipelines are kept across reconnects, one for each port
+    pipelines = [create_pipeline(current_cfg, packet_sinks, port) 
+        for port in current_cfg.serial.ports]
+
+    # Searchable history of the first port, only kept when the in session 
+    # commands that use it can be typed
+    scrollback = None
+    if (current_cfg.terminal.scrollback > 0 and current_cfg.mode != "local"):
+        print(f"{utils.get_time_str()} The scrollback is only kept in local " \
+            "mode")
+    elif (current_cfg.terminal.scrollback > 0):
+        scrollback = Scrollback(int(current_cfg.terminal.scrollback 
+            * 1024 * 1024), encoding=current_cfg.terminal.encoding)
+        pipelines[0].chunk_sinks.append(scrollback.append)
+
+    if (current_cfg.engine == "asyncio" and os.name == 'nt'):
+        print(f"{utils.get_time_str()} The asyncio engine is not supported " \
+            "on Windows, using threads")
+        current_cfg.engine = "thread"
+
+    if (len(current_cfg.serial.ports) > 1 and current_cfg.engine != "asyncio"):
+        if (os.name == 'nt'):
+            print(f"{utils.get_time_str()} Monitoring more than one port is " \
+                "not supported on Windows")
+            return
+
+        current_cfg.engine = "asyncio"
+
+    output = MergedOutput([os.path.basename(port) 
+        for port in current_cfg.serial.ports], current_cfg.terminal.port_logs)
+    utils.exit_handlers.append(output.close)
+
+    metrics = Metrics()
+    metrics.pipelines = pipelines
+    try:
+        reporter = MetricsReporter(metrics, current_cfg.terminal.status, 
+            current_cfg.metrics.path, current_cfg.metrics.port, 
+            current_cfg.metrics.interval)
+    except OSError as e:
+        print(f"{utils.get_time_str()} Could not start metrics: {e}")
+        return
+    reporter.start()
+    utils.exit_handlers.append(reporter.close)
+
+    # The script is matched against the first port and runs on its own 
+    # thread once the port first opens
+    expecter = None
+    script = None
+    if (current_cfg.expect.script != None):
+        try:
+            script = load_script(current_cfg.expect.script)
+        except (OSError, ValueError) as e: # Includes EscapeError
+            print(f"{utils.get_time_str()} Could not load script: {e}")
+            return
+
+        expecter = Expecter(capture=pipelines[0].capture, 
+            timeout=current_cfg.expect.timeout, metrics=metrics)
+        pipelines[0].chunk_sinks.append(expecter.feed)
+
+        # The script can exit from its own thread so the terminal has to be
+        # restored by an exit handler
+        if (os.name != 'nt'):
+            utils.exit_handlers.append(KBHit().set_normal_term)
+
+    # Wait for serial port to open, the asyncio engine does not block on
+    # reads
+    timeout = 0 if current_cfg.engine == "asyncio" else 0.5
+    supervisors = [PortSupervisor(port, current_cfg.serial.baud, 
+        current_cfg.serial.data, current_cfg.serial.parity, 
+        current_cfg.serial.stop, timeout, current_cfg.serial.flow) 
+        for port in current_cfg.serial.ports]
+    supervisors[0].resolve = resolve
+    metrics.supervisors = supervisors
+
     while (True):
-        # Wait for serial port to open
-        port = open_serial_port(current_cfg.serial.port, current_cfg.serial.baud, 
-            current_cfg.serial.data, current_cfg.serial.parity, 
-            current_cfg.serial.stop, 0.5)
+        if (current_cfg.replay.path != None):
+            ports = [ReplaySerial(current_cfg.replay.path, 
+                current_cfg.replay.speed, timeout)]
+        elif (len(supervisors) > 1):
+            # Monitor the ports that are present, the engine opens the rest
+            # as they appear
+            ports = [supervisor.open_present() for supervisor in supervisors]
+        else:
+            ports = [supervisor.open() for supervisor in supervisors]
+        port = ports[0]
+        started = time.monotonic()
 
         print(f"{utils.get_time_str()} In {current_cfg.mode} mode with display " \
             f"{current_cfg.terminal.display_npc}.")
 
-        com_tx_thread = ComTxThread(port, current_cfg.mode)
+        # The start up sends are only made on the first connection
+        sender = BulkSender(port, current_cfg.serial.chunk_size, 
+            current_cfg.send.chunk_delay, current_cfg.send.line_delay,
+            pipelines[0].capture, pending=current_cfg.send.commands,
+            metrics=metrics)
+        sender.commands["status"] = reporter.toggle_status
+        if (scrollback != None):
+            sender.commands["find"] = scrollback.find
+            sender.commands["findhex"] = scrollback.find_hex
+            sender.commands["jump"] = scrollback.jump
+            sender.commands["next"] = scrollback.next
+
+        metrics.serial_port = port
+        metrics.rx_thread = None
+
+        def follow_first_port(port):
+            """
+            Point the expecter at the first port and start the script the 
+            first time it is open
+            """
+            nonlocal script
+            if (expecter != None):
+                expecter.serial_port = port
+
+            if (script != None):
+                threading.Thread(target=run_script, args=(expecter, script),
+                    name="expect_script_thread", daemon=True).start()
+                script = None
+
+        if (port != None):
+            follow_first_port(port)
+
+        if (current_cfg.engine == "asyncio"):
+            exited = run_async_engine(ports, pipelines, current_cfg.mode,
+                current_cfg.serial.chunk_size, output, sender, metrics,
+                supervisors, follow_first_port, 
+                current_cfg.terminal.frame_ms / 1000,
+                current_cfg.terminal.frame_kb * 1024,
+                current_cfg.terminal.skip_over * 1024)
+            for port in ports:
+                if (port != None):
+                    port.close()
+
+            if (exited):
+                for handler in utils.exit_handlers:
+                    handler()
+                print()
+                return
+
+            print(f"\r\n{utils.get_time_str()} Lost connection\r")
+            continue
+
+        com_tx_thread = ComTxThread(port, current_cfg.mode, 
+            pipelines[0].capture, sender, metrics)
         
-        com_rx_thread = ComRxThread(port, current_cfg.terminal.display_npc)
+        com_rx_thread = ComRxThread(port, pipelines[0], 
+            current_cfg.serial.chunk_size, output, 
+            current_cfg.serial.ring_size * 1024, current_cfg.serial.overflow,
+            current_cfg.terminal.frame_ms / 1000, 
+            current_cfg.terminal.frame_kb * 1024,
+            current_cfg.terminal.skip_over * 1024, metrics)
+        metrics.rx_thread = com_rx_thread
 
         # start threads
         com_tx_thread.start()
         com_rx_thread.start()
 
         com_rx_thread.join()
-        print(f"\r\n{utils.get_time_str()} Lost connection\r")
         com_tx_thread.join()
-        
         port.close()
 
+        if (current_cfg.replay.path != None):
+            elapsed = time.monotonic() - started
+            print(f"\r\n{utils.get_time_str()} Replayed {port.bytes_read} " \
+                f"bytes in {elapsed:.3f} s " \
+                f"({port.bytes_read / elapsed / 1e6:.2f} MB/s)\r")
+            utils.exit_app(0)
+
+        print(f"\r\n{utils.get_time_str()} Lost connection\r")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,240 @@
+##
+# @file merged_output.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-14
+# @brief Merges the rendered output of several serial ports into one view
+# with each line tagged by port and a monotonic time stamp
+
+import os
+import sys
+import time
+
+
+class MergedOutput:
+    """
+    Writes rendered text from one or more ports to the terminal. Text is held
+    until flush so a whole frame goes out in one write. With more than one
+    port every line starts with the port name and the seconds since start so
+    the interleaved lines can be told apart. If a port is part way through a
+    line when another port writes the line is ended first.
+    """
+    def __init__(self, names: list, log_dir: str = None, stream=None):
+        """
+        Initialise the output
+
+        ### Params:
+        names : list
+            The name of each port in index order
+        log_dir : str = None
+            Directory to write a separate log file for each port to
+        stream = None
+            The stream to write the merged view to (default stdout)
+        """
+        self.names = names
+        self.stream = stream if stream != None else sys.stdout
+
+        # Text is collected into a frame and written with one os.write on
+        # flush when the stream is a real file
+        self._frame = []
+        self.pending = 0
+        self._fd = None
+        try:
+            self._fd = self.stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            pass
+        self.tagged = len(names) > 1
+
+        width = max(len(name) for name in names)
+        self._tags = [f"[{name:<{width}} " for name in names]
+        self._line_start = [True] * len(names)
+        self._last = None
+        self._start = time.monotonic()
+
+        self.log_files = []
+        if (log_dir != None):
+            os.makedirs(log_dir, exist_ok=True)
+            for name in names:
+                self.log_files.append(open(os.path.join(log_dir,
+                    f"{name}.log"), "a"))
+
+    def tag_lines(self, index: int, text: str) -> str:
+        """
+        Put the port tag and time stamp at the start of each line in text. A
+        single time stamp is used for the whole chunk.
+
+        ### Params:
+        index : int
+            The index of the port the text came from
+        text : str
+            The rendered text
+
+        ### Returns:
+        out : str
+            The tagged text
+        """
+        prefix = f"{self._tags[index]}{time.monotonic() - self._start:10.3f}] "
+
+        ends_line = text.endswith("\n")
+        if (ends_line):
+            text = text[:-1]
+
+        text = text.replace("\n", "\n" + prefix)
+
+        if (self._line_start[index]):
+            text = prefix + text
+        if (ends_line):
+            text += "\n"
+
+        self._line_start[index] = ends_line
+        return text
+
+    def write(self, index: int, text: str):
+        """
+        Write rendered text from a port
+
+        ### Params:
+        index : int
+            The index of the port the text came from
+        text : str
+            The rendered text
+        """
+        if (text == ""):
+            return
+
+        if (self.tagged):
+            # End the other ports line so the text starts on a new one
+            if (self._last != index and self._last != None
+                and not self._line_start[self._last]):
+                self._frame.append("\n")
+                if (self.log_files):
+                    self.log_files[self._last].write("\n")
+                self._line_start[self._last] = True
+
+            text = self.tag_lines(index, text)
+            self._last = index
+
+        self._frame.append(text)
+        self.pending += len(text)
+
+        if (self.log_files):
+            self.log_files[index].write(text)
+
+    def flush(self):
+        """
+        Write the text collected since the last flush to the terminal
+        """
+        text = "".join(self._frame)
+        self._frame = []
+        self.pending = 0
+
+        if (self._fd == None):
+            self.stream.write(text)
+            self.stream.flush()
+            return
+
+        # Keep the order with anything printed to the stream directly
+        self.stream.flush()
+
+        view = memoryview(text.encode(getattr(self.stream, "encoding", None)
+            or "utf-8", "replace"))
+        while (len(view)):
+            view = view[os.write(self._fd, view):]
+
+    def close(self):
+        """
+        Close the per port log files, later writes only go to the terminal
+        so threads still receiving while the application exits are safe
+        """
+        log_files, self.log_files = self.log_files, []
+        for file in log_files:
+            file.close()
+
+
+class FramePacer:
+    """
+    Paces the writes of a MergedOutput to the terminal. While data is
+    streaming text is flushed at most once per frame interval (or sooner if
+    a frame's worth is waiting), data after a quiet spell goes out straight
+    away. When the renderer falls too far behind the backlog is skipped and
+    summarised rather than letting the terminal lag further. Shared by the 
+    receive thread and the asyncio engine.
+    """
+    def __init__(self, output: MergedOutput, frame_interval: float = 0.016,
+        frame_size: int = 65536, skip_over: int = 0):
+        """
+        Initialise the pacer
+
+        ### Params:
+        output : MergedOutput
+            The output to flush
+        frame_interval : float = 0.016
+            The shortest time between writes to the terminal while data is 
+            streaming
+        frame_size : int = 65536
+            The amount of text that is written without waiting for the frame
+            interval, also the amount kept when the backlog is skipped
+        skip_over : int = 0
+            When more than this many bytes are waiting to be displayed all 
+            but the newest frame_size are skipped, 0 never skips
+        """
+        self.output = output
+        self.frame_interval = frame_interval
+        self.frame_size = frame_size
+        self.skip_over = skip_over
+        self.skipped = 0
+
+        self._last_frame = 0.0
+
+    def wait_time(self, idle: float = None) -> float:
+        """
+        Find how long to wait for more data before the frame is due
+
+        ### Params:
+        idle : float = None
+            The wait when nothing is waiting to be flushed
+
+        ### Returns:
+        out : float
+            The seconds to wait
+        """
+        if (not self.output.pending):
+            return idle
+
+        return max(self._last_frame + self.frame_interval - time.monotonic(), 0)
+
+    def behind(self, waiting: int) -> bool:
+        """
+        Check if the backlog should be skipped
+
+        ### Params:
+        waiting : int
+            The number of bytes waiting to be displayed
+
+        ### Returns:
+        out : bool
+            True if all but the newest frame_size bytes should be skipped
+        """
+        return self.skip_over != 0 and waiting > self.skip_over
+
+    def report_skip(self, index: int, skipped: int):
+        """
+        Summarise skipped data in the output
+
+        ### Params:
+        index : int
+            The index of the port the data was skipped from
+        skipped : int
+            The number of bytes skipped
+        """
+        self.skipped += skipped
+        self.output.write(index, f"\r\n... {skipped} bytes skipped ...\r\n")
+
+    def frame(self):
+        """
+        Flush the output if a frame is due
+        """
+        now = time.monotonic()
+        if (self.output.pending and (now - self._last_frame 
+            >= self.frame_interval or self.output.pending >= self.frame_size)):
+            self.output.flush()
+            self._last_frame = now
@@ -0,0 +1,462 @@
+##
+# @file metrics.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-16
+# @brief Runtime counters and histograms for the receive and transmit sides
+# and the reconnect loop. They can be shown in a status line at the bottom
+# of the terminal, appended to a file as JSON lines or served as Prometheus
+# text.
+
+import bisect
+import http.server
+import json
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+
+import utils
+
+# Linux ioctl for the serial line error counts (struct serial_icounter_struct)
+TIOCGICOUNT = 0x545D
+ICOUNT = struct.Struct("20i")
+
+# Histogram bucket upper bounds
+SIZE_BOUNDS = [2 ** i for i in range(17)] # 1 B to 64 kB
+SECONDS_BOUNDS = [1e-6 * 2 ** i for i in range(24)] # 1 us to 8 s
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets
+    """
+    def __init__(self, bounds: list):
+        """
+        ### Params:
+        bounds : list
+            The upper bound of each bucket in increasing order, larger values
+            go in a final overflow bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Record a value
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction: float):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in
+
+        ### Params:
+        fraction : float
+            The quantile e.g. 0.99
+
+        ### Returns:
+        out : float
+            The estimate, None if nothing has been observed
+        """
+        if (self.count == 0):
+            return None
+
+        target = fraction * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if (total >= target):
+                return bound
+
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        """
+        Get the histogram as cumulative bucket counts
+
+        ### Returns:
+        out : dict
+            The count, sum and the cumulative count for each bound
+        """
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            total += count
+            buckets[str(bound)] = total
+
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+def read_line_errors(serial_port) -> dict:
+    """
+    Read the UART error counts for a port from the driver (Linux only)
+
+    ### Params:
+    serial_port : serial.Serial
+        The open port
+
+    ### Returns:
+    out : dict
+        The frame, overrun, parity, break and buffer overrun counts or None
+        if the driver does not report them (e.g. USB CDC or a pty)
+    """
+    if (os.name == 'nt'):
+        return None
+
+    import fcntl
+
+    try:
+        values = ICOUNT.unpack(fcntl.ioctl(serial_port.fileno(), TIOCGICOUNT,
+            bytes(ICOUNT.size)))
+    except (OSError, AttributeError, ValueError):
+        return None
+
+    # cts, dsr, rng, dcd, rx, tx, frame, overrun, parity, brk, buf_overrun
+    return {"frame_errors": values[6], "overrun_errors": values[7],
+        "parity_errors": values[8], "breaks": values[9],
+        "buffer_overruns": values[10]}
+
+
+class Metrics:
+    """
+    The counters updated by the receive and transmit sides. The hot path only
+    adds to plain attributes. Everything else (ring depth, framing errors,
+    reconnects, line errors) is read from its owner when a snapshot is taken.
+    """
+    def __init__(self):
+        """
+        Start the counters at zero
+        """
+        self.started = time.monotonic()
+
+        self.rx_bytes = 0
+        self.rx_chunks = 0
+        self.tx_bytes = 0
+        self.tx_chunks = 0
+
+        self.read_size = Histogram(SIZE_BOUNDS)
+        self.render_seconds = Histogram(SECONDS_BOUNDS)
+
+        # Set for each connection
+        self.serial_port = None
+        self.rx_thread = None
+        self.async_engine = None
+
+        # Set once
+        self.pipelines = []
+        self.supervisors = []
+
+        self._last = None
+
+    def count_rx(self, length: int):
+        """
+        Count a chunk read from the port
+        """
+        self.rx_bytes += length
+        self.rx_chunks += 1
+        self.read_size.observe(length)
+
+    def count_tx(self, length: int):
+        """
+        Count a chunk written to the port
+        """
+        self.tx_bytes += length
+        self.tx_chunks += 1
+
+    def snapshot(self, rates: bool = False) -> dict:
+        """
+        Collect all the metrics
+
+        ### Params:
+        rates : bool = False
+            Work out the byte rates since the last snapshot taken with rates
+
+        ### Returns:
+        out : dict
+            The metric values
+        """
+        now = time.monotonic()
+        values = {"uptime_seconds": round(now - self.started, 3),
+            "rx_bytes": self.rx_bytes, "rx_chunks": self.rx_chunks,
+            "tx_bytes": self.tx_bytes, "tx_chunks": self.tx_chunks}
+
+        if (rates):
+            rx_rate = tx_rate = 0.0
+            if (self._last != None and now > self._last[0]):
+                elapsed = now - self._last[0]
+                rx_rate = (self.rx_bytes - self._last[1]) / elapsed
+                tx_rate = (self.tx_bytes - self._last[2]) / elapsed
+            self._last = (now, self.rx_bytes, self.tx_bytes)
+            values["rx_bytes_per_second"] = round(rx_rate, 1)
+            values["tx_bytes_per_second"] = round(tx_rate, 1)
+
+        if (self.rx_thread != None):
+            ring = self.rx_thread.ring
+            values.update({"queue_bytes": ring.waiting(),
+                "queue_high_water_bytes": ring.high_water,
+                "queue_size_bytes": ring.size,
+                "dropped_bytes": ring.dropped, "overruns": ring.overruns,
+                "skipped_bytes": self.rx_thread.pacer.skipped})
+        elif (self.async_engine != None):
+            # The engine's queue holds chunks so its size is in chunks
+            engine = self.async_engine
+            values.update({"queue_bytes": engine.queued_bytes,
+                "queue_high_water_bytes": engine.queue_high_water,
+                "queue_size_bytes": engine.queue_size * engine.chunk_size,
+                "dropped_bytes": 0, "overruns": 0,
+                "skipped_bytes": engine.pacer.skipped})
+
+        values["framing_errors"] = sum(pipeline.framer.errors
+            for pipeline in self.pipelines if pipeline.framer != None)
+        values["framing_overflows"] = sum(pipeline.framer.overflows
+            for pipeline in self.pipelines if pipeline.framer != None)
+        values["decode_errors"] = sum(pipeline.packet_decoder.errors
+            for pipeline in self.pipelines 
+            if pipeline.packet_decoder != None)
+
+        values["reconnects"] = sum(supervisor.reconnects
+            for supervisor in self.supervisors)
+
+        if (self.serial_port != None):
+            line_errors = read_line_errors(self.serial_port)
+            if (line_errors != None):
+                values.update(line_errors)
+
+        reconnect_seconds = Histogram(SECONDS_BOUNDS)
+        for supervisor in self.supervisors:
+            for latency in supervisor.reconnect_latencies:
+                reconnect_seconds.observe(latency)
+
+        values["read_size_bytes"] = self.read_size.to_dict()
+        values["render_seconds"] = self.render_seconds.to_dict()
+        values["reconnect_seconds"] = reconnect_seconds.to_dict()
+
+        return values
+
+    def status_text(self, values: dict) -> str:
+        """
+        Format a snapshot as a one line summary
+
+        ### Params:
+        values : dict
+            A snapshot
+
+        ### Returns:
+        out : str
+            The status line text
+        """
+        text = f"rx {values['rx_bytes_per_second'] / 1000:8.1f} kB/s " \
+            f"{values['rx_bytes']:>10} B | tx {values['tx_bytes']:>8} B"
+
+        if ("queue_bytes" in values):
+            full = 100 * values["queue_bytes"] // values["queue_size_bytes"]
+            text += f" | queue {full:3d}% drop {values['dropped_bytes']} " \
+                f"skip {values['skipped_bytes']}"
+
+        p99 = self.render_seconds.quantile(0.99)
+        if (p99 != None):
+            text += f" | render p99 {p99 * 1e3:.2f} ms"
+
+        text += f" | frame err {values['framing_errors']}"
+        if ("overrun_errors" in values):
+            text += f" | uart ovr {values['overrun_errors']} " \
+                f"par {values['parity_errors']} frm {values['frame_errors']}"
+
+        return text + f" | reconnects {values['reconnects']}"
+
+
+def prometheus_text(values: dict) -> str:
+    """
+    Format a snapshot in the Prometheus text exposition format
+
+    ### Params:
+    values : dict
+        A snapshot
+
+    ### Returns:
+    out : str
+        The metrics text
+    """
+    lines = []
+    for name, value in values.items():
+        name = "better_serial_" + name
+        if (isinstance(value, dict)):
+            lines.append(f"# TYPE {name} histogram")
+            for bound, count in value["buckets"].items():
+                lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{name}_sum {value['sum']}")
+            lines.append(f"{name}_count {value['count']}")
+        else:
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+class StatusLine:
+    """
+    A line kept at the bottom of the terminal by shrinking the scroll region
+    so received data scrolls above it
+    """
+    def __init__(self, stream=None):
+        """
+        ### Params:
+        stream = None
+            The terminal stream (default stdout)
+        """
+        self.stream = stream if stream != None else sys.stdout
+        self.shown = False
+
+    def _write(self, text: str):
+        """
+        Write straight to the terminal in one call so it is not split by a
+        frame written at the same time
+        """
+        self.stream.flush()
+        os.write(self.stream.fileno(), text.encode())
+
+    def show(self):
+        """
+        Reserve the bottom row of the terminal
+        """
+        rows = shutil.get_terminal_size().lines
+        self._write(f"\x1b7\x1b[1;{rows - 1}r\x1b8")
+        self.shown = True
+
+    def draw(self, text: str):
+        """
+        Draw the status line, cut to the terminal width
+        """
+        if (not self.shown):
+            self.show()
+
+        size = shutil.get_terminal_size()
+        self._write(f"\x1b7\x1b[{size.lines};1H\x1b[2K\x1b[7m" \
+            f"{text[:size.columns]}\x1b[0m\x1b8")
+
+    def hide(self):
+        """
+        Clear the status line and give the row back to the scroll region
+        """
+        if (not self.shown):
+            return
+
+        rows = shutil.get_terminal_size().lines
+        self._write(f"\x1b7\x1b[r\x1b[{rows};1H\x1b[2K\x1b8")
+        self.shown = False
+
+
+class MetricsReporter(threading.Thread):
+    """
+    Periodically takes snapshots of the metrics to draw the status line and
+    append JSON lines to a file. Can also serve the latest values as
+    Prometheus text over HTTP on localhost.
+    """
+    def __init__(self, metrics: Metrics, status: bool = False,
+        json_path: str = None, http_port: int = None, interval: float = 1.0):
+        """
+        Initialise the reporter
+
+        ### Params:
+        metrics : Metrics
+            The metrics to report
+        status : bool = False
+            Weather to start with the status line shown
+        json_path : str = None
+            The file to append a JSON line to each interval
+        http_port : int = None
+            The localhost port to serve /metrics on
+        interval : float = 1.0
+            The seconds between JSON lines
+        """
+        super().__init__(name="metrics_thread", daemon=True)
+
+        self.metrics = metrics
+        self.status = status
+        self.interval = interval
+        self.status_line = StatusLine()
+
+        self.json_file = None
+        if (json_path != None):
+            self.json_file = open(json_path, "a", buffering=1)
+
+        self.server = None
+        if (http_port != None):
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1",
+                http_port), self._make_handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever,
+                name="metrics_http_thread", daemon=True).start()
+
+        self._lock = threading.Lock()
+        self._stopper = threading.Event()
+
+    def _make_handler(self):
+        """
+        Make the HTTP request handler serving the metrics
+        """
+        reporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if (self.path != "/metrics"):
+                    self.send_error(404)
+                    return
+
+                with reporter._lock:
+                    body = prometheus_text(reporter.metrics.snapshot()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def toggle_status(self, argument: str = ""):
+        """
+        Show or hide the status line (the ::status command)
+        """
+        self.status = not self.status
+        if (not self.status):
+            self.status_line.hide()
+
+    def run(self):
+        """
+        Report until closed
+        """
+        next_json = time.monotonic()
+        while (not self._stopper.wait(min(self.interval, 0.5))):
+            if (not self.status and self.json_file == None):
+                continue
+
+            with self._lock:
+                values = self.metrics.snapshot(rates=True)
+
+            if (self.status):
+                self.status_line.draw(f"{utils.get_time_str()} "
+                    + self.metrics.status_text(values))
+
+            if (self.json_file != None and time.monotonic() >= next_json):
+                values["time"] = time.time()
+                self.json_file.write(json.dumps(values) + "\n")
+                next_json += self.interval
+
+    def close(self):
+        """
+        Stop reporting and put the terminal back
+        """
+        self._stopper.set()
+        self.status_line.hide()
+        if (self.json_file != None):
+            self.json_file.close()
+        if (self.server != None):
+            self.server.shutdown()
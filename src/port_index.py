@@ -0,0 +1,290 @@
+##
+# @file port_index.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-10
+# @brief An index of the serial ports attached to the system used to list
+# them and to pick a port by USB id, serial number or description. On Linux
+# the index is built from /sys/class/tty, cached on disk between runs and
+# only updated for the entries that change.
+
+import collections
+import json
+import os
+import sys
+
+from reconnect import DeviceWatcher, IN_CREATE, IN_DELETE, IN_MOVED_FROM, \
+    IN_MOVED_TO
+
+PortInfo = collections.namedtuple("PortInfo", ["device", "vid", "pid",
+    "serial_number", "manufacturer", "product", "description", "location"])
+
+# The sysfs attributes of a USB device read for each port
+USB_ATTRIBUTES = ["idVendor", "idProduct", "serial", "manufacturer", "product"]
+
+
+def default_cache_path() -> str:
+    """
+    Get the path of the on disk port index cache
+
+    ### Returns:
+    out : str
+        The cache file path
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+        os.path.join(os.path.expanduser("~"), ".cache"))
+
+    return os.path.join(cache_dir, "better-serial", "port-index.json")
+
+
+def read_attribute(path: str) -> str:
+    """
+    Read a sysfs attribute
+
+    ### Returns:
+    out : str
+        The stripped value or None if it does not exist
+    """
+    try:
+        with open(path, "r", errors="replace") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def read_sysfs_port(entry: str, name: str) -> PortInfo:
+    """
+    Read the details of a port from sysfs, walking up from the tty to the
+    USB device it belongs to if there is one
+
+    ### Params:
+    entry : str
+        The /sys/class/tty entry of the port
+    name : str
+        The name of the tty
+
+    ### Returns:
+    out : PortInfo
+        The port details
+    """
+    device = "/dev/" + name
+    directory = os.path.realpath(os.path.join(entry, "device"))
+
+    usb = None
+    while (directory.startswith("/sys/devices/") and usb == None):
+        if (os.path.exists(os.path.join(directory, "idVendor"))):
+            usb = directory
+        directory = os.path.dirname(directory)
+
+    if (usb == None):
+        return PortInfo(device, None, None, None, None, None, name, None)
+
+    vid, pid, serial_number, manufacturer, product = [read_attribute(
+        os.path.join(usb, attribute)) for attribute in USB_ATTRIBUTES]
+
+    interface = read_attribute(os.path.join(os.path.realpath(
+        os.path.join(entry, "device")), "interface"))
+
+    return PortInfo(device, int(vid, 16) if vid else None,
+        int(pid, 16) if pid else None, serial_number, manufacturer, product,
+        interface or product or name, os.path.basename(usb))
+
+
+class PortIndex:
+    """
+    The serial ports attached to the system. On Linux each /sys/class/tty
+    entry is identified by its sysfs link and creation time, so a refresh is
+    one directory scan with a readlink and stat per port and only new or
+    replaced ports have their USB details read. The details are cached on
+    disk so a launch with many adapters attached reads almost nothing, and
+    after the first refresh /dev is watched so later refreshes are skipped
+    until something is plugged in. Other systems use pyserial's list_ports.
+    """
+    def __init__(self, cache_path: str = None,
+        sys_dir: str = "/sys/class/tty"):
+        """
+        Load the index
+
+        ### Params:
+        cache_path : str = None
+            The on disk cache, None uses the default, "" disables it
+        sys_dir : str = "/sys/class/tty"
+            The sysfs tty class directory
+        """
+        self.cache_path = default_cache_path() if cache_path == None \
+            else cache_path
+        self.sys_dir = sys_dir
+        self.use_sysfs = sys.platform.startswith("linux") \
+            and os.path.isdir(sys_dir)
+
+        self.entries = {}
+        self.ports = []
+        self.watcher = None
+        self.reads = 0
+
+        if (self.use_sysfs and self.cache_path):
+            try:
+                with open(self.cache_path, "r") as file:
+                    self.entries = {name: (key, PortInfo(*info))
+                        for name, (key, info) in json.load(file).items()}
+            except (OSError, ValueError, TypeError):
+                self.entries = {}
+
+    def refresh(self) -> list:
+        """
+        Bring the index up to date
+
+        ### Returns:
+        out : list
+            The PortInfo for each port sorted by device
+        """
+        if (not self.use_sysfs):
+            from serial.tools import list_ports
+
+            self.ports = sorted([PortInfo(port.device, port.vid, port.pid,
+                port.serial_number, port.manufacturer, port.product,
+                port.description, port.location)
+                for port in list_ports.comports()])
+            return self.ports
+
+        # Nothing has changed in /dev since the last refresh
+        if (self.watcher != None and self.watcher.poll() == []):
+            return self.ports
+
+        # Watch before scanning so nothing plugged in during the scan is missed
+        if (self.watcher == None):
+            self.watcher = DeviceWatcher("/dev/tty", IN_CREATE | IN_DELETE
+                | IN_MOVED_FROM | IN_MOVED_TO)
+
+        entries = {}
+        changed = False
+        for entry in os.scandir(self.sys_dir):
+            try:
+                target = os.readlink(entry.path)
+                if ("/virtual/" in target or "/serial8250/" in target):
+                    continue
+                key = f"{target}:{os.stat(entry.path).st_ctime_ns}"
+            except OSError: # Removed during the scan
+                continue
+
+            cached = self.entries.get(entry.name)
+            if (cached != None and cached[0] == key):
+                entries[entry.name] = cached
+                continue
+
+            entries[entry.name] = (key, read_sysfs_port(entry.path,
+                entry.name))
+            self.reads += 1
+            changed = True
+
+        if (changed or entries.keys() != self.entries.keys()):
+            self.entries = entries
+            self.save()
+
+        self.ports = sorted(info for _, info in self.entries.values())
+        return self.ports
+
+    def save(self):
+        """
+        Write the index to the on disk cache, failures are ignored as the
+        cache only saves time
+        """
+        if (not self.cache_path):
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path + ".tmp", "w") as file:
+                json.dump({name: (key, info) for name, (key, info)
+                    in self.entries.items()}, file)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError:
+            pass
+
+    def find(self, vid: int = None, pid: int = None,
+        serial_number: str = None, description: str = None) -> list:
+        """
+        Find the ports matching all of the given details
+
+        ### Params:
+        vid : int = None
+            The USB vendor id
+        pid : int = None
+            The USB product id
+        serial_number : str = None
+            The USB serial number
+        description : str = None
+            Text found in the description, product or manufacturer (any case)
+
+        ### Returns:
+        out : list
+            The matching PortInfo sorted by device
+        """
+        matches = []
+        for port in self.refresh():
+            if (vid != None and port.vid != vid):
+                continue
+            if (pid != None and port.pid != pid):
+                continue
+            if (serial_number != None and port.serial_number != serial_number):
+                continue
+            if (description != None and description.lower() not in
+                " ".join(filter(None, (port.description, port.product,
+                port.manufacturer))).lower()):
+                continue
+
+            matches.append(port)
+
+        return matches
+
+    def close(self):
+        """
+        Stop watching for changes
+        """
+        if (self.watcher != None):
+            self.watcher.close()
+            self.watcher = None
+
+
+def parse_vid_pid(text: str) -> tuple:
+    """
+    Parse a USB id given as VID:PID in hex, either part may be left empty
+
+    ### Params:
+    text : str
+        The id e.g. "0403:6001" or "0403:"
+
+    ### Returns:
+    out : tuple
+        The vendor and product id, None where not given
+
+    ### Raises:
+    ValueError
+        If the id is not valid hex
+    """
+    vid, _, pid = text.partition(":")
+
+    return int(vid, 16) if vid else None, int(pid, 16) if pid else None
+
+
+def format_ports(ports: list) -> str:
+    """
+    Format ports as a table for --list
+
+    ### Params:
+    ports : list
+        The PortInfo to list
+
+    ### Returns:
+    out : str
+        The table
+    """
+    rows = [("PORT", "VID:PID", "SERIAL", "DESCRIPTION")]
+    for port in ports:
+        usb_id = "" if port.vid == None else f"{port.vid:04x}:{port.pid or 0:04x}"
+        rows.append((port.device, usb_id, port.serial_number or "",
+            port.description or ""))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+
+    return "\n".join(f"{row[0]:<{widths[0]}}  {row[1]:<{widths[1]}}  " \
+        f"{row[2]:<{widths[2]}}  {row[3]}".rstrip() for row in rows)
@@ -0,0 +1,220 @@
+##
+# @file profiling.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-18
+# @brief Opt in profiling of the receive and transmit hot paths. Timing hooks
+# are only patched in when profiling is enabled so the normal code paths are
+# untouched otherwise. A per stage breakdown (with optional cProfile and
+# tracemalloc results) is written to a file at exit.
+
+import cProfile
+import functools
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from async_engine import AsyncEngine
+from com_rx import ComRxThread, RxPipeline
+from com_tx import ComTxThread
+from merged_output import MergedOutput
+import com_tx
+
+# The stages timed as (name, owner, attribute), render includes decode. The
+# asyncio engine runs on the main thread so its coroutines are covered by the
+# main thread's cProfile profile, only its read and write need timing hooks
+STAGES = [
+    ("read", ComRxThread, "read_chunk"),
+    ("read", AsyncEngine, "read_chunk"),
+    ("record", RxPipeline, "record"),
+    ("render", RxPipeline, "present"),
+    ("decode", RxPipeline, "render"),
+    ("flush", MergedOutput, "flush"),
+    ("encode", com_tx, "convert_to_bytes"),
+    ("write", ComTxThread, "send"),
+    ("write", AsyncEngine, "send"),
+]
+
+# Thread entry points profiled with cProfile
+THREAD_ENTRIES = [(ComRxThread, "run"), (ComRxThread, "render_loop"),
+    (ComTxThread, "run")]
+
+
+class StageTimes:
+    """
+    The call count, total and longest time of one stage. Only updated by the
+    thread running the stage so no lock is needed.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+
+class Profiler:
+    """
+    Patches timing hooks around the hot path stages and collects the results
+    """
+    def __init__(self, path: str, python: bool = False, memory: bool = False):
+        """
+        Initialise the profiler, nothing is patched until install
+
+        ### Params:
+        path : str
+            The file to write the report to at exit
+        python : bool = False
+            Also run cProfile on the serial threads and the main thread
+        memory : bool = False
+            Also trace allocations with tracemalloc
+        """
+        self.path = path
+        self.python = python
+        self.memory = memory
+
+        self.stages = {name: StageTimes() for name, _, _ in STAGES}
+        self.profiles = []
+        self._profiles_lock = threading.Lock()
+        self._originals = []
+        self._started = None
+        self._written = False
+
+    def _timed(self, func, stage: StageTimes):
+        """
+        Wrap a function to add its run time to a stage
+        """
+        clock = time.perf_counter_ns
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                stage.calls += 1
+                stage.total_ns += elapsed
+                if (elapsed > stage.max_ns):
+                    stage.max_ns = elapsed
+
+        return timed
+
+    def _profiled(self, func):
+        """
+        Wrap a thread entry point to run it under its own cProfile profile
+        """
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            with self._profiles_lock:
+                self.profiles.append(profile)
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+
+        return profiled
+
+    def _patch(self, owner, attribute: str, wrapper):
+        """
+        Replace an attribute, and any module level copies of a function
+        imported with from ... import
+        """
+        original = getattr(owner, attribute)
+        patched = wrapper(original)
+
+        targets = [owner]
+        if (not isinstance(owner, type)):
+            targets += [module for module in list(sys.modules.values())
+                if module is not owner
+                and getattr(module, attribute, None) is original]
+
+        for target in targets:
+            setattr(target, attribute, patched)
+            self._originals.append((target, attribute, original))
+
+    def install(self):
+        """
+        Start profiling
+        """
+        self._started = time.monotonic()
+
+        for name, owner, attribute in STAGES:
+            self._patch(owner, attribute,
+                lambda func, stage=self.stages[name]: self._timed(func, stage))
+
+        if (self.python):
+            for owner, attribute in THREAD_ENTRIES:
+                self._patch(owner, attribute, self._profiled)
+
+            self._main_profile = cProfile.Profile()
+            self.profiles.append(self._main_profile)
+            self._main_profile.enable()
+
+        if (self.memory):
+            tracemalloc.start(10)
+
+    def uninstall(self):
+        """
+        Put the original functions back
+        """
+        for target, attribute, original in reversed(self._originals):
+            setattr(target, attribute, original)
+        self._originals = []
+
+    def report(self) -> str:
+        """
+        Format the results
+
+        ### Returns:
+        out : str
+            The report text
+        """
+        elapsed = time.monotonic() - self._started
+        lines = [f"better-serial profile over {elapsed:.3f} s", "",
+            f"{'stage':<8} {'calls':>10} {'total ms':>12} {'mean us':>10} " \
+            f"{'max us':>10} {'% of run':>9}"]
+
+        for name, stage in self.stages.items():
+            mean = stage.total_ns / stage.calls / 1e3 if stage.calls else 0
+            lines.append(f"{name:<8} {stage.calls:>10} " \
+                f"{stage.total_ns / 1e6:>12.3f} {mean:>10.2f} " \
+                f"{stage.max_ns / 1e3:>10.1f} " \
+                f"{100 * stage.total_ns / 1e9 / elapsed:>8.2f}%")
+        lines.append("(read includes waiting for data with the threaded " \
+            "engine, render includes decode)")
+
+        if (self.memory and tracemalloc.is_tracing()):
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines += ["", f"tracemalloc: {current / 1e6:.2f} MB current, " \
+                f"{peak / 1e6:.2f} MB peak, top allocations by line"]
+            for stat in snapshot.statistics("lineno")[:20]:
+                lines.append(str(stat))
+
+        if (self.python and self.profiles):
+            self._main_profile.disable()
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiles[0], stream=stream)
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.path + ".pstats")
+            stats.sort_stats("cumulative").print_stats(30)
+            lines += ["", f"cProfile (all threads, also in {self.path}.pstats)",
+                stream.getvalue()]
+
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Write the report to the file, run as an exit handler
+        """
+        if (self._written):
+            return
+        self._written = True
+
+        with open(self.path, "w") as file:
+            file.write(self.report())
@@ -0,0 +1,352 @@
+##
+# @file reconnect.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-08
+# @brief Opens a serial port and reopens it when it is lost. While the port
+# is missing the supervisor sleeps on inotify events for the device
+# directory (Linux) or polls with exponential backoff, rather than spinning.
+
+import asyncio
+import os
+import select
+import struct
+import sys
+import time
+import serial
+
+import utils
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class DeviceWatcher:
+    """
+    Waits for entries to be created or changed in the directory holding a
+    device, e.g. /dev/ttyUSB0 appearing or udev fixing its permissions. On
+    systems without inotify the wait is a plain sleep.
+    """
+    def __init__(self, path: str,
+        mask: int = IN_CREATE | IN_ATTRIB | IN_MOVED_TO):
+        """
+        Start watching the directory of a device
+
+        ### Params:
+        path : str
+            The device path, the nearest existing directory above it is
+            watched
+        mask : int = IN_CREATE | IN_ATTRIB | IN_MOVED_TO
+            The inotify events to wake on
+        """
+        self.name = os.path.basename(path)
+        self.fd = None
+
+        if (not sys.platform.startswith("linux")):
+            return
+
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+
+        if (fd < 0):
+            return
+
+        # /dev/serial/by-id only exists while a device is attached
+        directory = os.path.dirname(os.path.abspath(path))
+        while (not os.path.isdir(directory)):
+            directory = os.path.dirname(directory)
+
+        if (libc.inotify_add_watch(fd, directory.encode(), mask) < 0):
+            os.close(fd)
+            return
+
+        self.fd = fd
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait for a change in the watched directory
+
+        ### Params:
+        timeout : float
+            The longest time to wait
+
+        ### Returns:
+        out : bool
+            True if the device itself was created or changed
+        """
+        if (self.fd == None):
+            time.sleep(timeout)
+            return False
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if (not ready):
+            return False
+
+        return self.name in self._read_names()
+
+    def poll(self) -> list:
+        """
+        Collect the events since the last wait or poll without blocking
+
+        ### Returns:
+        out : list
+            The names of the entries that changed, None without inotify
+        """
+        if (self.fd == None):
+            return None
+
+        return self._read_names()
+
+    def _read_names(self) -> list:
+        """
+        Read all pending events
+
+        ### Returns:
+        out : list
+            The names of the entries the events were for
+        """
+        names = []
+        while (True):
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return names
+
+            offset = 0
+            while (offset + INOTIFY_EVENT.size <= len(data)):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                names.append(data[offset:offset + length].rstrip(b"\0") \
+                    .decode(errors="replace"))
+                offset += length
+
+    def close(self):
+        """
+        Stop watching
+        """
+        if (self.fd != None):
+            os.close(self.fd)
+            self.fd = None
+
+
+class PortSupervisor:
+    """
+    Opens a serial port, waiting for it to appear if it is missing. It is
+    kept for the whole session so each reopen after a lost connection can
+    report how long the port was down and how quickly it was reopened once
+    the device came back.
+    """
+    def __init__(self, port: str, baud: int, data: int, parity: str,
+        stop: int, timeout: float, flow: str = "none",
+        initial_delay: float = 0.01, max_delay: float = 1.0, resolve=None):
+        """
+        Initialise the supervisor
+
+        ### Params:
+        port : str
+            The serial port to open
+        baud : int
+            The baud rate
+        data : int
+            The number of data bits
+        parity : str
+            The parity (Y or N)
+        stop : int
+            The number of stop bits
+        timeout : float
+            The time to wait before timing out on a serial read
+        flow : str = "none"
+            The flow control to use (none, rtscts or xonxoff)
+        initial_delay : float = 0.01
+            The first retry delay, doubled on each failed open
+        max_delay : float = 1.0
+            The longest retry delay
+        resolve = None
+            Callable returning the device to open (e.g. found by serial 
+            number, so it may change name when replugged) or None if it is
+            not attached. Called before each attempt when given.
+        """
+        self.port = port
+        self.baud = baud
+        self.data = data
+        self.parity = parity
+        self.stop = stop
+        self.timeout = timeout
+        self.flow = flow
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.resolve = resolve
+
+        self.opened_before = False
+        self.reconnects = 0
+        self.reconnect_latencies = []
+
+    def try_open(self) -> serial.Serial:
+        """
+        Try to open the port once
+
+        ### Returns:
+        out : serial.Serial
+            The opened serial port
+
+        ### Raises:
+        serial.SerialException
+            If the port could not be opened
+        """
+        return serial.Serial(port=self.port, baudrate=self.baud,
+            bytesize=self.data, parity=self.parity, stopbits=self.stop,
+            timeout=self.timeout, rtscts=(self.flow == "rtscts"),
+            xonxoff=(self.flow == "xonxoff"))
+
+    def attempt(self) -> serial.Serial:
+        """
+        Look up the device (if it is resolved) and try to open it once
+
+        ### Returns:
+        out : serial.Serial
+            The opened serial port or None if it could not be opened
+        """
+        device = self.port
+        if (self.resolve != None):
+            device = self.resolve()
+
+        if (device == None):
+            return None
+
+        self.port = device
+        try:
+            return self.try_open()
+        except serial.SerialException:
+            return None
+
+    async def open_async(self) -> serial.Serial:
+        """
+        Reopen the port from an event loop, retrying with exponential backoff
+        without blocking the loop. Used by the asyncio engine so one of 
+        several ports can be reopened while the others keep running.
+
+        ### Returns:
+        out : serial.Serial
+            The opened serial port
+        """
+        lost = time.monotonic()
+        delay = self.initial_delay
+
+        while (True):
+            serial_port = self.attempt()
+            if (serial_port != None):
+                break
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+        if (self.opened_before):
+            self.report_reconnect(lost, None)
+        else:
+            print(f"{utils.get_time_str()} Opened {self.port}\r")
+        self.opened_before = True
+
+        return serial_port
+
+    def open_present(self) -> serial.Serial:
+        """
+        Open the port if it is present without waiting for it. Used when
+        monitoring several ports so a missing one does not hold up the
+        others, it is opened later by open_async.
+
+        ### Returns:
+        out : serial.Serial
+            The opened serial port or None if it is not present
+        """
+        serial_port = self.attempt()
+        if (serial_port == None):
+            print(f"{utils.get_time_str()} {self.port} is not connected, " \
+                "waiting for it\r")
+            return None
+
+        self.opened_before = True
+        print(f"{utils.get_time_str()} Serial monitor started on {self.port}: " \
+            f"{self.data}, {self.stop}, {self.baud}, {self.parity}")
+
+        return serial_port
+
+    def open(self) -> serial.Serial:
+        """
+        Open the port, waiting until it is available. Ctrl+C while waiting
+        exits the application.
+
+        ### Returns:
+        out : serial.Serial
+            The opened serial port
+        """
+        lost = time.monotonic()
+        appeared = None
+        watcher = None
+        delay = self.initial_delay
+
+        try:
+            while (True):
+                serial_port = self.attempt()
+                if (serial_port != None):
+                    break
+
+                if (watcher == None):
+                    print(f"{utils.get_time_str()} Serial port waiting to " \
+                        "open (Check settings if connected) \r")
+                    watcher = DeviceWatcher(self.port)
+
+                if (watcher.wait(delay)):
+                    if (appeared == None):
+                        appeared = time.monotonic()
+                    delay = self.initial_delay # Retry quickly while udev works
+                else:
+                    delay = min(delay * 2, self.max_delay)
+        except KeyboardInterrupt:
+            print()
+            utils.exit_app(0)
+        finally:
+            if (watcher != None):
+                watcher.close()
+
+        if (self.opened_before):
+            self.report_reconnect(lost, appeared)
+
+        self.opened_before = True
+        print(f"{utils.get_time_str()} Serial monitor started: {self.data}, " \
+            f"{self.stop}, {self.baud}, {self.parity}")
+
+        return serial_port
+
+    def report_reconnect(self, lost: float, appeared: float):
+        """
+        Print how long the port was down and the reconnect latency
+
+        ### Params:
+        lost : float
+            The monotonic time the reopen started
+        appeared : float
+            The monotonic time the device was seen to appear, None if it was
+            not seen
+        """
+        now = time.monotonic()
+        self.reconnects += 1
+
+        message = f"{utils.get_time_str()} Reconnected to {self.port} after " \
+            f"{now - lost:.3f} s"
+        if (appeared != None):
+            self.reconnect_latencies.append(now - appeared)
+            message += f" ({(now - appeared) * 1000:.1f} ms after it appeared)"
+
+        print(message + "\r")
@@ -0,0 +1,366 @@
+##
+# @file render.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-02
+# @brief Converts chunks of received bytes into the text printed to the
+# terminal
+
+import codecs
+import string
+
+# The bytes that are printed as is when displaying non printable chars
+PRINTABLE_BYTES = bytes(string.printable, 'ascii')
+
+def _build_npc_table() -> list:
+    """
+    Build the 256 entry table mapping each byte value to the text it is
+    displayed as. Printable chars map to themselves and everything else maps
+    to its python bytes repr (e.g. b'\\x00').
+
+    ### Returns:
+    out : list
+        The table indexed by byte value
+    """
+    table = []
+    for value in range(256):
+        if (value in PRINTABLE_BYTES):
+            table.append(chr(value))
+        else:
+            table.append(repr(bytes((value,))))
+
+    return table
+
+NPC_TABLE = _build_npc_table()
+
+# The table at the bytes level. Each byte's text (all ascii) is padded to a
+# fixed width with a filler byte that never appears in the text, and split
+# into one bytes.translate table per position so a whole chunk can be laid
+# out in slots and the filler deleted afterwards.
+NPC_FILLER = b"\xff"
+NPC_WIDTH = max(map(len, NPC_TABLE))
+NPC_SLOT_TABLES = [bytes(ord(text[i]) if i < len(text) else NPC_FILLER[0]
+    for text in NPC_TABLE) for i in range(NPC_WIDTH)]
+
+
+def render_npc(chunk: bytes) -> str:
+    """
+    Render a chunk of bytes with the non printable chars shown as their bytes
+    repr. The work is done at the bytes level in a fixed number of passes 
+    over the chunk, each byte's text is written into a fixed width slot a
+    position at a time, the filler is deleted and the result decoded once.
+
+    ### Params:
+    chunk : bytes
+        The bytes to render
+
+    ### Returns:
+    out : str
+        The text to display
+    """
+    # bytes.translate is much faster than any check that works on a view
+    if (not isinstance(chunk, bytes)):
+        chunk = bytes(chunk)
+
+    # Fast path when everything is printable
+    if (not chunk.translate(None, PRINTABLE_BYTES)):
+        return chunk.decode('ascii')
+
+    slots = bytearray(len(chunk) * NPC_WIDTH)
+    for position, table in enumerate(NPC_SLOT_TABLES):
+        slots[position::NPC_WIDTH] = chunk.translate(table)
+
+    return slots.translate(None, NPC_FILLER).decode('ascii')
+
+
+# The text encodings received data can be decoded as
+ENCODINGS = ["utf-8", "latin-1", "cp437"]
+
+
+def _hex_errors(error: UnicodeDecodeError) -> tuple:
+    """
+    Codec error handler showing each undecodable byte as <xx>
+    """
+    return "".join(f"<{value:02x}>" for value in 
+        error.object[error.start:error.end]), error.end
+
+codecs.register_error("better-serial-hex", _hex_errors)
+
+# The policies for bytes that are not valid in the encoding mapped to the
+# codec error handler used
+DECODE_ERRORS = {"replace": "replace", "escape": "backslashreplace", 
+    "hex": "better-serial-hex"}
+
+
+class StreamDecoder:
+    """
+    Decodes received chunks as text. An incremental decoder holds the start
+    of a character split across reads until the rest arrives so nothing is
+    decoded a byte at a time, and invalid bytes are handled by the error
+    policy rather than raising.
+    """
+    def __init__(self, encoding: str = "utf-8", errors: str = "replace"):
+        """
+        Initialise the decoder
+
+        ### Params:
+        encoding : str = "utf-8"
+            The encoding, one of ENCODINGS
+        errors : str = "replace"
+            What to show for invalid bytes, one of DECODE_ERRORS
+        """
+        if (errors not in DECODE_ERRORS):
+            raise ValueError(f"unknown decode error policy {errors}")
+
+        self.encoding = encoding
+        self.errors = DECODE_ERRORS[errors]
+        self.decoder = codecs.getincrementaldecoder(encoding)(self.errors)
+
+        # Only utf-8 can leave part of a character in the decoder
+        self._stateful = codecs.lookup(encoding).name == "utf-8"
+
+    def decode(self, chunk: bytes, final: bool = False) -> str:
+        """
+        Decode a chunk, the start of a character cut off at the end is kept
+        for the next chunk
+
+        ### Params:
+        chunk : bytes
+            The received bytes
+        final : bool = False
+            Decode anything held back as well (e.g. at the end of a packet)
+
+        ### Returns:
+        out : str
+            The decoded text
+        """
+        if (not self._stateful):
+            return str(chunk, self.encoding, self.errors)
+
+        if (final or self.decoder.getstate()[0]):
+            return self.decoder.decode(chunk, final)
+
+        # Nothing held back so decode in place (views are not copied) and
+        # only hand a cut off character to the decoder
+        text, used = codecs.utf_8_decode(chunk, self.errors, False)
+        if (used < len(chunk)):
+            self.decoder.setstate((bytes(chunk[used:]), 0))
+
+        return text
+
+    def reset(self):
+        """
+        Throw away anything held back
+        """
+        self.decoder.reset()
+
+
+# The number of bytes shown on each row of the numerical output formats
+DUMP_ROW_WIDTHS = {"hex": 16, "dec": 16, "bin": 8, "ascii+hex": 16}
+
+DEC_TABLE = [f"{value:3d}" for value in range(256)]
+BIN_TABLE = [f"{value:08b}" for value in range(256)]
+
+# Printable chars excluding whitespace appear in the ascii gutter, the rest
+# are replaced by '.'
+GUTTER_TABLE = [chr(value) if (32 <= value < 127) else "." 
+    for value in range(256)]
+GUTTER_BYTES = bytes(map(ord, GUTTER_TABLE))
+
+
+def _digit_tables(table: list) -> list:
+    """
+    Split a table of the text of each byte value into one bytes.translate
+    table per character, e.g. the hundreds, tens and ones digits in dec
+
+    ### Params:
+    table : list
+        The text of each byte value, all the same length
+
+    ### Returns:
+    out : list
+        The translate tables for each character in order
+    """
+    return [bytes(ord(text[i]) for text in table) 
+        for i in range(len(table[0]))]
+
+DIGIT_TABLES = {"hex": _digit_tables([f"{value:02x}" for value in range(256)]),
+    "dec": _digit_tables(DEC_TABLE), "bin": _digit_tables(BIN_TABLE)}
+DIGIT_TABLES["ascii+hex"] = DIGIT_TABLES["hex"]
+
+
+class DumpFormatter:
+    """
+    Formats received bytes as fixed width rows of numbers with the offset of
+    the first byte at the start of each row. The offset is kept between
+    chunks so that a stream of chunks reads as one continuous dump.
+
+    Whole rows are not formatted one at a time, the rows of a chunk are laid
+    out in a single buffer of blank rows and each character column is filled
+    for every row at once by a strided slice assignment from the chunk 
+    translated through a table. The work per chunk is a fixed number of C
+    level passes and there are no objects per row or byte.
+    """
+    def __init__(self, format: str = "hex"):
+        """
+        Initialise the formatter
+
+        ### Params:
+        format : str = "hex"
+            The output format one of hex, dec, bin or ascii+hex
+        """
+        if (format not in DUMP_ROW_WIDTHS):
+            raise ValueError(f"unknown dump format {format}")
+
+        self.format = format
+        self.width = DUMP_ROW_WIDTHS[format]
+        self.offset = 0
+
+        self._digits = DIGIT_TABLES[format]
+        self._cell = len(self._digits) + 1 # The characters for each byte
+        self._column_width = self.width * self._cell - 1
+
+        # A blank row, the offset and columns start 10 characters in and the
+        # ascii gutter follows the columns
+        row = f"{'':{self._column_width + 10}}"
+        self._gutter = None
+        if (format == "ascii+hex"):
+            self._gutter = len(row) + 3
+            row += f"  |{'':{self.width}}|"
+        self._blank_row = bytearray(row + "\n", "ascii")
+
+        # The low 4 hex digits of the row offsets repeat every 64 KiB
+        self._low_offsets = "".join(f"{offset:04x}" 
+            for offset in range(0, 0x10000, self.width)).encode()
+
+    def format_row(self, row: bytes) -> str:
+        """
+        Format the numerical columns for a single row
+
+        ### Params:
+        row : bytes
+            The bytes in the row (at most one row width)
+
+        ### Returns:
+        out : str
+            The formatted columns
+        """
+        if (self.format == "dec"):
+            columns = " ".join(map(DEC_TABLE.__getitem__, row))
+        elif (self.format == "bin"):
+            columns = " ".join(map(BIN_TABLE.__getitem__, row))
+        else:
+            columns = row.hex(" ")
+
+        return columns
+
+    def render_row(self, row: bytes) -> str:
+        """
+        Render a single, possibly short, row. A row continuing one the last
+        chunk ended part way through is shown against the row's offset with
+        its bytes in their own columns, so streamed reads stay aligned.
+
+        ### Params:
+        row : bytes
+            The bytes in the row (at most up to the end of the current row)
+
+        ### Returns:
+        out : str
+            The rendered row ending in a new line
+        """
+        lead = self.offset % self.width
+        line = f"{self.offset - lead:08x}  {'':{lead * self._cell}}" \
+            f"{self.format_row(row)}"
+        if (self.format == "ascii+hex"): # Pad so the gutter lines up
+            line = line.ljust(self._column_width + 10) + "  |" + " " * lead \
+                + str(row, 'latin-1').translate(GUTTER_TABLE) + "|"
+
+        self.offset += len(row)
+        return line + "\n"
+
+    def render_rows(self, data: bytes) -> str:
+        """
+        Render whole rows starting at a row boundary
+
+        ### Params:
+        data : bytes
+            The bytes to render, a whole number of rows
+
+        ### Returns:
+        out : str
+            The rendered rows each ending in a new line
+        """
+        width = self.width
+        rows = len(data) // width
+        row_length = len(self._blank_row)
+        output = self._blank_row * rows
+
+        # The offsets are filled in a digit at a time, the high 4 digits are
+        # the same for each run of rows in a 64 KiB block and the low 4 are
+        # taken from the table
+        high = []
+        low = []
+        period = len(self._low_offsets) // 4
+        row = 0
+        while (row < rows):
+            offset = self.offset + row * width
+            first = (offset & 0xFFFF) // width
+            run = min(period - first, rows - row)
+            high.append(f"{offset >> 16:04x}".encode() * run)
+            low.append(self._low_offsets[first * 4:(first + run) * 4])
+            row += run
+
+        high = b"".join(high)
+        low = b"".join(low)
+        for i in range(4):
+            output[i::row_length] = high[i::4]
+            output[4 + i::row_length] = low[i::4]
+
+        for digit, table in enumerate(self._digits):
+            text = data.translate(table)
+            for column in range(width):
+                output[10 + column * self._cell + digit::row_length] = \
+                    text[column::width]
+
+        if (self._gutter != None):
+            text = data.translate(GUTTER_BYTES)
+            for column in range(width):
+                output[self._gutter + column::row_length] = text[column::width]
+
+        self.offset += len(data)
+        return output.decode("ascii")
+
+    def render(self, chunk: bytes) -> str:
+        """
+        Render a chunk as rows. If the previous chunk ended part way through
+        a row the first row continues it from the same column so that all
+        the rows stay aligned to the row width.
+
+        ### Params:
+        chunk : bytes
+            The bytes to render
+
+        ### Returns:
+        out : str
+            The rendered rows each ending in a new line
+        """
+        output = []
+        start = 0
+        length = len(chunk)
+
+        # Finish the row the last chunk ended part way through
+        if (self.offset % self.width and length):
+            start = min(self.width - self.offset % self.width, length)
+            output.append(self.render_row(chunk[:start]))
+
+        end = start + (length - start) // self.width * self.width
+        if (end > start and self.offset + end - start <= 0xFFFFFFFF):
+            output.append(self.render_rows(bytes(chunk[start:end])))
+            start = end
+
+        # The last short row and rows past 4 GiB which need more digits
+        while (start < length):
+            end = start + self.width - (self.offset % self.width)
+            output.append(self.render_row(chunk[start:end]))
+            start = end
+
+        return "".join(output)
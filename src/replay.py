@@ -0,0 +1,168 @@
+##
+# @file replay.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-08-24
+# @brief A stand in for serial.Serial that plays back a capture file through
+# the receive pipeline
+
+import time
+import serial
+
+from capture import CaptureReader, CAPTURE_MAGIC, RX
+
+
+class ReplaySerial:
+    """
+    Plays back a capture as if it were a serial port. Record captures can be
+    played back at their recorded timing (scaled by speed) or as fast as
+    possible, raw captures are always played as fast as possible. The
+    capture is streamed from disk so memory use does not depend on its size.
+    Writes are discarded. Once the capture is finished reads raise
+    serial.SerialException like an unplugged port.
+    """
+    def __init__(self, path: str, speed: float = 0, timeout: float = 0.5,
+        raw_chunk_size: int = 65536):
+        """
+        Open the capture for replay
+
+        ### Params:
+        path : str
+            The capture file to replay
+        speed : float = 0
+            The playback speed relative to the recording, 0 plays as fast as
+            possible
+        timeout : float = 0.5
+            The longest time a read waits for data
+        raw_chunk_size : int = 65536
+            The size of the chunks a raw capture is read in
+        """
+        self.name = path
+        self.speed = speed
+        self.timeout = timeout
+        self.raw_chunk_size = raw_chunk_size
+
+        self.bytes_read = 0
+        self.finished = False
+        self.started = None
+
+        with open(path, "rb") as file:
+            is_records = file.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+        self._reader = None
+        if (is_records):
+            self._reader = CaptureReader(path)
+            self._chunks = self._record_chunks()
+        else:
+            self.speed = 0
+            self._chunks = self._raw_chunks()
+
+        self._pending = b""
+        self._offset = 0
+        self._pending_time = 0.0
+        self._next_chunk()
+
+    def _record_chunks(self):
+        """
+        Generator of (time stamp, data) for the received records
+        """
+        for record in self._reader:
+            if (record.direction == RX):
+                yield record.timestamp, bytes(record.data)
+
+    def _raw_chunks(self):
+        """
+        Generator of (0, data) for a raw capture read in fixed size chunks
+        """
+        with open(self.name, "rb") as file:
+            while (True):
+                data = file.read(self.raw_chunk_size)
+                if (data == b""):
+                    return
+                yield 0.0, data
+
+    def _next_chunk(self):
+        """
+        Load the next chunk from the capture
+        """
+        self._offset = 0
+        try:
+            self._pending_time, self._pending = next(self._chunks)
+        except StopIteration:
+            self._pending = b""
+            self.finished = True
+
+    def _due_in(self) -> float:
+        """
+        Get the time until the pending chunk should be delivered
+
+        ### Returns:
+        out : float
+            The seconds to wait, 0 or less if it is due
+        """
+        if (self.speed == 0):
+            return 0
+
+        if (self.started == None):
+            self.started = time.monotonic() - self._pending_time / self.speed
+
+        return self.started + self._pending_time / self.speed \
+            - time.monotonic()
+
+    @property
+    def in_waiting(self) -> int:
+        """
+        The number of bytes that are due to be read
+        """
+        if (self.finished or self._due_in() > 0):
+            return 0
+
+        return len(self._pending) - self._offset
+
+    def read(self, size: int = 1) -> bytes:
+        """
+        Read up to size bytes, waiting up to the timeout for the next chunk to
+        be due
+
+        ### Params:
+        size : int = 1
+            The most bytes to read
+
+        ### Returns:
+        out : bytes
+            The bytes read, empty on a timeout
+        """
+        if (self.finished):
+            raise serial.SerialException("replay finished")
+
+        wait = self._due_in()
+        if (wait > 0):
+            time.sleep(min(wait, self.timeout))
+            if (wait > self.timeout):
+                return b""
+
+        data = self._pending[self._offset:self._offset + size]
+        self._offset += len(data)
+        self.bytes_read += len(data)
+
+        if (self._offset == len(self._pending)):
+            self._next_chunk()
+
+        return data
+
+    def write(self, data: bytes) -> int:
+        """
+        Discard data written to the replay
+
+        ### Returns:
+        out : int
+            The number of bytes "written"
+        """
+        return len(data)
+
+    def close(self):
+        """
+        Close the capture
+        """
+        self._chunks.close()
+        if (self._reader != None):
+            self._reader.close()
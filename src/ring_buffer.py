@@ -0,0 +1,295 @@
+##
+# @file ring_buffer.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-12
+# @brief A single producer, single consumer byte ring used to pass received
+# data from the serial reader to the renderer so a slow terminal never stops
+# the port being drained
+
+import collections
+import threading
+
+# What the reader does when the renderer has fallen a whole ring behind
+RING_POLICIES = ["block", "drop-oldest", "coalesce"]
+
+
+class RingBuffer:
+    """
+    A preallocated byte ring with one writer (the serial reader) and one
+    reader (the renderer). Each side only ever moves its own position so the
+    data path needs no lock, events are only used to sleep when there is
+    nothing to do. Positions count all bytes ever written or read, the ring
+    offset is the position modulo the size.
+
+    When the ring is full the policy decides what happens to new data:
+        block       the writer waits for space (nothing is lost but the port
+                    is not drained while waiting)
+        drop-oldest the writer overwrites the oldest unread data
+        coalesce    new data is dropped and each run of dropped bytes is
+                    reported once, in order, as a single gap
+    """
+    def __init__(self, size: int = 1024 * 1024, policy: str = "block"):
+        """
+        Allocate the ring
+
+        ### Params:
+        size : int = 1024 * 1024
+            The ring size in bytes
+        policy : str = "block"
+            The overflow policy, one of RING_POLICIES
+        """
+        if (policy not in RING_POLICIES):
+            raise ValueError(f"unknown ring policy {policy}")
+
+        self.size = size
+        self.policy = policy
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+        self.write_pos = 0 # Only moved by the writer
+        self.read_pos = 0 # Only moved by the reader
+        self.closed = False
+
+        # Drop-oldest: the end of the write in progress, data before
+        # reserve_pos - size may be overwritten at any time
+        self._reserve_pos = 0
+
+        # Coalesce: gaps as (position, bytes dropped), the open gap is only
+        # published once the writer has room again
+        self._gaps = collections.deque()
+        self._open_gap = 0
+
+        self.dropped = 0
+        self.overruns = 0
+        self.blocked = 0
+        self.high_water = 0
+
+        # Each side only sets the other's event if it is not already set, as
+        # setting an event is far slower than checking it
+        self._readable = threading.Event()
+        self._writable = threading.Event()
+
+    def free(self) -> int:
+        """
+        Get the space left in the ring
+
+        ### Returns:
+        out : int
+            The number of bytes that can be written without overflowing
+        """
+        return self.size - (self.write_pos - self.read_pos)
+
+    def _copy_in(self, data: memoryview):
+        """
+        Copy data into the ring at the write position and publish it
+        """
+        length = len(data)
+        start = self.write_pos % self.size
+        end = start + length
+        self._reserve_pos = self.write_pos + length
+
+        if (end <= self.size):
+            self.view[start:end] = data
+        else:
+            split = self.size - start
+            self.view[start:] = data[:split]
+            self.view[:end - self.size] = data[split:]
+
+        self.write_pos += length
+        self.high_water = max(self.high_water,
+            min(self.write_pos - self.read_pos, self.size))
+
+    def put(self, data: bytes):
+        """
+        Add received data, applying the overflow policy if the ring is full
+
+        ### Params:
+        data : bytes
+            The received bytes
+        """
+        data = memoryview(data)
+
+        if (self.policy == "block"):
+            while (len(data) and not self.closed):
+                free = self.free()
+                if (free == 0):
+                    self.blocked += 1
+                    self._writable.clear()
+                    if (self.free() == 0): # Recheck after clear to not miss a get
+                        self._writable.wait(0.1)
+                    continue
+
+                self._copy_in(data[:free])
+                data = data[free:]
+                if (not self._readable.is_set()):
+                    self._readable.set()
+
+        elif (self.policy == "drop-oldest"):
+            if (len(data) > self.size): # Only the newest ring full can be kept
+                skip = len(data) - self.size
+                self._reserve_pos = self.write_pos + len(data)
+                self.write_pos += skip
+                data = data[skip:]
+
+            self._copy_in(data)
+
+        else:
+            free = self.free()
+            if (free and self._open_gap):
+                self._gaps.append((self.write_pos, self._open_gap))
+                self._open_gap = 0
+
+            if (free < len(data)):
+                self._open_gap += len(data) - free
+                data = data[:free]
+
+            if (len(data)):
+                self._copy_in(data)
+
+        if (not self._readable.is_set()):
+            self._readable.set()
+
+    def get(self, timeout: float = None, max_size: int = 65536) -> tuple:
+        """
+        Take the oldest unread data
+
+        ### Params:
+        timeout : float = None
+            The longest time to wait for data
+        max_size : int = 65536
+            The most bytes to take at once
+
+        ### Returns:
+        out : tuple
+            The data and the number of bytes lost just before it, (b"", 0)
+            on a timeout or None once the ring is closed and empty
+        """
+        buffer = bytearray(max_size)
+        item = self.get_into(buffer, timeout)
+        if (item == None):
+            return None
+
+        length, dropped = item
+        return bytes(buffer[:length]), dropped
+
+    def get_into(self, buffer, timeout: float = None) -> tuple:
+        """
+        Copy the oldest unread data into a buffer, so the reader can reuse one
+        buffer rather than allocating for each read
+
+        ### Params:
+        buffer : bytearray | memoryview
+            The buffer to fill, at most its length is taken at once
+        timeout : float = None
+            The longest time to wait for data
+
+        ### Returns:
+        out : tuple
+            The number of bytes copied to the start of the buffer and the
+            number of bytes lost just before them, (0, 0) on a timeout or 
+            None once the ring is closed and empty
+        """
+        while (self.write_pos == self.read_pos
+            and not (self._gaps and self._gaps[0][0] == self.read_pos)):
+            if (self.closed):
+                return None
+
+            self._readable.clear()
+            if (self.write_pos == self.read_pos and not self.closed
+                and not self._gaps):
+                if (not self._readable.wait(timeout)):
+                    return 0, 0
+
+        read_pos = self.read_pos
+        write_pos = self.write_pos
+        dropped = 0
+
+        if (self.policy == "drop-oldest"):
+            oldest = self._reserve_pos - self.size
+            if (read_pos < oldest):
+                dropped = oldest - read_pos
+                read_pos = oldest
+        elif (self.policy == "coalesce"):
+            if (self._gaps and self._gaps[0][0] == read_pos):
+                dropped = self._gaps.popleft()[1]
+            if (self._gaps):
+                write_pos = min(write_pos, self._gaps[0][0])
+
+        write_pos = min(write_pos, read_pos + len(buffer))
+        start = read_pos % self.size
+        end = start + (write_pos - read_pos)
+        length = write_pos - read_pos
+
+        if (end <= self.size):
+            buffer[:length] = self.view[start:end]
+        else:
+            split = self.size - start
+            buffer[:split] = self.view[start:]
+            buffer[split:length] = self.view[:end - self.size]
+
+        # Anything overwritten while it was being copied is lost as well
+        if (self.policy == "drop-oldest"):
+            oldest = self._reserve_pos - self.size
+            if (read_pos < oldest):
+                lost = min(oldest, write_pos) - read_pos
+                length -= lost
+                buffer[:length] = buffer[lost:lost + length]
+                dropped += lost
+                write_pos = max(write_pos, oldest)
+
+        self.read_pos = write_pos
+        if (not self._writable.is_set()):
+            self._writable.set()
+
+        if (dropped):
+            self.dropped += dropped
+            self.overruns += 1
+
+        return length, dropped
+
+    def waiting(self) -> int:
+        """
+        Get the amount of unread data
+
+        ### Returns:
+        out : int
+            The number of bytes waiting to be read
+        """
+        return min(self.write_pos - self.read_pos, self.size)
+
+    def skip(self, keep: int = 0) -> int:
+        """
+        Throw away unread data, used by the reader to catch up
+
+        ### Params:
+        keep : int = 0
+            The number of the newest bytes to leave in the ring
+
+        ### Returns:
+        out : int
+            The number of bytes (and gaps) skipped
+        """
+        target = self.write_pos - keep
+        if (target <= self.read_pos):
+            return 0
+
+        skipped = target - self.read_pos
+        while (self._gaps and self._gaps[0][0] <= target):
+            skipped += self._gaps.popleft()[1]
+
+        self.read_pos = target
+        self._writable.set()
+
+        return skipped
+
+    def close(self):
+        """
+        Stop the ring, the reader gets what is left and then None
+        """
+        if (self._open_gap):
+            self._gaps.append((self.write_pos, self._open_gap))
+            self._open_gap = 0
+
+        self.closed = True
+        self._readable.set()
+        self._writable.set()
@@ -0,0 +1,580 @@
+##
+# @file scrollback.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-09-21
+# @brief A bounded in memory history of the received data that can be
+# searched (by regex or hex pattern) and jumped through by time with in
+# session commands, long after it has scrolled off the terminal
+
+import array
+import bisect
+import datetime
+import re
+import threading
+import time
+
+import utils
+
+# Matches across the join between two blocks are found up to this long
+MAX_MATCH = 4096
+
+# The most results or lines printed by each command
+PAGE_LINES = 20
+
+# The longest line printed by the commands
+MAX_LINE = 1024
+
+# The finest time resolution kept in the time index
+TIME_RESOLUTION = 0.01
+
+# Control chars in printed lines are shown escaped so they cannot upset the
+# terminal, tabs are left as is
+CONTROL_TABLE = {value: f"\\x{value:02x}" for value in 
+    list(range(32)) + [127] if value != 9}
+
+_relative_re = re.compile(r"-(\d+(?:\.\d+)?)([smh])")
+
+
+class ScrollbackBlock:
+    """
+    A fixed size block of received data. Along with the data it holds the
+    offsets of the line starts in it and the arrival time of the data every
+    TIME_RESOLUTION, both as compact arrays. Blocks are only appended to so
+    a full block can be read without a lock.
+    """
+    def __init__(self, size: int, start: int, first_line: int):
+        """
+        Allocate the block
+
+        ### Params:
+        size : int
+            The block size in bytes
+        start : int
+            The stream position of the first byte in the block
+        first_line : int
+            The number of the line the block starts in
+        """
+        self.data = bytearray(size)
+        self.used = 0
+        self.start = start
+        self.first_line = first_line
+
+        self.lines = array.array("I") # Offsets just after each new line
+        self.time_offsets = array.array("I")
+        self.times = array.array("d")
+
+    def index_size(self) -> int:
+        """
+        Get the memory used by the indexes
+
+        ### Returns:
+        out : int
+            The size in bytes
+        """
+        return self.lines.itemsize * len(self.lines) \
+            + self.time_offsets.itemsize * len(self.time_offsets) \
+            + self.times.itemsize * len(self.times)
+
+
+def parse_when(text: str, now: float = None) -> float:
+    """
+    Parse the time given to the jump command
+
+    ### Params:
+    text : str
+        A clock time today (HH:MM[:SS[.fff]]), a date and time
+        (YYYY-MM-DD HH:MM[:SS]) or a time ago (e.g. -30s, -5m, -2h)
+    now : float = None
+        The current time, None uses time.time()
+
+    ### Returns:
+    out : float
+        The time as seconds since the epoch
+
+    ### Raises:
+    ValueError
+        If the time cannot be parsed
+    """
+    now = time.time() if now == None else now
+    text = text.strip()
+
+    match = _relative_re.fullmatch(text)
+    if (match != None):
+        scale = {"s": 1, "m": 60, "h": 3600}[match.group(2)]
+        return now - float(match.group(1)) * scale
+
+    try:
+        if (len(text) > 12): # Has a date
+            return datetime.datetime.fromisoformat(text).timestamp()
+
+        clock = datetime.time.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"cannot read the time {text}, use HH:MM:SS, " \
+            "YYYY-MM-DD HH:MM:SS or a time ago like -5m")
+
+    today = datetime.datetime.fromtimestamp(now).date()
+    when = datetime.datetime.combine(today, clock).timestamp()
+    if (when > now): # A clock time later than now was yesterday
+        when -= 24 * 3600
+
+    return when
+
+
+class Scrollback:
+    """
+    Keeps the most recent received data, up to a memory cap, in fixed size
+    blocks with the oldest block evicted when the cap is reached. Each block
+    indexes its line starts and arrival times so finding the line or time of
+    a position, or the position of a time, is a binary search rather than a
+    scan. Searches run from a position and stop after a page of results so
+    hours of traffic can be stepped through with the next command.
+
+    Appends come from the receive thread and the commands from the transmit
+    thread. Only the block list is locked, blocks that have been filled are
+    never changed so searches run without holding the lock.
+    """
+    def __init__(self, max_size: int = 64 * 1024 * 1024,
+        block_size: int = 1024 * 1024, encoding: str = "utf-8"):
+        """
+        Initialise the scrollback
+
+        ### Params:
+        max_size : int = 64 * 1024 * 1024
+            The most memory to use for the data and indexes
+        block_size : int = 1024 * 1024
+            The size of each block, the most data evicted at once
+        encoding : str = "utf-8"
+            The encoding lines are decoded with when printed
+        """
+        self.block_size = max(min(block_size, max_size // 4), MAX_MATCH)
+        self.max_size = max(max_size, 2 * self.block_size)
+        self.encoding = encoding
+
+        self.blocks = []
+        self.starts = [] # The start position of each block, for bisect
+        self.first_times = [] # The first time in each block, for bisect
+        self.position = 0
+        self.size = 0
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+        self._last_time = 0.0
+        self._next = None # What the next command continues
+        self._cursor = 0 # Where searches start, moved by jump
+
+    def append(self, chunk: bytes):
+        """
+        Add received data, used as a chunk sink of the receive pipeline
+
+        ### Params:
+        chunk : bytes
+            The received bytes
+        """
+        now = time.time()
+        chunk = memoryview(chunk)
+
+        with self._lock:
+            while (len(chunk)):
+                if (not self.blocks
+                    or self.blocks[-1].used == self.block_size):
+                    self._add_block(now)
+
+                block = self.blocks[-1]
+                length = min(len(chunk), self.block_size - block.used)
+                start = block.used
+                end = start + length
+                block.data[start:end] = chunk[:length]
+
+                if (now - self._last_time >= TIME_RESOLUTION
+                    or start == 0):
+                    block.time_offsets.append(start)
+                    block.times.append(now)
+                    self._last_time = now
+
+                # Searched in place so no object is made for each line
+                data = block.data
+                lines = block.lines
+                newline = data.find(b"\n", start, end)
+                while (newline != -1):
+                    lines.append(newline + 1)
+                    newline = data.find(b"\n", newline + 1, end)
+
+                block.used = end
+                self.position += length
+                chunk = chunk[length:]
+
+    def _add_block(self, now: float):
+        """
+        Start a new block, evicting the oldest blocks if over the cap
+
+        ### Params:
+        now : float
+            The time the first data in the block arrived
+        """
+        first_line = 0
+        if (self.blocks):
+            last = self.blocks[-1]
+            first_line = last.first_line + len(last.lines)
+            self.size += last.index_size()
+
+        while (self.blocks and self.size + self.block_size > self.max_size):
+            oldest = self.blocks.pop(0)
+            self.starts.pop(0)
+            self.first_times.pop(0)
+            self.size -= self.block_size + oldest.index_size()
+            self.evicted += oldest.used
+
+        self.blocks.append(ScrollbackBlock(self.block_size, self.position,
+            first_line))
+        self.starts.append(self.position)
+        self.first_times.append(now)
+        self.size += self.block_size
+
+    def _snapshot(self) -> tuple:
+        """
+        Take a consistent view of the blocks to read without the lock
+
+        ### Returns:
+        out : tuple
+            The blocks, their start positions, first times and the number of
+            bytes used in the last block
+        """
+        with self._lock:
+            return list(self.blocks), list(self.starts), \
+                list(self.first_times), \
+                self.blocks[-1].used if self.blocks else 0
+
+    def memory(self) -> int:
+        """
+        Get the memory used by the data and indexes
+
+        ### Returns:
+        out : int
+            The size in bytes
+        """
+        with self._lock:
+            return self.size + (self.blocks[-1].index_size()
+                if self.blocks else 0)
+
+    def oldest(self) -> int:
+        """
+        Get the position of the oldest data still held
+
+        ### Returns:
+        out : int
+            The stream position
+        """
+        with self._lock:
+            return self.starts[0] if self.starts else self.position
+
+    def _locate(self, starts: list, position: int) -> int:
+        """
+        Find the index of the block holding a position
+        """
+        return max(bisect.bisect_right(starts, position) - 1, 0)
+
+    def line_of(self, position: int) -> tuple:
+        """
+        Find the line a position is in
+
+        ### Params:
+        position : int
+            The stream position
+
+        ### Returns:
+        out : tuple
+            The line number (counted from 0 at the start of the session) and
+            the position the line starts at, or the oldest position held if
+            the start has been evicted
+        """
+        blocks, starts, _, _ = self._snapshot()
+        if (not blocks):
+            return 0, 0
+
+        index = self._locate(starts, position)
+        block = blocks[index]
+        found = bisect.bisect_right(block.lines, position - block.start)
+        number = block.first_line + found
+        if (found):
+            return number, block.start + block.lines[found - 1]
+
+        # The line started in an earlier block
+        for earlier in reversed(blocks[:index]):
+            if (earlier.lines):
+                return number, earlier.start + earlier.lines[-1]
+
+        return number, blocks[0].start
+
+    def time_of(self, position: int) -> float:
+        """
+        Find when the data at a position arrived
+
+        ### Params:
+        position : int
+            The stream position
+
+        ### Returns:
+        out : float
+            The time as seconds since the epoch (within TIME_RESOLUTION), 
+            None if nothing is held
+        """
+        blocks, starts, _, _ = self._snapshot()
+        if (not blocks):
+            return None
+
+        block = blocks[self._locate(starts, position)]
+        found = bisect.bisect_right(block.time_offsets, position - block.start)
+
+        return block.times[max(found - 1, 0)]
+
+    def position_at(self, when: float) -> int:
+        """
+        Find the first data that arrived at or after a time
+
+        ### Params:
+        when : float
+            The time as seconds since the epoch
+
+        ### Returns:
+        out : int
+            The stream position, the end of the data if nothing arrived 
+            after the time
+        """
+        blocks, _, first_times, _ = self._snapshot()
+        if (not blocks):
+            return self.position
+
+        index = max(bisect.bisect_right(first_times, when) - 1, 0)
+        for block in blocks[index:index + 2]:
+            found = bisect.bisect_left(block.times, when)
+            if (found < len(block.times)):
+                return block.start + block.time_offsets[found]
+
+        return self.position
+
+    def read(self, start: int, end: int) -> bytes:
+        """
+        Copy out held data
+
+        ### Params:
+        start : int
+            The first stream position
+        end : int
+            The stream position after the last byte
+
+        ### Returns:
+        out : bytes
+            The data, starting later if the start has been evicted
+        """
+        blocks, starts, _, last_used = self._snapshot()
+        if (not blocks):
+            return b""
+
+        start = max(start, starts[0])
+        end = min(end, starts[-1] + last_used)
+        parts = []
+        index = self._locate(starts, start)
+        while (start < end and index < len(blocks)):
+            block = blocks[index]
+            offset = start - block.start
+            length = min(end - start, len(block.data) - offset)
+            parts.append(bytes(memoryview(block.data)[offset:offset + length]))
+            start += length
+            index += 1
+
+        return b"".join(parts)
+
+    def line_end(self, position: int) -> int:
+        """
+        Find the end of the line a position is in
+
+        ### Params:
+        position : int
+            The stream position
+
+        ### Returns:
+        out : int
+            The position after the new line ending the line or the end of
+            the data if the line is not finished
+        """
+        blocks, starts, _, _ = self._snapshot()
+        index = self._locate(starts, position)
+
+        for block in blocks[index:]:
+            found = bisect.bisect_right(block.lines, position - block.start)
+            if (found < len(block.lines)):
+                return block.start + block.lines[found]
+
+        return self.position
+
+    def search(self, pattern: re.Pattern, start: int = 0,
+        limit: int = PAGE_LINES) -> list:
+        """
+        Find matches from a position on, stopping after a page of results
+
+        ### Params:
+        pattern : re.Pattern
+            The compiled bytes pattern to look for
+        start : int = 0
+            The stream position to search from
+        limit : int = PAGE_LINES
+            The most matches to return
+
+        ### Returns:
+        out : list
+            The stream positions of the matches in order
+        """
+        blocks, starts, _, last_used = self._snapshot()
+        if (not blocks):
+            return []
+
+        start = max(start, starts[0])
+        matches = []
+        index = self._locate(starts, start)
+
+        for index in range(index, len(blocks)):
+            block = blocks[index]
+            used = last_used if index == len(blocks) - 1 else len(block.data)
+            found = [block.start + match.start() for match in 
+                pattern.finditer(block.data, max(start - block.start, 0), 
+                used)]
+
+            # Matches that run over the join into the next block
+            if (index + 1 < len(blocks)):
+                tail = max(used - MAX_MATCH, start - block.start, 0)
+                following = blocks[index + 1]
+                window = bytes(block.data[tail:used]) + bytes(
+                    following.data[:min(MAX_MATCH, last_used if index + 2 
+                    == len(blocks) else len(following.data))])
+                joined = used - tail
+                found += [block.start + tail + match.start() for match in
+                    pattern.finditer(window) if match.start() < joined 
+                    and match.end() > joined]
+                found.sort()
+
+            matches += found
+            if (len(matches) >= limit):
+                return matches[:limit]
+
+        return matches
+
+    def format_line(self, start: int) -> str:
+        """
+        Format a held line to print with its arrival time and line number
+
+        ### Params:
+        start : int
+            The position the line starts at
+
+        ### Returns:
+        out : str
+            The line without its new line, cut to MAX_LINE bytes
+        """
+        end = min(self.line_end(start), start + MAX_LINE)
+        text = self.read(start, end).rstrip(b"\r\n").decode(self.encoding,
+            "backslashreplace").translate(CONTROL_TABLE)
+        clock = datetime.datetime.fromtimestamp(self.time_of(start))
+
+        return f"{clock.strftime('%H:%M:%S.%f')[:-3]} " \
+            f"{self.line_of(start)[0] + 1:>8}  {text}"
+
+    def _print_matches(self, pattern: re.Pattern, start: int):
+        """
+        Print the lines holding the next page of matches
+        """
+        matches = self.search(pattern, start)
+        if (not matches):
+            print(f"{utils.get_time_str()} No more matches")
+            self._next = None
+            return
+
+        last_line = None
+        for position in matches:
+            _, line = self.line_of(position)
+            if (line != last_line):
+                print(self.format_line(line))
+                last_line = line
+
+        self._next = lambda: self._print_matches(pattern, matches[-1] + 1)
+
+    def _print_lines(self, start: int):
+        """
+        Print the next page of lines
+        """
+        if (start >= self.position):
+            print(f"{utils.get_time_str()} End of the scrollback")
+            self._next = None
+            return
+
+        for _ in range(PAGE_LINES):
+            if (start >= self.position):
+                break
+            print(self.format_line(start))
+            start = self.line_end(start)
+
+        self._next = lambda: self._print_lines(start)
+
+    def find(self, argument: str):
+        """
+        Print the lines matching a regex from the oldest data held or the last
+        jump (the ::find command)
+
+        ### Params:
+        argument : str
+            The regular expression
+
+        ### Raises:
+        ValueError
+            If the expression is not valid
+        """
+        try:
+            pattern = re.compile(argument.encode(self.encoding))
+        except re.error as e:
+            raise ValueError(f"bad pattern {e}")
+
+        self._print_matches(pattern, max(self._cursor, self.oldest()))
+
+    def find_hex(self, argument: str):
+        """
+        Print the lines holding a sequence of bytes given in hex, e.g. 
+        "de ad be ef" (the ::findhex command)
+
+        ### Params:
+        argument : str
+            The bytes in hex
+
+        ### Raises:
+        ValueError
+            If the argument is not valid hex
+        """
+        pattern = re.compile(re.escape(bytes.fromhex(argument)))
+
+        self._print_matches(pattern, max(self._cursor, self.oldest()))
+
+    def jump(self, argument: str):
+        """
+        Print the lines received from a time on, later searches start from
+        there as well (the ::jump command)
+
+        ### Params:
+        argument : str
+            The time, see parse_when
+
+        ### Raises:
+        ValueError
+            If the time cannot be parsed
+        """
+        _, self._cursor = self.line_of(self.position_at(parse_when(argument)))
+
+        self._print_lines(self._cursor)
+
+    def next(self, argument: str = ""):
+        """
+        Print the next page of the last find or jump (the ::next command)
+        """
+        if (self._next == None):
+            print(f"{utils.get_time_str()} Nothing to continue, use find, " \
+                "findhex or jump first")
+            return
+
+        self._next()
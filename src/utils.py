@@ -6,6 +6,10 @@
 
 import threading
 import datetime
+import os
+
+# Functions run before the application exits
+exit_handlers = []
 
 def close_com_threads():
     """
@@ -32,3 +36,18 @@ def get_time_str() -> str:
 
     return now.strftime("[%H:%M:%S]:")
 
+
+
+def exit_app(code: int = 0):
+    """
+    Run the registered exit handlers (e.g. flushing captures) and then exit
+    immediately without waiting for the blocked serial threads.
+
+    ### Params:
+    code : int = 0
+        The exit code
+    """
+    for handler in exit_handlers:
+        handler()
+
+    os._exit(code)
@@ -0,0 +1,11 @@
+##
+# @file conftest.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Shared pytest setup, the application modules are imported from src
+# the same way main.py imports them
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
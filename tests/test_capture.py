@@ -0,0 +1,124 @@
+##
+# @file test_capture.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Tests for the raw and record capture writers and the record reader
+
+import gzip
+import os
+
+import pytest
+
+import capture
+from capture import CaptureWriter, CaptureReader, RX, TX
+
+
+class FakeClock:
+    """
+    Stands in for time.monotonic_ns so record time stamps are known
+    """
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self) -> int:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(capture.time, "monotonic_ns", fake)
+    return fake
+
+
+def test_raw_capture_ignores_tx(tmp_path):
+    path = str(tmp_path / "raw.bin")
+    writer = CaptureWriter(path)
+    writer.write(b"hello ")
+    writer.write(b"sent", TX)
+    writer.write(b"world")
+    writer.close()
+
+    with open(path, "rb") as file:
+        assert file.read() == b"hello world"
+    assert writer.bytes_written == 11
+
+
+def test_raw_capture_rotates_and_compresses(tmp_path):
+    path = str(tmp_path / "raw.bin")
+    writer = CaptureWriter(path, rotate_size=4, compress=True)
+    for chunk in [b"ab", b"cd", b"ef", b"ghij"]:
+        writer.write(chunk)
+    writer.close()
+
+    with gzip.open(str(tmp_path / "raw.0000.bin.gz")) as file:
+        assert file.read() == b"abcd"
+    with gzip.open(str(tmp_path / "raw.0001.bin.gz")) as file:
+        assert file.read() == b"ef"
+    with open(str(tmp_path / "raw.0002.bin"), "rb") as file:
+        assert file.read() == b"ghij"
+    assert not os.path.exists(str(tmp_path / "raw.0000.bin"))
+
+
+def test_record_round_trip(tmp_path, clock):
+    path = str(tmp_path / "rec.bin")
+    writer = CaptureWriter(path, records=True, index_interval=1.0)
+    sent = []
+    for i in range(10):
+        clock.now = i * 500_000_000
+        data = bytes([i]) * i
+        direction = TX if i % 3 == 0 else RX
+        writer.write(data, direction)
+        sent.append((i * 0.5, direction, data))
+    writer.close()
+
+    reader = CaptureReader(path)
+    assert [(record.timestamp, record.direction, bytes(record.data))
+        for record in reader] == sent
+
+    # The index points at or before the first record at each time
+    assert reader.offset_for_time(0) == capture.FILE_HEADER.size
+    assert [record.timestamp for record in reader.records(2.0, 3.0)] \
+        == [2.0, 2.5, 3.0]
+    assert [record.timestamp for record in reader.records(4.1)] == [4.5]
+    reader.close()
+
+
+def test_record_truncated_final_record(tmp_path, clock):
+    path = str(tmp_path / "rec.bin")
+    writer = CaptureWriter(path, records=True)
+    writer.write(b"complete")
+    writer.write(b"cut short")
+    writer.close()
+
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 3)
+
+    reader = CaptureReader(path)
+    assert [bytes(record.data) for record in reader] == [b"complete"]
+    reader.close()
+
+
+def test_reader_close_with_open_generator(tmp_path, clock):
+    path = str(tmp_path / "rec.bin")
+    writer = CaptureWriter(path, records=True)
+    writer.write(b"one")
+    writer.write(b"two")
+    writer.close()
+
+    reader = CaptureReader(path)
+    records = reader.records()
+    assert bytes(next(records).data) == b"one"
+    reader.close()
+
+    with pytest.raises(StopIteration):
+        next(records)
+
+
+@pytest.mark.parametrize("contents", [b"", b"BSCAP001", b"not a capture!!!!"])
+def test_reader_rejects_other_files(tmp_path, contents):
+    path = tmp_path / "other.bin"
+    path.write_bytes(contents)
+
+    with pytest.raises(ValueError):
+        CaptureReader(str(path))
@@ -0,0 +1,60 @@
+##
+# @file test_com_tx.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Tests for the escape sequence encoder used when sending
+
+import pytest
+
+from com_tx import convert_to_bytes, convert_lines, EscapeError, MAX_REPEAT
+
+
+@pytest.mark.parametrize("input_str, expected", [
+    ("plain text", b"plain text"),
+    ("", b""),
+    (r"a\nb\rc\td\be\ff\0g\\h", b"a\nb\rc\td\be\ff\x00g\\h"),
+    (r"\x41\xfF", b"A\xff"),
+    (r"\o101\o377", b"A\xff"),
+    (r"é€", "é€".encode()),
+    ("café\\n", "café\n".encode()),
+    (r"\x00{4}", b"\x00" * 4),
+    (r"ab\n{3}c", b"ab\n\n\nc"),
+    (r"\x41{0}B", b"B"),
+    (r"{2}\x41", b"{2}A"),
+])
+def test_convert_to_bytes(input_str, expected):
+    assert convert_to_bytes(input_str) == expected
+
+
+def test_convert_to_bytes_repeats_are_not_cached():
+    assert convert_to_bytes(r"\x7e{3}") == b"~~~"
+    assert convert_to_bytes(r"\x7e") == b"~"
+
+
+@pytest.mark.parametrize("input_str, column", [
+    (r"\q", 0),
+    ("ok\\", 2),
+    (r"ab\xZZ", 2),
+    (r"\o400", 0),
+    (r"\u12", 0),
+    ("\\x41{%d}" % (MAX_REPEAT + 1), 0),
+])
+def test_bad_escapes(input_str, column):
+    with pytest.raises(EscapeError) as error:
+        convert_to_bytes(input_str)
+
+    assert error.value.column == column
+    assert error.value.line == None
+    assert isinstance(error.value, ValueError)
+
+
+def test_convert_lines():
+    assert convert_lines(["AT\n", r"AT+X=\x01" + "\r\n"], b"\r\n") \
+        == [b"AT\r\n", b"AT+X=\x01\r\n"]
+
+    with pytest.raises(EscapeError) as error:
+        convert_lines(["fine", "also fine", r"not \fine\?"])
+
+    assert error.value.line == 3
+    assert error.value.column == 9
+    assert "line 3, column 10" in str(error.value)
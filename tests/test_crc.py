@@ -0,0 +1,44 @@
+##
+# @file test_crc.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Tests for the Modbus CRC16
+
+import random
+
+import pytest
+
+from crc import crc16_modbus, MODBUS_POLY
+
+
+def crc16_bitwise(data: bytes) -> int:
+    """
+    The CRC calculated a bit at a time to check the tables against
+    """
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ MODBUS_POLY if (crc & 1) else crc >> 1
+    return crc
+
+
+def test_check_value():
+    assert crc16_modbus(b"123456789") == 0x4B37
+    assert crc16_modbus(b"") == 0xFFFF
+
+
+@pytest.mark.parametrize("length", [1, 2, 3, 8, 255, 256, 257, 1000])
+def test_matches_bitwise(length):
+    rng = random.Random(length)
+    data = bytes(rng.getrandbits(8) for _ in range(length))
+
+    assert crc16_modbus(data) == crc16_bitwise(data)
+    assert crc16_modbus(memoryview(bytearray(data))) == crc16_bitwise(data)
+
+
+def test_frame_with_crc_checks_to_zero():
+    frame = bytes.fromhex("01 03 00 00 00 0a")
+    frame += crc16_modbus(frame).to_bytes(2, "little")
+    assert frame.hex(" ") == "01 03 00 00 00 0a c5 cd"
+    assert crc16_modbus(frame) == 0
@@ -0,0 +1,170 @@
+##
+# @file test_decoders.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Tests for the Modbus RTU framer and the built in decoders
+
+import struct
+
+import pytest
+
+from configuration import ConfigDict
+from crc import crc16_modbus
+from decoders import (ModbusRtuDecoder, StructDecoder, make_decoder,
+    unpack_bits, unpack_registers)
+from framing import ModbusRtuFramer
+
+
+def frame(hex_body: str) -> bytes:
+    """
+    Build a Modbus RTU frame from its hex body by adding the CRC
+    """
+    body = bytes.fromhex(hex_body)
+    return body + crc16_modbus(body).to_bytes(2, "little")
+
+
+READ_REQUEST = frame("01 03 00 10 00 02")
+READ_RESPONSE = frame("01 03 04 00 2a 01 00")
+WRITE_REQUEST = frame("11 10 00 01 00 02 04 00 0a 01 02")
+WRITE_RESPONSE = frame("11 10 00 01 00 02")
+EXCEPTION = frame("0a 81 02")
+
+
+def test_framer_splits_requests_and_responses():
+    framer = ModbusRtuFramer()
+    stream = READ_REQUEST + READ_RESPONSE + WRITE_REQUEST + WRITE_RESPONSE \
+        + EXCEPTION
+
+    packets = []
+    for i in range(len(stream)):
+        packets += framer.feed(stream[i:i + 1])
+
+    assert packets == [READ_REQUEST, READ_RESPONSE, WRITE_REQUEST,
+        WRITE_RESPONSE, EXCEPTION]
+    assert framer.errors == 0
+    assert framer.buffer == b""
+
+
+def test_framer_resyncs_after_noise():
+    framer = ModbusRtuFramer()
+    packets = framer.feed(b"\xff\x00" + READ_REQUEST + READ_RESPONSE[:-1])
+    assert packets == [READ_REQUEST]
+    assert framer.errors == 2
+    assert framer.feed(READ_RESPONSE[-1:]) == [READ_RESPONSE]
+
+
+def test_decode_read():
+    decoder = ModbusRtuDecoder()
+    assert decoder.decode(READ_REQUEST) == [{"address": 1,
+        "function": "read_holding_registers", "start": 16, "count": 2}]
+    assert decoder.decode(READ_RESPONSE) == [{"address": 1,
+        "function": "read_holding_registers", "registers": [42, 256]}]
+
+
+def test_decode_request_that_looks_like_a_response():
+    # A start address of 0x03XX has the byte count of a 3 byte response
+    assert ModbusRtuDecoder().decode(frame("01 03 03 00 00 0a")) \
+        == [{"address": 1, "function": "read_holding_registers",
+        "start": 768, "count": 10}]
+
+
+def test_decode_coils():
+    decoder = ModbusRtuDecoder()
+    assert decoder.decode(frame("01 01 02 cd 01"))[0]["bits"] \
+        == "1011001110000000"
+    assert decoder.decode(frame("01 0f 00 13 00 0a 02 cd 01"))[0] \
+        == {"address": 1, "function": "write_multiple_coils", "start": 19,
+        "count": 10, "bits": "1011001110"}
+
+
+def test_decode_writes():
+    decoder = ModbusRtuDecoder()
+    assert decoder.decode(WRITE_REQUEST)[0]["registers"] == [10, 258]
+    assert decoder.decode(WRITE_RESPONSE)[0] == {"address": 17,
+        "function": "write_multiple_registers", "start": 1, "count": 2}
+    assert decoder.decode(frame("01 06 00 01 00 03"))[0] == {"address": 1,
+        "function": "write_single_register", "start": 1, "value": 3}
+
+
+def test_decode_exception():
+    assert ModbusRtuDecoder().decode(EXCEPTION) == [{"address": 10,
+        "function": "read_coils", "exception": "illegal_data_address"}]
+
+
+@pytest.mark.parametrize("packet, reason", [
+    (b"\x01\x03", "frame too short"),
+    (READ_REQUEST[:-1] + b"\x00", "bad CRC"),
+    (frame("01 83"), "missing exception code"),
+    (frame("01 03 00 10 00"), "bad read length"),
+    (frame("11 10 00 01 00 02 05 00 0a 01 02"), "bad byte count"),
+])
+def test_decode_errors(packet, reason):
+    decoder = ModbusRtuDecoder()
+    with pytest.raises(ValueError, match=reason):
+        decoder.decode(packet)
+
+    assert decoder.render(packet) \
+        == f"modbus error: {reason}: {packet.hex(' ')}\n"
+    assert decoder.errors == 1
+
+
+def test_render_counts_records():
+    decoder = ModbusRtuDecoder()
+    assert decoder.render(WRITE_RESPONSE) == "address=17 " \
+        "function=write_multiple_registers start=1 count=2\n"
+    assert decoder.records == 1
+
+
+def test_unpack_helpers():
+    assert unpack_registers(b"\x00\x01\xff\xff") == (1, 65535)
+    assert unpack_registers(bytes(300)) == (0,) * 150
+    assert unpack_bits(b"\x01\x80", 16) == "1000000000000001"
+
+    with pytest.raises(ValueError):
+        unpack_registers(b"\x00")
+
+
+def struct_config(layout: dict) -> ConfigDict:
+    return ConfigDict(type="struct", layout="point",
+        layouts=ConfigDict(point=layout))
+
+
+def test_struct_decoder():
+    decoder = StructDecoder(struct_config({"format": "<Bhh",
+        "fields": ["id", "x", "y"]}))
+    packet = struct.pack("<Bhh", 1, -2, 3) + struct.pack("<Bhh", 2, 4, -5)
+
+    assert decoder.decode(packet) == [{"id": 1, "x": -2, "y": 3},
+        {"id": 2, "x": 4, "y": -5}]
+    assert decoder.render(packet) == "point id=1 x=-2 y=3\npoint id=2 x=4 y=-5\n"
+    assert decoder.records == 2
+
+    assert decoder.render(b"\x01\x02") \
+        == "point error: 2 bytes is not a whole number of 5 byte records: " \
+        "01 02\n"
+    assert decoder.errors == 1
+
+
+@pytest.mark.parametrize("layout", [
+    {"format": "<Bhh", "fields": ["id", "x"]},
+    {"format": "<Q!", "fields": ["id"]},
+    {"fields": ["id"]},
+])
+def test_struct_decoder_bad_layouts(layout):
+    with pytest.raises(ValueError):
+        StructDecoder(struct_config(layout))
+
+    with pytest.raises(ValueError):
+        StructDecoder(ConfigDict(layout="missing", layouts=ConfigDict()))
+
+
+def test_make_decoder():
+    assert make_decoder(ConfigDict(type="none")) == None
+    assert isinstance(make_decoder(ConfigDict(type="modbus")), ModbusRtuDecoder)
+    assert isinstance(make_decoder(ConfigDict(type="decoders:ModbusRtuDecoder")),
+        ModbusRtuDecoder)
+
+    for bad in ["bogus", "no_such_module:Decoder", "decoders:Missing",
+        "decoders:make_decoder"]:
+        with pytest.raises(ValueError):
+            make_decoder(ConfigDict(type=bad))
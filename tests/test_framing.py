@@ -0,0 +1,85 @@
+##
+# @file test_framing.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Tests for the delimiter, length prefix, SLIP and COBS framers
+
+import pytest
+
+from framing import (DelimiterFramer, LengthPrefixFramer, SlipFramer,
+    CobsFramer, cobs_decode, make_framer)
+
+
+def feed_bytewise(framer, data: bytes) -> list:
+    """
+    Feed data to a framer one byte at a time
+    """
+    packets = []
+    for i in range(len(data)):
+        packets += framer.feed(data[i:i + 1])
+    return packets
+
+
+def test_delimiter_splits_packets():
+    framer = DelimiterFramer(b"\n")
+    assert framer.feed(b"one\ntwo\nthr") == [b"one", b"two"]
+    assert framer.feed(b"ee\n") == [b"three"]
+    assert framer.buffer == b""
+
+
+def test_delimiter_split_across_chunks():
+    framer = DelimiterFramer(b"\r\n")
+    assert feed_bytewise(framer, b"ab\r\ncd\r\n\r\n") == [b"ab", b"cd", b""]
+
+
+def test_delimiter_empty_rejected():
+    with pytest.raises(ValueError):
+        DelimiterFramer(b"")
+
+
+def test_overflow_forces_packet_out():
+    framer = DelimiterFramer(b"\n", max_length=4)
+    assert framer.feed(b"abcdef") == [b"abcdef"]
+    assert framer.overflows == 1
+    assert framer.feed(b"g\n") == [b"g"]
+
+
+def test_length_prefix():
+    framer = LengthPrefixFramer(2, "little")
+    data = b"\x03\x00abc\x00\x00\x01\x00z"
+    assert feed_bytewise(framer, data) == [b"abc", b"", b"z"]
+    assert framer.feed(b"\x05\x00ab") == []
+    assert framer.feed(b"cde") == [b"abcde"]
+
+
+def test_slip_unescapes_and_drops_bad_packets():
+    framer = SlipFramer()
+    data = b"\xc0a\xdb\xdcb\xdb\xddc\xc0\xc0bad\xdb\x01\xc0ok\xc0"
+    assert framer.feed(data) == [b"a\xc0b\xdbc", b"ok"]
+    assert framer.errors == 1
+
+
+def test_cobs_decode():
+    assert cobs_decode(b"\x01") == b""
+    assert cobs_decode(b"\x01\x01") == b"\x00"
+    assert cobs_decode(b"\x03\x11\x22\x02\x33") == b"\x11\x22\x00\x33"
+    assert cobs_decode(b"\xff" + bytes(range(1, 255))) == bytes(range(1, 255))
+
+    with pytest.raises(ValueError):
+        cobs_decode(b"\x05ab")
+
+
+def test_cobs_framer():
+    framer = CobsFramer()
+    data = b"\x03\x11\x22\x02\x33\x00\x00\x04ab\x00"
+    assert feed_bytewise(framer, data) == [b"\x11\x22\x00\x33"]
+    assert framer.errors == 1
+
+
+def test_make_framer():
+    assert make_framer("none") == None
+    assert isinstance(make_framer("delim", b";"), DelimiterFramer)
+    assert make_framer("length", header_size=4).header_size == 4
+
+    with pytest.raises(ValueError):
+        make_framer("bogus")
@@ -0,0 +1,119 @@
+##
+# @file test_ring_buffer.py
+# @author Jack Duignan (JackpDuignan@gmail.com)
+# @date 2024-10-02
+# @brief Tests for the receive ring buffer and its overflow policies
+
+import threading
+
+import pytest
+
+from ring_buffer import RingBuffer
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        RingBuffer(8, "bogus")
+
+
+def test_wraps_around():
+    ring = RingBuffer(8)
+    ring.put(b"abcdef")
+    assert ring.get(max_size=4) == (b"abcd", 0)
+
+    ring.put(b"ghijkl") # Wraps past the end
+    assert ring.waiting() == 8
+    assert ring.free() == 0
+    assert ring.get() == (b"efghijkl", 0)
+    assert ring.high_water == 8
+
+
+def test_get_into_reuses_buffer():
+    ring = RingBuffer(8)
+    buffer = bytearray(3)
+    ring.put(b"abcde")
+    assert ring.get_into(buffer) == (3, 0)
+    assert buffer == b"abc"
+    assert ring.get_into(memoryview(buffer)) == (2, 0)
+    assert buffer[:2] == b"de"
+
+
+def test_get_times_out():
+    ring = RingBuffer(8)
+    assert ring.get(timeout=0.01) == (b"", 0)
+
+
+def test_close_drains_then_ends():
+    ring = RingBuffer(8)
+    ring.put(b"abc")
+    ring.close()
+    assert ring.get() == (b"abc", 0)
+    assert ring.get() == None
+
+
+def test_block_loses_nothing():
+    ring = RingBuffer(16, "block")
+    data = bytes(range(256)) * 40
+    received = bytearray()
+
+    def reader():
+        while (True):
+            item = ring.get(timeout=5)
+            if (item == None):
+                return
+            received.extend(item[0])
+            assert item[1] == 0
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for i in range(0, len(data), 100):
+        ring.put(data[i:i + 100])
+    ring.close()
+    thread.join(5)
+
+    assert received == data
+    assert ring.blocked > 0
+    assert ring.dropped == 0
+
+
+def test_drop_oldest():
+    ring = RingBuffer(8, "drop-oldest")
+    ring.put(b"abcdef")
+    ring.put(b"ghij")
+    assert ring.get() == (b"cdefghij", 2)
+
+    # Only the newest ring full of a large write is kept
+    ring.put(bytes(range(20)))
+    assert ring.get() == (bytes(range(12, 20)), 12)
+    assert ring.dropped == 14
+    assert ring.overruns == 2
+
+
+def test_coalesce_reports_one_gap_in_order():
+    ring = RingBuffer(8, "coalesce")
+    ring.put(b"abcdef")
+    ring.put(b"ghij")
+    ring.put(b"klm") # Joins the open gap
+    assert ring.get() == (b"abcdefgh", 0)
+
+    ring.put(b"no")
+    assert ring.get() == (b"no", 5)
+    assert ring.dropped == 5
+    assert ring.overruns == 1
+
+
+def test_coalesce_gap_published_on_close():
+    ring = RingBuffer(4, "coalesce")
+    ring.put(b"abcdef")
+    ring.close()
+    assert ring.get() == (b"abcd", 0)
+    assert ring.get() == (b"", 2)
+    assert ring.get() == None
+
+
+def test_skip_keeps_newest():
+    ring = RingBuffer(8)
+    ring.put(b"abcdefgh")
+    assert ring.skip(keep=3) == 5
+    assert ring.get() == (b"fgh", 0)
+    assert ring.skip() == 0